@@ -0,0 +1,197 @@
+"""
+Coarse-to-fine (multi-resolution) aperture scans.
+
+A uniform scan spends most of its acquisitions on regions where the SLM
+aberration is smooth and a coarse grid already resolves it. AdaptiveGrid starts
+from the coarse roi_n x roi_n grid of a measurement (level 0) and, level by
+level, splits an aperture into 2 x 2 apertures of half the width only where the
+retrieved phase changes quickly between neighbours or the fit error is high.
+The measured apertures (the leaves of the resulting quadtree) are finally
+interpolated onto one common grid at the finest resolution.
+
+Phases are handled as unit phasors, so wrapped values interpolate correctly.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import numpy as np
+from scipy.interpolate import griddata
+
+
+def _wrap(phase):
+    """Wrap a phase to [-pi, pi)."""
+    return np.mod(phase + np.pi, 2 * np.pi) - np.pi
+
+
+def phase_steps(dphi):
+    """
+    Largest wrapped phase step from every cell of a map to its 4 neighbours.
+
+    Args:
+        dphi (np.ndarray): 2D phase map [rad].
+
+    Returns:
+        np.ndarray: Maximum absolute phase difference per cell [rad].
+    """
+    steps = np.zeros(dphi.shape)
+    d_rows = np.abs(_wrap(np.diff(dphi, axis=0)))
+    d_cols = np.abs(_wrap(np.diff(dphi, axis=1)))
+    np.maximum(steps[1:], d_rows, out=steps[1:])
+    np.maximum(steps[:-1], d_rows, out=steps[:-1])
+    np.maximum(steps[:, 1:], d_cols, out=steps[:, 1:])
+    np.maximum(steps[:, :-1], d_cols, out=steps[:, :-1])
+    return steps
+
+
+class AdaptiveGrid:
+    """
+    Quadtree of measured apertures over a square block of the SLM.
+
+    Level L is a regular grid of (n * 2**L)^2 cells of width width / 2**L pixels;
+    cells are addressed by their flat (row-major) index on their level.
+
+    Attributes:
+        n (int): Cells per side at level 0.
+        width (int): Aperture width at level 0 [px].
+        top (int): First SLM row of the block [px].
+        left (int): First SLM column of the block [px].
+        levels (dict): level -> (cells, dphi, amp, dphi_err) of the measured apertures.
+    """
+
+    def __init__(self, n, width, top=0, left=0):
+        self.n = int(n)
+        self.width = int(width)
+        self.top = int(top)
+        self.left = int(left)
+        self.levels = {}
+
+    def side(self, level):
+        """Cells per side on a level."""
+        return self.n * 2 ** level
+
+    def bounds(self, level, cells):
+        """
+        SLM pixel bounds of cells on a level.
+
+        Args:
+            level (int): Quadtree level.
+            cells (np.ndarray): Flat cell indices.
+
+        Returns:
+            tuple: (top, bottom, left, right) integer arrays, as aperture_bounds.
+        """
+        width = self.width // 2 ** level
+        rows, cols = np.divmod(np.asarray(cells, dtype=int), self.side(level))
+        top = self.top + rows * width
+        left = self.left + cols * width
+        return top, top + width, left, left + width
+
+    def add(self, level, cells, dphi, amp, dphi_err):
+        """
+        Record the results of the apertures measured on a level.
+
+        Amplitudes are rescaled by the aperture area relative to level 0, so all
+        levels share one intensity scale.
+        """
+        self.levels[level] = (np.asarray(cells, dtype=int), np.asarray(dphi, dtype=float),
+                              np.asarray(amp, dtype=float) * 4 ** level, np.asarray(dphi_err, dtype=float))
+
+    def maps(self, level):
+        """
+        Phase and error maps on a level, filled from the coarser levels where
+        no aperture of that level was measured.
+
+        Returns:
+            tuple: (dphi, dphi_err) arrays of shape (side, side).
+        """
+        dphi = np.zeros((self.n, self.n))
+        err = np.zeros((self.n, self.n))
+        for lvl in range(level + 1):
+            if lvl > 0:
+                dphi = np.kron(dphi, np.ones((2, 2)))
+                err = np.kron(err, np.ones((2, 2)))
+            if lvl in self.levels:
+                cells, phase, _, phase_err = self.levels[lvl]
+                dphi.flat[cells] = phase
+                err.flat[cells] = phase_err
+        return dphi, err
+
+    def refine(self, level, max_step=np.pi / 2, max_err=None):
+        """
+        Cells of the next level that split the apertures of a level needing more resolution.
+
+        An aperture of the level is split when its phase differs from a neighbour
+        by more than max_step, or when its fit error exceeds max_err.
+
+        Args:
+            level (int): Level measured last.
+            max_step (float): Phase step to the neighbours that triggers a split [rad]; None disables.
+            max_err (float): Fit error that triggers a split [rad]; None disables.
+
+        Returns:
+            np.ndarray: Flat indices of the child cells on level + 1 (sorted).
+        """
+        cells = self.levels[level][0]
+        dphi, err = self.maps(level)
+        split = np.zeros(cells.size, dtype=bool)
+        if max_step is not None:
+            split |= phase_steps(dphi).flat[cells] > max_step
+        if max_err is not None:
+            split |= err.flat[cells] > max_err
+        rows, cols = np.divmod(cells[split], self.side(level))
+        side = self.side(level + 1)
+        children = [(2 * rows + i) * side + 2 * cols + j for i in (0, 1) for j in (0, 1)]
+        return np.sort(np.concatenate(children)) if split.any() else np.zeros(0, dtype=int)
+
+    def leaves(self):
+        """
+        Measured apertures not split by a finer level.
+
+        Returns:
+            list: (level, cells, dphi, amp, dphi_err) per level, restricted to leaves.
+        """
+        leaves = []
+        for level in sorted(self.levels):
+            cells, dphi, amp, err = self.levels[level]
+            keep = np.ones(cells.size, dtype=bool)
+            if level + 1 in self.levels:
+                rows, cols = np.divmod(self.levels[level + 1][0], self.side(level + 1))
+                parents = (rows // 2) * self.side(level) + cols // 2
+                keep = ~np.isin(cells, parents)
+            leaves.append((level, cells[keep], dphi[keep], amp[keep], err[keep]))
+        return leaves
+
+    def resample(self, level=None):
+        """
+        Interpolate the leaves linearly onto the regular grid of a level.
+
+        Points outside the convex hull of the leaf centres take the nearest leaf.
+
+        Args:
+            level (int): Output level; defaults to the finest measured level.
+
+        Returns:
+            tuple: (dphi, amp, dphi_err) arrays of shape (side, side).
+        """
+        level = max(self.levels) if level is None else level
+        side = self.side(level)
+        points, values = [], []
+        for lvl, cells, dphi, amp, err in self.leaves():
+            rows, cols = np.divmod(cells, self.side(lvl))
+            # Leaf centres in units of output cells
+            scale = 2.0 ** (level - lvl)
+            points.append(np.c_[(rows + 0.5) * scale - 0.5, (cols + 0.5) * scale - 0.5])
+            values.append(np.c_[np.exp(1j * dphi), amp, err])
+        points = np.concatenate(points)
+        values = np.concatenate(values)
+        grid = np.indices((side, side)).reshape(2, -1).T
+
+        if len(points) >= 3:
+            out = griddata(points, values, grid, method="linear")
+            missing = np.isnan(out.real).any(axis=1)
+            if missing.any():
+                out[missing] = griddata(points, values, grid[missing], method="nearest")
+        else:
+            out = griddata(points, values, grid, method="nearest")
+        out = out.reshape(side, side, 3)
+        return np.angle(out[..., 0]), out[..., 1].real, out[..., 2].real
@@ -0,0 +1,157 @@
+"""
+Streaming frame averaging for the measurement cameras.
+
+FrameAverager keeps a running float32 mean while frames arrive, so averaging
+N exposures never holds more than one frame, and writes the result into a
+buffer owned by the caller. Frames can be binned in software before they are
+accumulated. spot_window() centres a sensor ROI (subarray) on the interference
+spot, so only the pixels that carry fringes are read out and fitted.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import numpy as np
+
+
+def binned_shape(shape, binning):
+    """(height, width) of a frame of the given shape after binning x binning binning."""
+    return shape[0] // binning, shape[1] // binning
+
+
+def bin_frame(frame, binning, out=None):
+    """
+    Sum binning x binning blocks of a frame, dropping incomplete edge blocks.
+
+    Args:
+        frame (np.ndarray): 2D frame.
+        binning (int): Block size.
+        out (np.ndarray): Optional array of the binned shape to write into.
+
+    Returns:
+        np.ndarray: Binned frame.
+    """
+    if binning == 1:
+        if out is None:
+            return frame
+        np.copyto(out, frame, casting="unsafe")
+        return out
+    h, w = binned_shape(frame.shape, binning)
+    blocks = frame[:h * binning, :w * binning].reshape(h, binning, w, binning)
+    return np.sum(blocks, axis=(1, 3), out=out, dtype=None if out is None else out.dtype)
+
+
+def spot_window(frame, shape):
+    """
+    Top-left corner of a window of the given shape centred on the brightest spot.
+
+    The spot centre is the intensity centroid of the pixels above half the maximum.
+
+    Args:
+        frame (np.ndarray): Full-sensor frame (background subtracted or dark-free).
+        shape (tuple): (height, width) of the window.
+
+    Returns:
+        tuple: (top, left) of the window, clipped to the frame.
+    """
+    frame = np.asarray(frame, dtype=float)
+    weights = np.where(frame > 0.5 * frame.max(), frame, 0)
+    rows, cols = np.indices(frame.shape)
+    total = weights.sum()
+    if total > 0:
+        cy, cx = (rows * weights).sum() / total, (cols * weights).sum() / total
+    else:
+        cy, cx = (frame.shape[0] - 1) / 2, (frame.shape[1] - 1) / 2
+    top = int(round(cy - (shape[0] - 1) / 2))
+    left = int(round(cx - (shape[1] - 1) / 2))
+    top = min(max(top, 0), frame.shape[0] - shape[0])
+    left = min(max(left, 0), frame.shape[1] - shape[1])
+    return top, left
+
+
+def fringe_phase_error(mean, noise_var, n, carrier):
+    """
+    Expected phase error of a sine fit to an averaged interferogram.
+
+    The fringe amplitude A is estimated by projecting the (background-free) mean
+    onto the carrier. For N pixels with per-pixel noise s of the mean, a least
+    squares fit of A cos(carrier + phi) has std(phi) = s * sqrt(2 / N) / A.
+
+    Args:
+        mean (np.ndarray): Background-subtracted running mean.
+        noise_var (float): Single-frame pixel variance.
+        n (int): Number of averaged frames.
+        carrier (np.ndarray): exp(-1j * (kx * x + ky * y)) on the frame grid.
+
+    Returns:
+        float: Estimated phase error [rad].
+    """
+    n_pix = mean.size
+    amp = 2 * abs(np.vdot(np.conj(carrier).ravel(), mean.ravel())) / n_pix
+    if amp == 0:
+        return np.inf
+    return np.sqrt(noise_var / n) * np.sqrt(2 / n_pix) / amp
+
+
+class FrameAverager:
+    """
+    Running-mean accumulator for frames of a fixed shape.
+
+    Attributes:
+        shape (tuple): (height, width) of the incoming frames.
+        binning (int): Software binning applied to every frame.
+        out_shape (tuple): (height, width) of the averaged, binned frame.
+    """
+
+    def __init__(self, shape, binning=1):
+        self.shape = tuple(shape)
+        self.binning = int(binning)
+        self.out_shape = binned_shape(self.shape, self.binning)
+        self._mean = np.zeros(self.out_shape, dtype=np.float32)
+        self._delta = np.zeros(self.out_shape, dtype=np.float32)
+        self._m2 = None
+        self.n_frames = 0
+
+    def average(self, grab, num_frames, out=None, stop=None, min_frames=2):
+        """
+        Average up to num_frames frames from grab() into out.
+
+        With a stop criterion the per-pixel variance is tracked as well (Welford)
+        and averaging ends as soon as stop(mean, noise_var, n) returns True, where
+        noise_var is the mean single-frame pixel variance. The number of frames
+        used is kept in n_frames.
+
+        Args:
+            grab (callable): Returns the next frame (shape self.shape).
+            num_frames (int): Maximum number of frames to average.
+            out (np.ndarray): Caller-owned array of out_shape; a new float32 array if None.
+            stop (callable): Optional early-stopping criterion, see above.
+            min_frames (int): Frames taken before stop is first consulted.
+
+        Returns:
+            np.ndarray: The mean frame (out).
+        """
+        mean, delta = self._mean, self._delta
+        mean.fill(0)
+        if stop is not None:
+            if self._m2 is None:
+                self._m2 = np.zeros(self.out_shape, dtype=np.float32)
+            m2 = self._m2
+            m2.fill(0)
+        for n in range(1, num_frames + 1):
+            bin_frame(grab(), self.binning, out=delta)
+            delta -= mean
+            if stop is None:
+                delta /= n
+                mean += delta
+                continue
+            # Welford: m2 += (x - mean_old) * (x - mean_new)
+            m2 += delta * delta * ((n - 1) / n)
+            delta /= n
+            mean += delta
+            if n >= max(min_frames, 2) and stop(mean, float(m2.mean()) / (n - 1), n):
+                break
+        self.n_frames = n if num_frames > 0 else 0
+        if out is None:
+            return mean.copy()
+        np.copyto(out, mean, casting="unsafe")
+        return out
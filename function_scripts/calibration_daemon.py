@@ -0,0 +1,583 @@
+"""
+Resident calibration service keeping the instruments open across jobs.
+
+A one-shot run of main_phase_amplitude_retrieval.py loads the SLM DLL, parses
+its header, connects the SLM, initializes the camera and opens the shutter
+before doing any work. CalibrationDaemon does that once: DeviceSessions opens
+each device on first use and keeps it open, and jobs sent by clients over a
+local multiprocessing.connection socket (authenticated with an HMAC key, bound
+to localhost) are queued and executed one after the other by a worker thread
+against the warm devices. The PhaseAmplitudeRetriever is kept as well, so a
+measure job with use_correction=True continues the closed loop of the
+previous one.
+
+Jobs (see the @job handlers): measure (measure_slm_wavefront with keyword
+parameters), upload (a uint8 frame to the SLM), grab (a camera frame or an
+average), shutter and reset (close devices, reopened by the next job). status
+and shutdown are answered immediately. While a job runs the daemon streams
+events back to the client: ("queued", id, position), ("started", id, None),
+("stage", id, record) for the STREAM_STAGES of a measurement, and finally
+("result", id, payload) or ("error", id, message).
+
+Start it with (see main):
+    python -m function_scripts.calibration_daemon --data-path data [--simulated]
+
+and use it from Python:
+    with DaemonClient() as client:
+        run = client.measure(aperture_number=20, roi_n=12, on_event=print)
+
+Clients must present the daemon's key: the SLM_DAEMON_AUTHKEY environment
+variable if set, otherwise a random key generated on first use in KEY_FILE
+(~/.slm_daemon_key, readable by its owner only). Since the connection unpickles
+what clients send, the daemon refuses to listen on a non-loopback address
+unless a key was given explicitly.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import argparse
+import ipaddress
+import itertools
+import os
+import secrets
+import queue
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+DEFAULT_ADDRESS = ("127.0.0.1", 6543)
+AUTHKEY_ENV = "SLM_DAEMON_AUTHKEY"
+KEY_FILE = os.path.join(os.path.expanduser("~"), ".slm_daemon_key")
+
+# Profiler stages of a measurement streamed to the client as progress events
+STREAM_STAGES = ("background", "fit", "reconstruct", "zernike")
+
+# Requests answered by the connection thread instead of the job queue
+IMMEDIATE_OPS = ("status", "shutdown")
+
+JOB_HANDLERS = {}
+
+
+def job(op):
+    """Register a job handler handler(daemon, emit, **params) under op."""
+    def register(handler):
+        JOB_HANDLERS[op] = handler
+        return handler
+    return register
+
+
+def default_authkey():
+    """
+    The key from SLM_DAEMON_AUTHKEY, or else the per-user key in KEY_FILE.
+
+    The key file is created with 32 random bytes and mode 0600 on first use. The
+    key is written to a temporary file and linked into place, so a concurrent
+    reader never sees a partly written key; if another process wins the race,
+    its key is used.
+
+    Raises:
+        PermissionError: If the key file is readable by other users.
+        ValueError: If the key file is empty.
+    """
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode()
+    if not os.path.exists(KEY_FILE):
+        fd, tmp = tempfile.mkstemp(prefix=".slm_daemon_key", dir=os.path.dirname(KEY_FILE))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_hex(32).encode())
+            os.link(tmp, KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    if os.name == "posix" and os.stat(KEY_FILE).st_mode & 0o077:
+        raise PermissionError(f"{KEY_FILE} is accessible by other users; chmod 600 it")
+    with open(KEY_FILE, "rb") as f:
+        key = f.read().strip()
+    if not key:
+        raise ValueError(f"{KEY_FILE} is empty; delete it to generate a new key")
+    return key
+
+
+def is_local_address(address):
+    """True for loopback (host, port) addresses and for Unix sockets / named pipes."""
+    if isinstance(address, str):
+        return True
+    host = address[0]
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class DaemonJobError(RuntimeError):
+    """A job failed in the daemon; the message holds the remote traceback summary."""
+
+
+class DeviceSessions:
+    """
+    Devices opened on first use and kept open until close().
+
+    Attributes:
+        openers (dict): name -> opener(sessions) returning the connected device; an
+            opener may get other devices from sessions (the camera needs the SLM).
+        devices (dict): Open devices by name, in opening order.
+        open_times (dict): Time spent opening each device [s].
+        opened (dict): Number of times each device was opened.
+    """
+
+    def __init__(self, openers):
+        self.openers = dict(openers)
+        self.devices = {}
+        self.open_times = {}
+        self.opened = {name: 0 for name in self.openers}
+
+    def get(self, name):
+        """
+        The open device, opening it first if needed.
+
+        Raises:
+            KeyError: If there is no opener for name.
+        """
+        device = self.devices.get(name)
+        if device is None:
+            if name not in self.openers:
+                raise KeyError(f"No device {name!r}; known devices: {sorted(self.openers)}")
+            t0 = time.perf_counter()
+            device = self.openers[name](self)
+            self.open_times[name] = time.perf_counter() - t0
+            self.opened[name] += 1
+            self.devices[name] = device
+        return device
+
+    def close(self, names=None):
+        """Close open devices (all if names is None), in reverse opening order."""
+        for name in reversed(list(self.devices)):
+            if names is not None and name not in names:
+                continue
+            device = self.devices.pop(name)
+            close = getattr(device, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as exc:
+                    print(f"Closing {name} failed: {exc}")
+
+    def status(self):
+        """name -> {open, opened, open_time [s]} of every known device."""
+        return {name: {"open": name in self.devices, "opened": self.opened[name],
+                       "open_time": self.open_times.get(name)} for name in self.openers}
+
+
+def hardware_openers(settle_store=None, frame_slots=0, exposure=0.005):
+    """
+    Openers of the lab instruments, as set up in main_phase_amplitude_retrieval.py.
+
+    Drivers are imported when a device is opened, so the daemon starts without them.
+
+    Args:
+        settle_store (SettleStore): Calibrated SLM settle times, see SlmHamamatsu.
+        frame_slots (int): SLM frame-memory slots, see SlmHamamatsu.
+        exposure (float): Camera exposure [s].
+    """
+    def open_slm(sessions):
+        from slm.slm_hamamatsu import SlmHamamatsu
+        slm = SlmHamamatsu(settle_store=settle_store, frame_slots=frame_slots)
+        slm.connect()
+        return slm
+
+    def open_camera(sessions):
+        from orca.orca_camera import LiveHamamatsu
+        return LiveHamamatsu(exposure=exposure, initCam=True, came_numb=0, trig_mODe=1)
+
+    def open_shutter(sessions):
+        from peripheral_instruments.thorlabs_shutter import Shutter
+        return Shutter()
+
+    return {"slm": open_slm, "camera": open_camera, "shutter": open_shutter}
+
+
+def simulated_openers(slm_kwargs=None, **camera_kwargs):
+    """
+    Openers of the simulated bench (simulation/simulated_bench.py), for tests and dry runs.
+
+    Args:
+        slm_kwargs (dict): Arguments of SimulatedSlm.
+        **camera_kwargs: Arguments of SimulatedCamera (aberration, n_fft, roi_shape, ...).
+    """
+    from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+    return {
+        "slm": lambda sessions: SimulatedSlm(**(slm_kwargs or {})),
+        "shutter": lambda sessions: SimulatedShutter(),
+        "camera": lambda sessions: SimulatedCamera(sessions.get("slm"), sessions.get("shutter"), **camera_kwargs),
+    }
+
+
+class Job:
+    """
+    A queued request and the events it produced.
+
+    Attributes:
+        id (int): Job number, unique per daemon.
+        op (str): Handler name.
+        params (dict): Keyword parameters of the handler.
+        events (queue.Queue): (kind, id, payload) events, ending with "result" or "error".
+    """
+
+    def __init__(self, job_id, op, params):
+        self.id = job_id
+        self.op = op
+        self.params = params
+        self.events = queue.Queue()
+
+    def emit(self, kind, payload=None):
+        self.events.put((kind, self.id, payload))
+
+
+class CalibrationDaemon:
+    """
+    Job queue and socket server in front of warm device sessions.
+
+    Attributes:
+        sessions (DeviceSessions): The open devices.
+        retriever (PhaseAmplitudeRetriever): Kept across measure jobs.
+        address: Address the listener is bound to (set by start(); the actual
+            port when started on port 0).
+        completed (int): Jobs finished so far (including failed ones).
+    """
+
+    def __init__(self, openers, data_path, address=DEFAULT_ADDRESS, authkey=None, wavelength=752e-9,
+                 calibration_store=None):
+        """
+        Args:
+            openers (dict): Device openers, e.g. hardware_openers() or simulated_openers().
+            data_path (str): Folder of the measurement runs.
+            address: (host, port), a Unix socket path or, on Windows, a named pipe.
+            authkey (bytes): Shared key of the clients; default_authkey() if None.
+            wavelength (float): Laser wavelength [m] of the retriever.
+            calibration_store (CalibrationStore): Passed to the retriever.
+
+        Raises:
+            ValueError: If authkey is empty, or address is not local and no key was
+                set explicitly (authkey or SLM_DAEMON_AUTHKEY).
+        """
+        from function_scripts.slmphase import PhaseAmplitudeRetriever
+
+        if authkey is not None and not authkey:
+            raise ValueError("An empty authkey disables authentication")
+        if not is_local_address(address) and authkey is None and not os.environ.get(AUTHKEY_ENV):
+            raise ValueError(f"Refusing to listen on non-loopback address {address} without an explicit "
+                             f"key; set {AUTHKEY_ENV}")
+        self.sessions = DeviceSessions(openers)
+        self.retriever = PhaseAmplitudeRetriever(data_path, wavelength, calibration_store=calibration_store)
+        self.address = address
+        self.authkey = default_authkey() if authkey is None else authkey
+        self.completed = 0
+        self.current = None
+        self._jobs = queue.Queue()
+        self._ids = itertools.count(1)
+        self._listener = None
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Start the worker and the listener threads.
+
+        Returns:
+            The address the listener is bound to.
+        """
+        self._listener = Listener(self.address, authkey=self.authkey)
+        self.address = self._listener.address
+        self._stopped.clear()
+        self._threads = [threading.Thread(target=self._work, name="daemon-worker", daemon=True),
+                         threading.Thread(target=self._accept, name="daemon-listener", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self.address
+
+    def serve_forever(self):
+        """Run until stop() or a shutdown request; devices are closed on exit."""
+        if self._listener is None:
+            self.start()
+        try:
+            self._stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop accepting clients, finish the queued jobs and close the devices."""
+        self._stopped.set()
+        if self._listener is not None:
+            # Closing the socket does not interrupt a blocked accept(); a last connection does
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+        self._jobs.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        self.sessions.close()
+
+    def submit(self, op, **params):
+        """
+        Queue a job (also usable in-process, without a socket).
+
+        Returns:
+            Job: The queued job; read its events for progress and the result.
+
+        Raises:
+            ValueError: If op is not a registered job.
+        """
+        if op not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job {op!r}; known jobs: {sorted(JOB_HANDLERS)}")
+        new = Job(next(self._ids), op, params)
+        new.emit("queued", self._jobs.qsize() + (self.current is not None))
+        self._jobs.put(new)
+        return new
+
+    def status(self):
+        """Queue length, running job and device sessions."""
+        running = None if self.current is None else {"id": self.current.id, "op": self.current.op}
+        return {"queued": self._jobs.qsize(), "running": running, "completed": self.completed,
+                "devices": self.sessions.status()}
+
+    def _work(self):
+        while True:
+            current = self._jobs.get()
+            if current is None:
+                return
+            self.current = current
+            current.emit("started")
+            try:
+                result = JOB_HANDLERS[current.op](self, current.emit, **current.params)
+            except Exception as exc:
+                summary = "".join(traceback.format_exception_only(type(exc), exc)).strip()
+                current.emit("error", summary)
+            else:
+                current.emit("result", result)
+            finally:
+                self.current = None
+                self.completed += 1
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # A client that failed authentication or hung up during the handshake
+                if self._stopped.is_set():
+                    return
+                continue
+            if self._stopped.is_set():
+                conn.close()
+                return
+            threading.Thread(target=self._serve, args=(conn,), name="daemon-client", daemon=True).start()
+
+    def _serve(self, conn):
+        """Answer the requests of one client connection until it closes."""
+        with conn:
+            while True:
+                try:
+                    op, params = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if op == "status":
+                    conn.send(("result", None, self.status()))
+                    continue
+                if op == "shutdown":
+                    conn.send(("result", None, None))
+                    self._stopped.set()
+                    return
+                try:
+                    current = self.submit(op, **params)
+                except ValueError as exc:
+                    conn.send(("error", None, str(exc)))
+                    continue
+                while True:
+                    event = current.events.get()
+                    try:
+                        conn.send(event)
+                    except (OSError, ValueError):
+                        break  # client gone; the job still runs to completion
+                    if event[0] in ("result", "error"):
+                        break
+
+
+@job("measure")
+def _measure(daemon, emit, **params):
+    """measure_slm_wavefront on the warm devices; stage records stream as events."""
+    slm, cam, shutter = (daemon.sessions.get(name) for name in ("slm", "camera", "shutter"))
+    retriever = daemon.retriever
+
+    def forward(record):
+        if record["name"] in STREAM_STAGES:
+            emit("stage", record)
+
+    retriever.profiler.add_hook(forward)
+    try:
+        save_dir = retriever.measure_slm_wavefront(slm, cam, shutter, **params)
+        retriever.wait_for_results()
+    finally:
+        retriever.profiler.remove_hook(forward)
+    run = {name: np.load(os.path.join(save_dir, name + ".npy")) for name in ("dphi", "amplitude", "dphi_err")}
+    run.update(save_dir=save_dir, zernike=retriever.zernike, timing=retriever.profiler.summary())
+    return run
+
+
+@job("upload")
+def _upload(daemon, emit, frame):
+    """Show a uint8 frame on the SLM."""
+    slm = daemon.sessions.get("slm")
+    frame = np.ascontiguousarray(frame, dtype=np.uint8)
+    if frame.shape != tuple(slm.res):
+        raise ValueError(f"Frame shape {frame.shape} does not match the SLM {tuple(slm.res)}")
+    t0 = time.perf_counter()
+    slm.load_phase(frame)
+    return {"duration": time.perf_counter() - t0}
+
+
+@job("grab")
+def _grab(daemon, emit, num_frames=1):
+    """One camera frame, or the average of num_frames."""
+    cam = daemon.sessions.get("camera")
+    return cam.grab_frame() if num_frames == 1 else cam.take_average_image(num_frames)
+
+
+@job("shutter")
+def _shutter(daemon, emit, open=True):
+    """Open or close the shutter."""
+    daemon.sessions.get("shutter").shutter_enable(open)
+    return {"open": bool(open)}
+
+
+@job("reset")
+def _reset(daemon, emit, devices=None):
+    """Close devices (all if None); the next job that needs them reopens them."""
+    daemon.sessions.close(devices)
+    return daemon.sessions.status()
+
+
+class DaemonClient:
+    """
+    Connection to a CalibrationDaemon; one job at a time per client.
+
+    Open several clients to queue jobs from several threads or processes.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.conn = Client(address, authkey=default_authkey() if authkey is None else authkey)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.conn.close()
+
+    def stream(self, op, **params):
+        """
+        Send a request and yield its events until the final one.
+
+        Yields:
+            tuple: (kind, job id, payload) events, the last one "result" or "error".
+        """
+        self.conn.send((op, params))
+        while True:
+            event = self.conn.recv()
+            yield event
+            if event[0] in ("result", "error"):
+                return
+
+    def call(self, op, on_event=None, **params):
+        """
+        Run a request and return its result.
+
+        Args:
+            op (str): Job name.
+            on_event (callable): Called with every intermediate event.
+            **params: Job parameters.
+
+        Raises:
+            DaemonJobError: If the job failed.
+        """
+        for kind, _, payload in self.stream(op, **params):
+            if kind == "result":
+                return payload
+            if kind == "error":
+                raise DaemonJobError(payload)
+            if on_event is not None:
+                on_event((kind, _, payload))
+
+    def measure(self, on_event=None, **params):
+        """measure_slm_wavefront(**params); returns dphi, amplitude, dphi_err, save_dir, zernike, timing."""
+        return self.call("measure", on_event=on_event, **params)
+
+    def upload(self, frame):
+        """Show a uint8 frame on the SLM."""
+        return self.call("upload", frame=frame)
+
+    def grab(self, num_frames=1):
+        """A camera frame, or the average of num_frames."""
+        return self.call("grab", num_frames=num_frames)
+
+    def shutter(self, open=True):
+        return self.call("shutter", open=open)
+
+    def reset(self, devices=None):
+        return self.call("reset", devices=devices)
+
+    def status(self):
+        return self.call("status")
+
+    def shutdown(self):
+        """Ask the daemon to finish its queue, close the devices and exit."""
+        return self.call("shutdown")
+
+
+def _parse_address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resident SLM calibration daemon.")
+    parser.add_argument("--address", default="%s:%d" % DEFAULT_ADDRESS, help="host:port to listen on")
+    parser.add_argument("--data-path", default="data", help="folder of the measurement runs")
+    parser.add_argument("--simulated", action="store_true", help="use the simulated bench")
+    parser.add_argument("--frame-slots", type=int, default=0, help="SLM frame-memory slots")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_path, exist_ok=True)
+    openers = simulated_openers() if args.simulated else hardware_openers(frame_slots=args.frame_slots)
+    try:
+        daemon = CalibrationDaemon(openers, args.data_path, _parse_address(args.address))
+    except ValueError as exc:
+        parser.error(str(exc))
+    print(f"Calibration daemon listening on {daemon.start()}")
+    daemon.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,304 @@
+"""
+Indexed store of SLM calibrations: correction frames and modulation-depth LUTs.
+
+A calibration belongs to a device serial, a wavelength, a head temperature and
+a date. CalibrationStore keeps them in one folder: index.json lists the
+entries, and every correction frame and LUT is an uint8 .npy file next to it.
+The files are opened memory-mapped, so a lookup reads no pixel data until the
+frame is used, and switching lasers or wavelengths costs an in-memory index
+search instead of a BMP decode and renormalization.
+
+Correction frames are stored as uint8 phase with 256 = 2*pi (the resolution of
+the manufacturer BMPs); Calibration.fixed() shifts them into the uint16 fixed
+point of PhaseComposer. LUTs are 65536-entry phase -> grey level tables; an
+entry without one uses the linear table of its mod_depth.
+
+lookup() returns the entry closest in wavelength, then in temperature, then
+the newest. With interpolate=True the modulation depth and LUT are linearly
+interpolated between the calibrated wavelengths around the requested one (or
+the nearest calibration is used if there is none on one side); the
+correction frame is taken from the closer of the two, since wrapped phase maps
+cannot be blended. Opened calibrations, their fixed-point frames and recent
+lookups are cached in the process; open_store() shares one store per folder.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import json
+import os
+import re
+import time
+
+import numpy as np
+from PIL import Image
+
+from function_scripts.helpers import normalize
+from function_scripts.phase_compose import PHASE_ONE, mod_depth_lut
+from function_scripts.reporting import save_array
+
+LOOKUP_CACHE_SIZE = 256  # remembered lookup() queries per store
+
+_stores = {}
+
+
+def phase_to_frame(phase):
+    """
+    Quantize a phase in units of 2*pi (any range) to uint8 with 256 = 2*pi.
+
+    Args:
+        phase (np.ndarray): Phase in units of 2*pi.
+
+    Returns:
+        np.ndarray: Wrapped uint8 phase.
+    """
+    scaled = np.rint(np.asarray(phase) * 256).astype(np.int64)
+    return np.bitwise_and(scaled, 255).astype(np.uint8)
+
+
+class Calibration:
+    """
+    One calibration of a device, with memory-mapped frame and LUT.
+
+    Attributes:
+        id (str): Entry identifier in the store ("" for interpolated calibrations).
+        serial (str): Device serial number.
+        wavelength (float): Wavelength [nm].
+        temperature (float): Head temperature [degC].
+        date (str): Calibration date, "%Y-%m-%d %H:%M:%S".
+        mod_depth (int): Grey level of a 2*pi phase shift.
+        frame (np.ndarray): uint8 correction phase (256 = 2*pi), or None.
+        lut (np.ndarray): 65536-entry uint8 phase -> grey level table, or None for
+            the linear table of mod_depth.
+        info (dict): Further details recorded with the entry.
+    """
+
+    def __init__(self, entry, frame=None, lut=None):
+        self.id = entry.get("id", "")
+        self.serial = entry["serial"]
+        self.wavelength = entry["wavelength"]
+        self.temperature = entry["temperature"]
+        self.date = entry["date"]
+        self.mod_depth = entry["mod_depth"]
+        self.info = entry.get("info", {})
+        self.frame = frame
+        self.lut = lut
+        self._fixed = None
+
+    def __repr__(self):
+        return (f"Calibration({self.serial!r}, {self.wavelength:g} nm, {self.temperature:.1f} degC, "
+                f"{self.date!r}, mod_depth={self.mod_depth})")
+
+    def fixed(self):
+        """
+        Correction frame as a read-only uint16 fixed-point component, or None.
+
+        Converted on first use and cached with the calibration.
+        """
+        if self._fixed is None and self.frame is not None:
+            self._fixed = np.left_shift(self.frame, 8, dtype=np.uint16)
+            self._fixed.setflags(write=False)
+        return self._fixed
+
+    def phase(self):
+        """Correction frame in units of 2*pi, or None without a frame."""
+        return None if self.frame is None else self.frame / 256
+
+    def levels_lut(self):
+        """The LUT to compose frames with: the stored one or the linear table of mod_depth."""
+        return self.lut if self.lut is not None else mod_depth_lut(self.mod_depth)
+
+
+class CalibrationStore:
+    """
+    Folder of calibrations indexed by serial, wavelength, temperature and date.
+
+    Attributes:
+        root (str): Store folder; index.json and the .npy files live here.
+        entries (list): Index entries (dicts), sorted by serial, wavelength,
+            temperature and date.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = []
+        self._opened = {}  # id -> Calibration
+        self._lookups = {}  # query -> Calibration
+        path = os.path.join(root, "index.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)["entries"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, serial, wavelength, temperature, mod_depth, frame=None, lut=None, date=None, **info):
+        """
+        Record a calibration and rewrite the index atomically.
+
+        An entry with the same serial, wavelength, temperature and date is replaced.
+
+        Args:
+            serial (str): Device serial number.
+            wavelength (float): Wavelength [nm].
+            temperature (float): Head temperature [degC].
+            mod_depth (int): Grey level of a 2*pi phase shift.
+            frame (np.ndarray): Correction, as uint8 (256 = 2*pi) or as a phase in
+                units of 2*pi; None for a LUT-only calibration.
+            lut (np.ndarray): Measured 65536-entry uint8 LUT; None for the linear one.
+            date (str): "%Y-%m-%d %H:%M:%S"; now if None.
+            **info: Further JSON-serializable details (source file, run folder, ...).
+
+        Returns:
+            Calibration: The stored calibration.
+        """
+        date = time.strftime("%Y-%m-%d %H:%M:%S") if date is None else date
+        entry_id = re.sub(r"[^\w.-]", "_", f"{serial}_{wavelength:g}nm_{temperature:.1f}C_"
+                                         f"{date.replace('-', '').replace(':', '')}")
+        entry = {"id": entry_id, "serial": serial, "wavelength": float(wavelength),
+                 "temperature": float(temperature), "date": date, "mod_depth": int(mod_depth),
+                 "frame": None, "lut": None, "info": info}
+
+        os.makedirs(self.root, exist_ok=True)
+        if frame is not None:
+            frame = np.asarray(frame)
+            if frame.dtype != np.uint8:
+                frame = phase_to_frame(frame)
+            entry["frame"] = entry_id + "_frame.npy"
+            save_array(os.path.join(self.root, entry["frame"]), frame)
+        if lut is not None:
+            lut = np.asarray(lut)
+            if lut.shape != (PHASE_ONE,) or lut.dtype != np.uint8:
+                raise ValueError(f"LUT must be uint8 with {PHASE_ONE} entries, got {lut.dtype} {lut.shape}")
+            entry["lut"] = entry_id + "_lut.npy"
+            save_array(os.path.join(self.root, entry["lut"]), lut)
+
+        entries = [e for e in self.entries if e["id"] != entry_id] + [entry]
+        self.entries = sorted(entries, key=lambda e: (e["serial"], e["wavelength"], e["temperature"], e["date"]))
+        path = os.path.join(self.root, "index.json")
+        with open(path + ".part", "w") as f:
+            json.dump({"entries": self.entries}, f, indent=2)
+        os.replace(path + ".part", path)
+        self._opened.pop(entry_id, None)
+        self._lookups.clear()
+        return self.open(entry)
+
+    def add_bmp(self, path, serial, wavelength, temperature, mod_depth, date=None, **info):
+        """
+        Import a manufacturer correction BMP (e.g. CAL_LSH0803420_750nm.bmp).
+
+        The BMP is normalized like PhaseComposer.correction() and stored as uint8.
+
+        Returns:
+            Calibration: The stored calibration.
+        """
+        with Image.open(path) as img:
+            phase = normalize(np.asarray(img, dtype=np.uint16))
+        return self.add(serial, wavelength, temperature, mod_depth, frame=phase, date=date,
+                        source=os.path.basename(path), **info)
+
+    def add_measurement(self, run_dir, serial, wavelength, temperature, mod_depth, date=None, **info):
+        """
+        Import the correction_phase.npy of a measure_slm_wavefront run folder.
+
+        Returns:
+            Calibration: The stored calibration.
+        """
+        phase = np.load(os.path.join(run_dir, "correction_phase.npy"))
+        return self.add(serial, wavelength, temperature, mod_depth, frame=phase, date=date,
+                        source=os.path.basename(os.path.normpath(run_dir)), **info)
+
+    def open(self, entry):
+        """Calibration of an index entry, with its files memory-mapped (cached per id)."""
+        calibration = self._opened.get(entry["id"])
+        if calibration is None:
+            frame, lut = (None if entry[name] is None else
+                          np.load(os.path.join(self.root, entry[name]), mmap_mode="r")
+                          for name in ("frame", "lut"))
+            calibration = self._opened[entry["id"]] = Calibration(entry, frame, lut)
+        return calibration
+
+    def _candidates(self, serial, before):
+        return [e for e in self.entries if e["serial"] == serial and (before is None or e["date"] <= before)]
+
+    def _nearest(self, entries, wavelength, temperature):
+        # Newest first, so ties in wavelength and temperature go to the latest calibration
+        entries = sorted(entries, key=lambda e: e["date"], reverse=True)
+        return min(entries, key=lambda e: (abs(e["wavelength"] - wavelength),
+                                           0.0 if temperature is None else abs(e["temperature"] - temperature)))
+
+    def lookup(self, serial, wavelength, temperature=None, before=None, interpolate=False,
+               max_wavelength_delta=2.0, max_temp_delta=None):
+        """
+        Calibration of a device closest to a wavelength and temperature.
+
+        Args:
+            serial (str): Device serial number.
+            wavelength (float): Wavelength [nm].
+            temperature (float): Head temperature [degC]; None ignores temperatures.
+            before (str): Only use calibrations dated up to this "%Y-%m-%d %H:%M:%S".
+            interpolate (bool): Interpolate mod_depth and LUT between the calibrated
+                wavelengths around the requested one; without calibrations on both
+                sides the nearest one is returned.
+            max_wavelength_delta (float): Largest accepted wavelength difference [nm]
+                to the nearest calibration (to both neighbours when interpolating).
+            max_temp_delta (float): Largest accepted temperature difference [degC];
+                None accepts any.
+
+        Returns:
+            Calibration: The match, or None if no calibration is close enough.
+        """
+        query = (serial, wavelength, temperature, before, interpolate, max_wavelength_delta, max_temp_delta)
+        if query in self._lookups:
+            return self._lookups[query]
+
+        entries = self._candidates(serial, before)
+        if temperature is not None and max_temp_delta is not None:
+            entries = [e for e in entries if abs(e["temperature"] - temperature) <= max_temp_delta]
+        calibration = None
+        if entries:
+            best = self._nearest(entries, wavelength, temperature)
+            if interpolate and best["wavelength"] != wavelength:
+                calibration = self._interpolate(entries, wavelength, temperature, max_wavelength_delta)
+            if calibration is None and abs(best["wavelength"] - wavelength) <= max_wavelength_delta:
+                # No calibrations on both sides: the nearest one within the tolerance
+                calibration = self.open(best)
+        if len(self._lookups) >= LOOKUP_CACHE_SIZE:
+            self._lookups.clear()
+        self._lookups[query] = calibration
+        return calibration
+
+    def _interpolate(self, entries, wavelength, temperature, max_delta):
+        below = [e for e in entries if wavelength - max_delta <= e["wavelength"] < wavelength]
+        above = [e for e in entries if wavelength < e["wavelength"] <= wavelength + max_delta]
+        if not below or not above:
+            return None
+        lo = self.open(self._nearest(below, wavelength, temperature))
+        hi = self.open(self._nearest(above, wavelength, temperature))
+        t = (wavelength - lo.wavelength) / (hi.wavelength - lo.wavelength)
+        lut = None
+        if lo.lut is not None or hi.lut is not None:
+            blend = (1 - t) * lo.levels_lut() + t * hi.levels_lut()
+            lut = np.rint(blend).astype(np.uint8)
+        nearest = lo if t <= 0.5 else hi
+        entry = {"serial": lo.serial, "wavelength": wavelength,
+                 "temperature": (1 - t) * lo.temperature + t * hi.temperature,
+                 "date": max(lo.date, hi.date),
+                 "mod_depth": int(round((1 - t) * lo.mod_depth + t * hi.mod_depth)),
+                 "info": {"interpolated": [lo.id, hi.id], "frame": nearest.id}}
+        calibration = Calibration(entry, nearest.frame, lut)
+        calibration._fixed = nearest.fixed()
+        return calibration
+
+    def clear_cache(self):
+        """Forget opened calibrations and lookups (e.g. after editing files by hand)."""
+        self._opened.clear()
+        self._lookups.clear()
+
+
+def open_store(root):
+    """Shared CalibrationStore of a folder, so its caches live for the whole process."""
+    key = os.path.abspath(root)
+    store = _stores.get(key)
+    if store is None:
+        store = _stores[key] = CalibrationStore(root)
+    return store
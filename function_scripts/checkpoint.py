@@ -0,0 +1,115 @@
+"""
+Checkpoints of a running wavefront measurement.
+
+The measurement folder holds the scan geometry (scan.json), the interferograms
+(FrameStore in frames/) and the fit results so far (fit_checkpoint.npz, rewritten
+atomically after every fitted batch). Refinement levels of a coarse-to-fine scan
+have their own fit checkpoint (fit_checkpoint_L<level>.npz). A measurement that stops midway can be
+resumed from this state: patches already acquired are not exposed again and
+patches already fitted are not refitted. Once the results of the run are
+written, scan.json is marked complete and the run can no longer be resumed.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+
+GEOMETRY_FILE = "scan.json"
+FIT_FILE = "fit_checkpoint.npz"
+
+
+def _to_json(value):
+    """json.dump fallback for numpy scalars (e.g. np.int64 aperture counts) and arrays."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class ScanCheckpoint:
+    """
+    Scan geometry and fit progress stored in a measurement folder.
+
+    Attributes:
+        save_dir (str): Measurement folder.
+    """
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+
+    @staticmethod
+    def latest(data_path):
+        """
+        Most recent measurement folder under data_path.
+
+        Args:
+            data_path (str): Folder holding <timestamp>_wavefront runs.
+
+        Returns:
+            str: Path of the newest run with a scan.json, or None.
+        """
+        runs = sorted(glob.glob(os.path.join(data_path, "*_wavefront", GEOMETRY_FILE)))
+        return os.path.dirname(runs[-1]) if runs else None
+
+    def save_geometry(self, geometry):
+        """Write the scan settings (dict of JSON types; numpy scalars and arrays are converted)."""
+        with open(os.path.join(self.save_dir, GEOMETRY_FILE), "w") as f:
+            json.dump(geometry, f, indent=2, default=_to_json)
+
+    def load_geometry(self):
+        """Scan settings written by save_geometry, or None."""
+        path = os.path.join(self.save_dir, GEOMETRY_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def check_geometry(self, geometry, keys):
+        """
+        Raise if the stored scan differs from geometry in any of keys.
+
+        Raises:
+            ValueError: If there is no stored scan or a setting differs.
+        """
+        stored = self.load_geometry()
+        if stored is None:
+            raise ValueError(f"No {GEOMETRY_FILE} in {self.save_dir}; nothing to resume")
+        diff = [key for key in keys if stored.get(key) != geometry.get(key)]
+        if diff:
+            details = ", ".join(f"{key}: {stored.get(key)!r} != {geometry.get(key)!r}" for key in diff)
+            raise ValueError(f"Cannot resume {self.save_dir}, scan settings differ ({details})")
+        return stored
+
+    def mark_complete(self):
+        """Record in scan.json that the run finished and its results are written."""
+        geometry = self.load_geometry()
+        geometry["complete"] = True
+        self.save_geometry(geometry)
+
+    def is_complete(self):
+        """True if the run was marked complete."""
+        geometry = self.load_geometry()
+        return bool(geometry and geometry.get("complete"))
+
+    def _fit_path(self, level):
+        """Fit checkpoint file of a scan level."""
+        name = FIT_FILE if level == 0 else FIT_FILE.replace(".npz", f"_L{level}.npz")
+        return os.path.join(self.save_dir, name)
+
+    def save_fit(self, level=0, **arrays):
+        """Atomically replace the fit checkpoint of a scan level with the given arrays."""
+        path = self._fit_path(level)
+        with open(path + ".part", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".part", path)
+
+    def load_fit(self, level=0):
+        """Arrays of the last fit checkpoint of a scan level as a dict, or None."""
+        path = self._fit_path(level)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
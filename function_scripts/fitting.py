@@ -1,6 +1,23 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
+import scipy.fft as sfft
 import scipy.optimize as opt
 
+# Per-process state of refine_stack pool workers (see _init_refine_worker)
+_worker_state = {}
+
+
+def _grid_axes(x, y):
+    """1D axes of a camera grid (x varies along columns, y along rows)."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_axis = x.reshape(-1, x.shape[-1])[0] if x.ndim else x
+    y_axis = y[:, 0] if y.ndim == 2 else y.ravel()
+    return x_axis, y_axis
+
+
 class FitSine:
     """
     2D Sine fitter for interferogram analysis.
@@ -50,6 +67,284 @@ class FitSine:
         cos_term = np.cos(self.kx * x + self.ky * y + phi)
         return (a1 * a2 * cos_term).ravel()
 
+    def fit_stack(self, x, y, img_stack, dx, dy, chunk_size=32):
+        """
+        Fit every interferogram of a stack in one batched linear least-squares solve.
+
+        With the carrier (kx, ky) known from dx, dy, the cosine model is linear in
+        c = a*cos(phi) and s = a*sin(phi):
+            f(x, y) = c * cos(kx * x + ky * y) - s * sin(kx * x + ky * y)
+        so each patch reduces to a 2x2 normal-equation solve. Patches are processed
+        in chunks of `chunk_size` to bound the memory of the carrier arrays.
+
+        Args:
+            x (np.ndarray): X grid of the camera frame [m] (H x W), or its
+                broadcastable axis (1 x W) as returned by make_grid(sparse=True).
+            y (np.ndarray): Y grid of the camera frame [m] (H x W or H x 1).
+            img_stack (np.ndarray): Interferogram stack (H x W x N).
+            dx (np.ndarray): Patch X-offsets [m] (N).
+            dy (np.ndarray): Patch Y-offsets [m] (N).
+            chunk_size (int): Number of patches fitted per vectorized block.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+                phi (N), amplitude a1*a2 (N), covariance of (c, s) (N x 2 x 2)
+                and the propagated phase error dphi_err (N).
+        """
+        x_axis, y_axis = _grid_axes(x, y)
+        kx = self.k * np.asarray(dx, dtype=float).ravel() / self.fl
+        ky = self.k * np.asarray(dy, dtype=float).ravel() / self.fl
+        n_patch = kx.size
+        h, w = y_axis.size, x_axis.size
+        n_pix = h * w
+        data = np.reshape(img_stack, (h, w, n_patch))
+
+        coef = np.zeros((n_patch, 2))
+        pcov = np.zeros((n_patch, 2, 2))
+        for start in range(0, n_patch, chunk_size):
+            sl = slice(start, min(start + chunk_size, n_patch))
+            # The carrier is separable: cos(kx x + ky y) = Cy Cx - Sy Sx, so only
+            # the 1D axis terms are evaluated and the sums factor per axis.
+            tx = np.multiply.outer(kx[sl], x_axis)
+            ty = np.multiply.outer(ky[sl], y_axis)
+            cx, sx, cy, sy = np.cos(tx), np.sin(tx), np.cos(ty), np.sin(ty)
+            del tx, ty
+            d = np.moveaxis(np.asarray(data[..., sl], dtype=float), -1, 0)
+
+            cxx, sxx, csx = (np.einsum('nw,nw->n', a, b) for a, b in ((cx, cx), (sx, sx), (cx, sx)))
+            cyy, syy, csy = (np.einsum('nh,nh->n', a, b) for a, b in ((cy, cy), (sy, sy), (cy, sy)))
+            gram = np.empty((cx.shape[0], 2, 2))
+            gram[:, 0, 0] = cyy * cxx + syy * sxx - 2 * csy * csx
+            gram[:, 1, 1] = syy * cxx + cyy * sxx + 2 * csy * csx
+            gram[:, 0, 1] = gram[:, 1, 0] = -(csy * cxx + cyy * csx - syy * csx - csy * sxx)
+
+            # Project the frames on the y terms first (n x W), then on the x terms
+            dcy = np.matmul(cy[:, None, :], d)[:, 0]
+            dsy = np.matmul(sy[:, None, :], d)[:, 0]
+            rhs = np.stack((np.einsum('nw,nw->n', dcy, cx) - np.einsum('nw,nw->n', dsy, sx),
+                            -np.einsum('nw,nw->n', dsy, cx) - np.einsum('nw,nw->n', dcy, sx)), axis=-1)
+
+            # pinv keeps the zero-carrier patch (the reference itself) finite
+            gram_inv = np.linalg.pinv(gram)
+            beta = np.einsum('nij,nj->ni', gram_inv, rhs)
+            rss = np.einsum('nhw,nhw->n', d, d) - np.einsum('nk,nk->n', beta, rhs)
+            sigma2 = np.clip(rss, 0, None) / max(n_pix - 2, 1)
+
+            coef[sl] = beta
+            pcov[sl] = sigma2[:, None, None] * gram_inv
+
+        c, s = coef[:, 0], coef[:, 1]
+        phi = np.arctan2(s, c)
+        amp = np.hypot(c, s)
+        var_phi = s ** 2 * pcov[:, 0, 0] + c ** 2 * pcov[:, 1, 1] - 2 * c * s * pcov[:, 0, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dphi_err = np.sqrt(np.clip(var_phi, 0, None)) / amp ** 2
+        return phi, amp, pcov, dphi_err
+
+    def refine_stack(self, x_data, img_stack, dx, dy, phi, amp, workers=None):
+        """
+        Refine batched estimates with a per-patch nonlinear fit (safe_fit).
+
+        The linear solution seeds curve_fit, which then only needs a few iterations.
+        With workers > 1 the patches are split across a process pool. The image stack
+        is published once through shared memory instead of being pickled per task, and
+        results come back in patch order, identical to the serial path.
+
+        Args:
+            x_data (np.ndarray): Stacked X, Y grid vectors (2 x N_pix).
+            img_stack (np.ndarray): Interferogram stack (H x W x N).
+            dx (np.ndarray): Patch X-offsets [m] (N).
+            dy (np.ndarray): Patch Y-offsets [m] (N).
+            phi (np.ndarray): Initial phases (N).
+            amp (np.ndarray): Initial amplitudes a1*a2 (N).
+            workers (int): Number of worker processes; None or 1 fits serially.
+
+        Returns:
+            np.ndarray: Fit parameters [phi, a1, a2] per patch (N x 3).
+                Failed fits are returned as zeros, as in safe_fit.
+        """
+        n_patch = img_stack.shape[-1]
+        tasks = [(i, dx[i], dy[i], phi[i], amp[i]) for i in range(n_patch)]
+        if not workers or workers <= 1 or n_patch < 2:
+            return np.array([self._refine_patch(x_data, img_stack[..., t[0]], *t[1:]) for t in tasks])
+
+        img_stack = np.ascontiguousarray(img_stack)
+        shm = shared_memory.SharedMemory(create=True, size=max(img_stack.nbytes, 1))
+        try:
+            np.ndarray(img_stack.shape, dtype=img_stack.dtype, buffer=shm.buf)[...] = img_stack
+            init_args = (shm.name, img_stack.shape, img_stack.dtype.str, x_data, self.fl, self.k)
+            chunksize = max(1, n_patch // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_refine_worker,
+                                     initargs=init_args) as pool:
+                popt_sv = list(pool.map(_refine_worker_task, tasks, chunksize=chunksize))
+        finally:
+            shm.close()
+            shm.unlink()
+        return np.array(popt_sv)
+
+    def _refine_patch(self, x_data, img, dx, dy, phi, amp):
+        """Run safe_fit on one interferogram, seeded with the linear estimate."""
+        self.set_dx_dy(dx, dy)
+        a_guess = np.sqrt(np.max(img)) / 2
+        if not a_guess > 0:
+            print("Fit failed — returning zeros.")
+            return np.zeros(3)
+        lower, upper = [-np.pi, 0, 0], [np.pi, 2 * a_guess, 2 * a_guess]
+        a0 = np.sqrt(amp)
+        p0 = np.clip([phi, a0, a0], lower, upper)
+        popt, _ = safe_fit(self.fit_sine, x_data, img.ravel(), p0, (lower, upper))
+        return popt
+
+
+def _init_refine_worker(shm_name, shape, dtype, x_data, fl, k):
+    """Attach a pool worker to the shared image stack published by refine_stack."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state["shm"] = shm
+    _worker_state["img_stack"] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    _worker_state["x_data"] = x_data
+    _worker_state["fitter"] = FitSine(fl, k)
+
+
+def _refine_worker_task(task):
+    """Refine one patch inside a pool worker."""
+    i, dx, dy, phi, amp = task
+    img = _worker_state["img_stack"][..., i]
+    return _worker_state["fitter"]._refine_patch(_worker_state["x_data"], img, dx, dy, phi, amp)
+
+
+class FitFFT:
+    """
+    Fourier-transform fringe demodulation for interferogram analysis.
+
+    Alternative backend to FitSine with the same carrier model:
+        f(x, y) = a * cos(kx * x + ky * y + phi)
+
+    Each frame is transformed once with a batched fft2 over the whole stack. The
+    sideband around the expected carrier is isolated in a small window and matched
+    against the analytic spectrum of the carrier tone and of its conjugate, which
+    gives the complex peak (a/2) * exp(i * phi) without any iterations, also for
+    carriers that do not fall on an FFT bin or sit close to DC.
+
+    Attributes:
+        fl (float): Focal length [m].
+        k (float): Wavenumber [rad/m].
+        sideband_radius (int): Half-width of the sideband window [FFT bins].
+        workers (int): Number of threads used by scipy.fft.
+    """
+
+    def __init__(self, fl: float, k: float, sideband_radius: int = 2, workers: int = -1):
+        self.fl = fl
+        self.k = k
+        self.sideband_radius = sideband_radius
+        self.workers = workers
+        self.kx = None
+        self.ky = None
+
+    def set_dx_dy(self, dx: float, dy: float):
+        """
+        Sets fringe spatial frequency based on patch offset dx, dy.
+
+        Args:
+            dx (float): Patch X-offset [m].
+            dy (float): Patch Y-offset [m].
+        """
+        self.kx = self.k * dx / self.fl
+        self.ky = self.k * dy / self.fl
+
+    @staticmethod
+    def _dirichlet(delta, n):
+        """Spectrum of a unit tone of length n sampled delta bins off its centre."""
+        delta = np.asarray(delta, dtype=float)
+        num = np.sin(np.pi * delta)
+        den = np.sin(np.pi * delta / n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(np.abs(den) < 1e-12, n * np.cos(np.pi * delta) / np.cos(np.pi * delta / n), num / den)
+        return ratio * np.exp(-1j * np.pi * delta * (n - 1) / n)
+
+    def demodulate(self, x, y, img):
+        """
+        Demodulate a single interferogram at the carrier set by set_dx_dy.
+
+        Args:
+            x (np.ndarray): X grid of the camera frame [m] (H x W).
+            y (np.ndarray): Y grid of the camera frame [m] (H x W).
+            img (np.ndarray): Interferogram (H x W).
+
+        Returns:
+            Tuple[float, float]: Relative phase phi and amplitude a.
+        """
+        phi, amp, _, _ = self.fit_stack(x, y, img[..., None], [self.kx * self.fl / self.k],
+                                        [self.ky * self.fl / self.k])
+        return phi[0], amp[0]
+
+    def fit_stack(self, x, y, img_stack, dx, dy, chunk_size=32):
+        """
+        Demodulate every interferogram of a stack with one batched fft2 per chunk.
+
+        Args:
+            x (np.ndarray): X grid of the camera frame [m] (H x W).
+            y (np.ndarray): Y grid of the camera frame [m] (H x W).
+            img_stack (np.ndarray): Interferogram stack (H x W x N).
+            dx (np.ndarray): Patch X-offsets [m] (N).
+            dy (np.ndarray): Patch Y-offsets [m] (N).
+            chunk_size (int): Number of frames transformed per fft2 call.
+
+        Returns:
+            Tuple[np.ndarray, None, np.ndarray, np.ndarray]:
+                phi (N), amplitude a (N), no covariance (None) and dphi_err (N),
+                estimated from the residual power outside the fitted carrier.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        h, w, n_patch = img_stack.shape
+        step_x = x[0, 1] - x[0, 0]
+        step_y = y[1, 0] - y[0, 0]
+        kx = self.k * np.asarray(dx, dtype=float).ravel() / self.fl
+        ky = self.k * np.asarray(dy, dtype=float).ravel() / self.fl
+
+        # Carrier position in FFT bins and the sideband window around it
+        bin_x = kx * step_x * w / (2 * np.pi)
+        bin_y = ky * step_y * h / (2 * np.pi)
+        offsets = np.arange(-self.sideband_radius, self.sideband_radius + 1)
+        cols = np.rint(bin_x)[:, None] + offsets
+        rows = np.rint(bin_y)[:, None] + offsets
+        tone = (self._dirichlet(rows - bin_y[:, None], h)[:, :, None]
+                * self._dirichlet(cols - bin_x[:, None], w)[:, None, :])
+        conj_tone = (self._dirichlet(rows + bin_y[:, None], h)[:, :, None]
+                     * self._dirichlet(cols + bin_x[:, None], w)[:, None, :])
+        # Window spectrum = z * tone + conj(z) * conj_tone, linear in Re(z), Im(z)
+        basis = np.stack((tone + conj_tone, 1j * (tone - conj_tone)), axis=1)
+        gram_inv = np.linalg.pinv(np.real(np.einsum('nirc,njrc->nij', np.conj(basis), basis)))
+        rows = rows.astype(int) % h
+        cols = cols.astype(int) % w
+
+        peak = np.zeros(n_patch, dtype=complex)
+        power = np.zeros(n_patch)
+        for start in range(0, n_patch, chunk_size):
+            sl = slice(start, min(start + chunk_size, n_patch))
+            chunk = np.asarray(img_stack[..., sl])
+            spec = sfft.fft2(chunk, axes=(0, 1), workers=self.workers)
+            idx = np.arange(spec.shape[-1])
+            side = spec[rows[sl, :, None], cols[sl, None, :], idx[:, None, None]]
+            rhs = np.real(np.einsum('nirc,nrc->ni', np.conj(basis[sl]), side))
+            re_im = np.einsum('nij,nj->ni', gram_inv[sl], rhs)
+            peak[sl] = re_im[:, 0] + 1j * re_im[:, 1]
+            power[sl] = np.sum(np.square(chunk, dtype=float), axis=(0, 1))
+
+        # The tone index starts at the grid origin, so shift phi back to x = y = 0
+        phi = np.angle(peak * np.exp(-1j * (kx * x[0, 0] + ky * y[0, 0])))
+        amp = 2 * np.abs(peak)
+
+        # Residual power = frame power - energy of the fitted cosine over the frame
+        n_pix = h * w
+        cross = self._dirichlet(-2 * bin_x, w) * self._dirichlet(-2 * bin_y, h)
+        model_power = amp ** 2 / 2 * (n_pix + np.real(np.exp(2j * np.angle(peak)) * cross))
+        sigma2 = np.clip(power - model_power, 0, None) / max(n_pix - 2, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dphi_err = np.sqrt(2 * sigma2 / n_pix) / amp
+        return phi, amp, None, dphi_err
+
+
 def safe_fit(model_func, x_data, y_data, p0, bounds):
     """
     Wrapper for curve fitting with error handling.
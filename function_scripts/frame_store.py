@@ -0,0 +1,239 @@
+"""
+Chunked on-disk store for the interferograms of a wavefront measurement.
+
+Frames are written as they arrive into fixed-size chunk files
+(frames_0000.npy, frames_0001.npy, ...) that are memory-mapped, so only the
+chunk being written or read is paged in and memory stays flat however many
+patches are scanned. A sidecar index (index.npy) records the patch id, the
+patch offset dx/dy, the acquisition time and the number of averaged camera
+frames of every frame, and meta.json the frame shape, dtype and chunking. A
+store of multiplexed frames (patches_per_frame > 1) keeps the ids and offsets
+of every patch shown in a frame, padded with patch id -1; patches() lists them
+in the column order needed to refit the frames. The background frame is stored
+once and subtracted on read, so raw camera counts can be kept as uint16.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+def index_dtype(patches_per_frame=1):
+    """Index record of a frame; patch_id, dx and dy hold patches_per_frame entries if more than 1."""
+    shape = () if patches_per_frame == 1 else (patches_per_frame,)
+    return np.dtype([
+        ("patch_id", np.int64, shape),
+        ("dx", np.float64, shape),
+        ("dy", np.float64, shape),
+        ("timestamp", np.float64),
+        ("n_frames", np.int32),
+        ("written", np.bool_),
+    ])
+
+
+INDEX_DTYPE = index_dtype()
+
+
+class FrameStore:
+    """
+    Memory-mapped, chunked stack of camera frames with a sidecar index.
+
+    Attributes:
+        path (str): Folder holding the chunk files, index.npy and meta.json.
+        frame_shape (tuple): (height, width) of a frame.
+        n_frames (int): Capacity of the store.
+        dtype (np.dtype): Storage dtype of the frames.
+        chunk_frames (int): Frames per chunk file.
+        patches_per_frame (int): Largest number of patches shown in one frame.
+        index (np.ndarray): Structured array (index_dtype(patches_per_frame)), one record per frame.
+        background (np.ndarray): Frame subtracted on read, or None.
+    """
+
+    def __init__(self, path, frame_shape, n_frames, dtype=np.float32, chunk_frames=32,
+                 background=None, patches_per_frame=1, _create=True):
+        self.path = path
+        self.frame_shape = tuple(int(s) for s in frame_shape)
+        self.n_frames = int(n_frames)
+        self.dtype = np.dtype(dtype)
+        self.chunk_frames = int(chunk_frames)
+        self.patches_per_frame = int(patches_per_frame)
+        self._chunks = {}
+        self._stage = None  # float staging buffer for rounding into integer stores
+        self._lock = threading.Lock()  # the acquisition thread writes while the fit thread reads
+
+        if _create:
+            os.makedirs(path, exist_ok=True)
+            meta = {
+                "frame_shape": self.frame_shape,
+                "n_frames": self.n_frames,
+                "dtype": self.dtype.str,
+                "chunk_frames": self.chunk_frames,
+                "patches_per_frame": self.patches_per_frame,
+            }
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump(meta, f, indent=2)
+            self.index = np.lib.format.open_memmap(
+                os.path.join(path, "index.npy"), mode="w+", dtype=index_dtype(self.patches_per_frame),
+                shape=(self.n_frames,)
+            )
+            self.index["patch_id"] = -1
+            if background is not None:
+                np.save(os.path.join(path, "background.npy"), background)
+            self.background = background
+        else:
+            self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r+")
+            bckgr_path = os.path.join(path, "background.npy")
+            self.background = np.load(bckgr_path) if os.path.exists(bckgr_path) else None
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open an existing store, e.g. to refit the frames of a saved measurement.
+
+        Args:
+            path (str): Folder written by a previous FrameStore.
+
+        Returns:
+            FrameStore: The store, with its index and background loaded.
+        """
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        return cls(path, meta["frame_shape"], meta["n_frames"], meta["dtype"], meta["chunk_frames"],
+                   patches_per_frame=meta.get("patches_per_frame", 1), _create=False)
+
+    def __len__(self):
+        return self.n_frames
+
+    @property
+    def n_written(self):
+        """Number of frames written so far."""
+        return int(np.count_nonzero(self.index["written"]))
+
+    def _chunk(self, c):
+        """Memory map of chunk c, created on first use."""
+        chunk = self._chunks.get(c)
+        if chunk is not None:
+            return chunk
+        with self._lock:
+            chunk = self._chunks.get(c)
+            if chunk is not None:
+                return chunk
+            fname = os.path.join(self.path, f"frames_{c:04d}.npy")
+            if os.path.exists(fname):
+                chunk = np.load(fname, mmap_mode="r+")
+            else:
+                n = min(self.chunk_frames, self.n_frames - c * self.chunk_frames)
+                chunk = np.lib.format.open_memmap(fname, mode="w+", dtype=self.dtype,
+                                                  shape=(n,) + self.frame_shape)
+            self._chunks[c] = chunk
+            return chunk
+
+    def write(self, i, frame, patch_id=-1, dx=0.0, dy=0.0, n_frames=0):
+        """
+        Store frame i and its index record.
+
+        Args:
+            i (int): Frame slot, 0 <= i < n_frames.
+            frame (np.ndarray): Camera frame of shape frame_shape; float frames are
+                rounded (and clipped) into integer stores.
+            patch_id (int or array-like): Aperture index of the frame, or the indices of
+                all patches of a multiplexed frame (at most patches_per_frame).
+            dx (float or array-like): Patch offset from the reference patch along x [m].
+            dy (float or array-like): Patch offset from the reference patch along y [m].
+            n_frames (int): Number of camera frames averaged into frame.
+
+        Raises:
+            ValueError: If the frame shows more than patches_per_frame patches.
+        """
+        ids, dxs, dys = (np.ravel(v) for v in (patch_id, dx, dy))
+        if len(ids) > self.patches_per_frame:
+            raise ValueError(f"{len(ids)} patches in one frame, the store holds {self.patches_per_frame}")
+        c, j = divmod(int(i), self.chunk_frames)
+        frame = np.asarray(frame)
+        if self.dtype.kind in "iu" and frame.dtype.kind == "f":
+            # Averaged frames are rounded, not truncated, into integer stores
+            if self._stage is None:
+                self._stage = np.empty(self.frame_shape, dtype=frame.dtype)
+            info = np.iinfo(self.dtype)
+            frame = np.clip(np.rint(frame, out=self._stage), info.min, info.max, out=self._stage)
+        np.copyto(self._chunk(c)[j], frame, casting="unsafe")
+        self.index[i] = (self._pad(ids, -1), self._pad(dxs, 0.0), self._pad(dys, 0.0), time.time(), n_frames, True)
+
+    def _pad(self, values, fill):
+        if self.patches_per_frame == 1:
+            return values[0] if len(values) else fill
+        out = np.full(self.patches_per_frame, fill, dtype=values.dtype)
+        out[:len(values)] = values
+        return out
+
+    def patches(self, indices=None):
+        """
+        Patches shown in a set of frames, one entry per patch.
+
+        Args:
+            indices (array-like): Frame slots as passed to read(); all written frames if None.
+
+        Returns:
+            tuple: (columns, patch_id, dx, dy, n_frames) arrays; columns[n] is the position
+                of patch n's frame in read(indices), so read(indices)[..., columns] has one
+                column per patch for the fitters.
+        """
+        if indices is None:
+            indices = np.flatnonzero(self.index["written"])
+        records = self.index[np.asarray(indices, dtype=int)]
+        ids = records["patch_id"].reshape(len(records), -1)
+        columns, slot = np.nonzero(ids >= 0)
+        dx = records["dx"].reshape(len(records), -1)[columns, slot]
+        dy = records["dy"].reshape(len(records), -1)[columns, slot]
+        return columns, ids[columns, slot], dx, dy, records["n_frames"][columns]
+
+    def read(self, indices):
+        """
+        Read frames as a background-subtracted (H x W x N) float64 stack.
+
+        Args:
+            indices (array-like): Frame slots to read.
+
+        Returns:
+            np.ndarray: Frames stacked along the last axis, the layout used by the fitters.
+        """
+        indices = np.asarray(indices, dtype=int)
+        out = np.empty(self.frame_shape + (len(indices),))
+        for n, i in enumerate(indices):
+            c, j = divmod(int(i), self.chunk_frames)
+            out[..., n] = self._chunk(c)[j]
+        if self.background is not None:
+            out -= self.background[..., None]
+        return out
+
+    def iter_chunks(self, max_frames=None):
+        """
+        Iterate over the store in blocks of frames.
+
+        Args:
+            max_frames (int): Frames per block, defaults to chunk_frames.
+
+        Yields:
+            tuple: (indices, frames) with frames as returned by read().
+        """
+        step = max_frames or self.chunk_frames
+        for start in range(0, self.n_frames, step):
+            indices = np.arange(start, min(start + step, self.n_frames))
+            yield indices, self.read(indices)
+
+    def flush(self):
+        """Write pending changes of the memory maps to disk."""
+        for chunk in self._chunks.values():
+            chunk.flush()
+        self.index.flush()
+
+    def close(self):
+        """Flush and release the memory maps."""
+        self.flush()
+        self._chunks.clear()
+        self.index = np.asarray(self.index).copy()
@@ -2,6 +2,8 @@
 Utility functions for phase normalization, phase wrapping, and meshgrid creation.
 """
 
+from functools import lru_cache
+
 import numpy as np
 
 
@@ -32,41 +34,85 @@ def mod_1(arr):
     return np.mod(arr, 1)
 
 
-def make_grid(im, scale=None):
+# Bound of the coordinate grid caches (distinct shape / pitch / dtype combinations)
+GRID_CACHE_SIZE = 16
+
+
+def _read_only(*arrays):
+    for arr in arrays:
+        arr.flags.writeable = False
+    return arrays
+
+
+@lru_cache(maxsize=GRID_CACHE_SIZE)
+def _grid_axes(shape, scale, dtype):
+    h, w = shape
+    y_lim, x_lim = h // 2, w // 2
+    x = np.linspace(-x_lim * scale, x_lim * scale, w).astype(dtype)
+    y = np.linspace(-y_lim * scale, y_lim * scale, h).astype(dtype)
+    return _read_only(x, y)
+
+
+@lru_cache(maxsize=GRID_CACHE_SIZE)
+def _slm_axis(size, pitch, dtype):
+    return _read_only(np.arange(-size / 2, size / 2, pitch).astype(dtype))[0]
+
+
+def _as_grid(x, y, sparse):
+    """Broadcastable (1 x W), (H x 1) axes, or read-only H x W views of them."""
+    x, y = x[None, :], y[:, None]
+    if sparse:
+        return x, y
+    return tuple(np.broadcast_arrays(x, y))
+
+
+def make_grid(im, scale=None, dtype=np.float64, sparse=False):
     """
     Return a xy meshgrid based on the input array shape, ranging from
     -scale * width/2 to +scale * width/2.
 
+    Grids are memoized per (shape, scale, dtype) and returned read-only; the
+    dense grids are broadcast views of the cached axes, so no H x W array is
+    allocated. Copy the result before writing to it.
+
     Parameters:
         im (np.ndarray): Input image (2D).
         scale (float): Optional spatial scale factor [m/pixel].
+        dtype (np.dtype): Grid dtype, e.g. np.float32 for the fitters.
+        sparse (bool): Return broadcastable axes, x (1 x W) and y (H x 1).
 
     Returns:
         (x, y): np.ndarray meshgrids
     """
     if scale is None:
         scale = 1
-    h, w = im.shape
-    y_lim, x_lim = h // 2, w // 2
+    x, y = _grid_axes(tuple(np.shape(im)), float(scale), np.dtype(dtype).str)
+    return _as_grid(x, y, sparse)
 
-    x, y = np.linspace(-x_lim * scale, x_lim * scale, w), np.linspace(-y_lim * scale, y_lim * scale, h)
-    x, y = np.meshgrid(x, y)
-    return x, y
 
-
-def meshgrid_slm(slm_size, pitch):
+def meshgrid_slm(slm_size, pitch, dtype=np.float64, sparse=False):
     """
     Calculate X, Y meshgrid for SLM area using pixel pitch.
 
+    Memoized like make_grid; the arrays are read-only.
+
     Parameters:
         slm_size (tuple): Physical size (width, height) of the SLM in meters.
         pitch (float): Pixel pitch [m].
+        dtype (np.dtype): Grid dtype, e.g. np.float32 for the fitters.
+        sparse (bool): Return broadcastable axes instead of full grids.
 
     Returns:
         tuple: (X, Y) meshgrid arrays in meters.
     """
-    x = np.arange(-slm_size[0] / 2, slm_size[0] / 2, pitch)
-    return np.meshgrid(x, x)
+    x = _slm_axis(float(slm_size[0]), float(pitch), np.dtype(dtype).str)
+    return _as_grid(x, x, sparse)
+
+
+def clear_grid_cache():
+    """Drop all memoized coordinate grids."""
+    _grid_axes.cache_clear()
+    _slm_axis.cache_clear()
 
 
 def closest_arr(arr, K):
@@ -0,0 +1,236 @@
+"""
+Hologram generation with Gerchberg-Saxton and weighted Gerchberg-Saxton.
+
+HologramEngine finds the SLM phase whose far field (the focal plane of a lens,
+i.e. the 2D FFT of the SLM field) reproduces a target intensity. Gerchberg-
+Saxton (GS) alternates between the planes, keeping the phase and imposing the
+known amplitude: the source beam on the SLM, the target in the focal plane.
+Weighted GS (WGS, Di Leonardo et al., Opt. Express 15, 1913 (2007)) rescales
+the target amplitude every iteration by target / achieved, which equalizes
+spot arrays and flattens extended targets.
+
+The computation is done in preallocated complex64 buffers: the FFTs run in
+place (scipy.fft, overwrite_x, multi-threaded with workers) and the plane
+constraints are applied as in-place normalizations, so an iteration allocates
+no frame-sized arrays. A batch of targets is one (B, H, W) stack transformed
+with a single call per half-iteration. The FFT grid defaults to the SLM shape
+rounded up to fast FFT lengths (1272 -> 1280 columns); the SLM sits in its top
+left corner and the padding is held at zero amplitude.
+
+Targets are given on the FFT grid with the zero order in the centre. Helpers
+build LG donut (lg_target) and spot-array (spot_array_target) targets;
+vortex_phase is the analytic phase that turns a Gaussian beam into an LG donut.
+phase_gen.compute_hologram() adds a result to the composed SLM frames.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+from math import factorial
+
+import numpy as np
+import scipy.fft as sfft
+from scipy.special import eval_genlaguerre
+
+_TINY = np.float32(1e-20)  # floor of field magnitudes before normalizing
+
+
+def _centred_coords(shape, center=None):
+    """Row and column offsets from center (default: the FFT zero order, shape // 2)."""
+    h, w = shape
+    cy, cx = (h // 2, w // 2) if center is None else center
+    return np.arange(h)[:, None] - cy, np.arange(w)[None, :] - cx
+
+
+def vortex_phase(shape=(1024, 1272), charge=1, center=None):
+    """
+    Helical phase charge * theta of an LG_0^charge beam.
+
+    Args:
+        shape (tuple): (height, width) of the SLM.
+        charge (int): Topological charge l.
+        center (tuple): (row, col) of the vortex; the frame centre if None.
+
+    Returns:
+        np.ndarray: Phase in [0, 1) (units of 2*pi).
+    """
+    y, x = _centred_coords(shape, center)
+    return np.mod(charge * np.arctan2(y, x) / (2 * np.pi), 1)
+
+
+def lg_target(shape, l=1, p=0, waist=8.0, center=None):
+    """
+    Intensity of a Laguerre-Gauss mode LG_p^l (a donut for l != 0).
+
+    Args:
+        shape (tuple): (height, width) of the FFT grid.
+        l (int): Azimuthal index.
+        p (int): Radial index.
+        waist (float): Beam waist [pixels of the FFT grid].
+        center (tuple): (row, col) of the mode; the zero order if None.
+
+    Returns:
+        np.ndarray: Intensity normalized to a maximum of 1.
+    """
+    y, x = _centred_coords(shape, center)
+    rho = 2 * (x ** 2 + y ** 2) / waist ** 2
+    intensity = rho ** abs(l) * eval_genlaguerre(p, abs(l), rho) ** 2 * np.exp(-rho)
+    intensity *= factorial(p) / factorial(p + abs(l))
+    return intensity / intensity.max()
+
+
+def spot_array_target(shape, positions, weights=None):
+    """
+    Target of single-pixel spots.
+
+    Args:
+        shape (tuple): (height, width) of the FFT grid.
+        positions (array-like): (n, 2) spot offsets (row, col) from the zero order.
+        weights (array-like): Relative spot intensities; equal if None.
+
+    Returns:
+        np.ndarray: Intensity with the spots set to their weights.
+    """
+    positions = np.asarray(positions, dtype=int)
+    target = np.zeros(shape)
+    rows = positions[:, 0] + shape[0] // 2
+    cols = positions[:, 1] + shape[1] // 2
+    target[rows, cols] = 1.0 if weights is None else np.asarray(weights, dtype=float)
+    return target
+
+
+class HologramEngine:
+    """
+    GS / weighted-GS hologram computation with reused FFT buffers.
+
+    Attributes:
+        shape (tuple): (height, width) of the SLM.
+        fft_shape (tuple): FFT grid; targets are given on it.
+        workers (int): Threads used by scipy.fft (-1: all cores).
+        source (np.ndarray): Beam amplitude on the SLM.
+    """
+
+    def __init__(self, shape=(1024, 1272), fft_shape=None, source=None, workers=-1):
+        """
+        Args:
+            shape (tuple): (height, width) of the SLM.
+            fft_shape (tuple): FFT grid, at least shape; next fast FFT lengths if None.
+            source (np.ndarray): Beam amplitude on the SLM (e.g. a Gaussian); flat if None.
+            workers (int): Threads used by scipy.fft.
+        """
+        self.shape = tuple(shape)
+        if fft_shape is None:
+            fft_shape = tuple(sfft.next_fast_len(n) for n in self.shape)
+        self.fft_shape = tuple(fft_shape)
+        if any(f < s for f, s in zip(self.fft_shape, self.shape)):
+            raise ValueError(f"fft_shape {self.fft_shape} is smaller than the SLM shape {self.shape}")
+        self.workers = workers
+        self.source = np.ones(self.shape, dtype=np.float32) if source is None else np.asarray(source)
+        # Source amplitude on the FFT grid, zero on the padding
+        self._source = np.zeros(self.fft_shape, dtype=np.float32)
+        self._source[:self.shape[0], :self.shape[1]] = self.source
+        self._field = None
+        self._mag = None
+        self._weights = None
+        self._ratio = None
+
+    def _buffers(self, batch):
+        """complex64 field and float32 work buffers for a batch, reused while it does not change."""
+        if self._field is None or len(self._field) != batch:
+            full = (batch,) + self.fft_shape
+            self._field = np.empty(full, dtype=np.complex64)
+            self._mag = np.empty(full, dtype=np.float32)
+            self._weights = np.empty(full, dtype=np.float32)
+            self._ratio = np.empty(full, dtype=np.float32)
+        return self._field, self._mag, self._weights, self._ratio
+
+    def _inverse_magnitude(self, field, mag):
+        """mag = 1 / |field|, floored, so field * mag has unit magnitude."""
+        np.abs(field, out=mag)
+        np.maximum(mag, _TINY, out=mag)
+        np.reciprocal(mag, out=mag)
+
+    def compute(self, targets, n_iter=30, weighted=True, init_phase=None, seed=0):
+        """
+        Run GS or weighted GS for one target or a batch.
+
+        Args:
+            targets (np.ndarray): Target intensity on fft_shape, or a (B,) + fft_shape
+                stack; zero order in the centre.
+            n_iter (int): Number of iterations.
+            weighted (bool): Weighted GS instead of plain GS.
+            init_phase (np.ndarray): Start phase on the SLM (units of 2*pi); random if None.
+            seed (int): Seed of the random start phase.
+
+        Returns:
+            np.ndarray: float32 SLM phase in [0, 1), shape (H, W) or (B, H, W).
+
+        Raises:
+            ValueError: If the targets are not on fft_shape or are all zero.
+        """
+        targets = np.asarray(targets)
+        single = targets.ndim == 2
+        targets = targets[None] if single else targets
+        if targets.shape[1:] != self.fft_shape:
+            raise ValueError(f"Targets must be on the FFT grid {self.fft_shape}, got {targets.shape[1:]}")
+        if not np.all(targets.reshape(len(targets), -1).max(axis=1) > 0):
+            raise ValueError("Every target needs some nonzero intensity")
+        field, mag, weights, ratio = self._buffers(len(targets))
+        h, w = self.shape
+
+        # Target amplitude in FFT order, so no shifts are needed per iteration
+        amplitude = np.sqrt(sfft.ifftshift(targets, axes=(-2, -1))).astype(np.float32)
+        amp_sum = amplitude.sum(axis=(-2, -1))[:, None, None]
+        signal = amplitude > 0
+        np.copyto(weights, amplitude)
+
+        if init_phase is None:
+            init_phase = np.random.default_rng(seed).random((len(targets),) + self.shape)
+        field.fill(0)
+        field[:, :h, :w] = np.exp(2j * np.pi * np.asarray(init_phase, dtype=np.float32))
+        field *= self._source
+
+        # Complex * real products are several times faster than complex / real divisions,
+        # so both constraints are applied as field *= amplitude / |field|
+        for _ in range(n_iter):
+            far = sfft.fft2(field, axes=(-2, -1), overwrite_x=True, workers=self.workers)
+            if not np.may_share_memory(far, field):
+                np.copyto(field, far)
+            self._inverse_magnitude(field, mag)
+            if weighted:
+                # w <- w * target / achieved, with the achieved amplitude scaled to the target's
+                np.divide(signal, mag, out=ratio)
+                scale = ratio.sum(axis=(-2, -1))[:, None, None] / amp_sum
+                np.multiply(amplitude, mag, out=ratio)
+                ratio *= scale
+                np.multiply(weights, ratio, out=weights)
+                weights /= weights.max(axis=(-2, -1), keepdims=True)
+            np.multiply(weights, mag, out=ratio)
+            field *= ratio
+
+            near = sfft.ifft2(field, axes=(-2, -1), overwrite_x=True, workers=self.workers)
+            if not np.may_share_memory(near, field):
+                np.copyto(field, near)
+            self._inverse_magnitude(field, mag)
+            mag *= self._source
+            field *= mag
+
+        phase = np.angle(field[:, :h, :w]).astype(np.float32)
+        phase /= np.float32(2 * np.pi)
+        np.mod(phase, 1, out=phase)
+        return phase[0] if single else phase
+
+    def far_field(self, phase):
+        """
+        Focal-plane intensity of an SLM phase, zero order in the centre.
+
+        Args:
+            phase (np.ndarray): SLM phase (units of 2*pi), (H, W) or (B, H, W).
+
+        Returns:
+            np.ndarray: Intensity on fft_shape (per phase of a batch).
+        """
+        phase = np.asarray(phase)
+        field = np.zeros(phase.shape[:-2] + self.fft_shape, dtype=np.complex64)
+        field[..., :self.shape[0], :self.shape[1]] = self.source * np.exp(2j * np.pi * phase)
+        far = sfft.fft2(field, axes=(-2, -1), overwrite_x=True, workers=self.workers)
+        return sfft.fftshift(np.abs(far) ** 2, axes=(-2, -1))
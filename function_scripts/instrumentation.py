@@ -0,0 +1,229 @@
+"""
+Per-stage timing of a wavefront measurement.
+
+StageProfiler collects timed spans ("stages") from the measurement loop and the
+instrument drivers: frame composition, SLM upload and settle wait, camera
+exposure and readout, frame read-back with background subtraction, fitting,
+checkpointing and reconstruction. A span is a perf_counter pair around a block,
+so the cost is a few microseconds per stage; a disabled profiler hands out a
+shared no-op span.
+
+Spans opened inside another span on the same thread inherit its arguments, so
+the SLM's own upload / settle records carry the level and frame index of the
+retriever's "upload" span around them. From the records the profiler builds a
+summary per stage, per-frame records and a Chrome trace (chrome://tracing,
+https://ui.perfetto.dev). Hooks receive every record as it is taken, e.g. to
+feed an external metrics collector.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Stages of one acquired frame, in the order of the per-frame records
+FRAME_STAGES = ("upload", "slm.upload", "slm.settle", "exposure", "store_write")
+
+
+class _NullSpan:
+    """Span of a disabled profiler."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Times a with-block and records it on exit."""
+
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        if stack:
+            self.args = {**stack[-1], **self.args}
+        stack.append(self.args)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.profiler._stack().pop()
+        self.profiler._add(self.name, self.start, end - self.start, self.args)
+        return False
+
+
+class StageProfiler:
+    """
+    Timing records of named stages, with summary, per-frame view and trace export.
+
+    Records are dicts with name, start [s since the profiler's origin],
+    duration [s], thread (name) and args.
+
+    Attributes:
+        enabled (bool): If False, stage() and record() do nothing.
+        events (list): Records taken since the last reset().
+        hooks (list): Callables hook(record), called for every record.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self.hooks = []
+        self._local = threading.local()
+        self.origin = time.perf_counter()
+
+    def reset(self):
+        """Drop all records and restart the time origin."""
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def add_hook(self, hook):
+        """Register hook(record), called in the recording thread; keep it cheap."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Unregister a hook added with add_hook."""
+        self.hooks.remove(hook)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, name, start, duration, args):
+        event = {"name": name, "start": start - self.origin, "duration": duration,
+                 "thread": threading.current_thread().name, "args": args}
+        self.events.append(event)
+        for hook in self.hooks:
+            hook(event)
+
+    def stage(self, name, **args):
+        """
+        Context manager timing a block as stage `name`.
+
+        Args:
+            name (str): Stage name.
+            **args: JSON-serializable details, e.g. frame=3, level=0.
+
+        Returns:
+            Context manager.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name, start, duration, **args):
+        """
+        Add a span measured elsewhere, e.g. by a driver with its own timer.
+
+        Args:
+            name (str): Stage name.
+            start (float): time.perf_counter() at the start of the span [s].
+            duration (float): Span length [s].
+            **args: Details; the arguments of an enclosing stage are added.
+        """
+        if not self.enabled:
+            return
+        stack = self._stack()
+        self._add(name, start, duration, {**stack[-1], **args} if stack else args)
+
+    def summary(self):
+        """
+        Statistics per stage, in order of first appearance.
+
+        Returns:
+            dict: name -> {count, total, mean, p50, p90, max} [s].
+        """
+        durations = {}
+        for event in self.events:
+            durations.setdefault(event["name"], []).append(event["duration"])
+        summary = {}
+        for name, values in durations.items():
+            values = np.asarray(values)
+            p50, p90 = np.percentile(values, [50, 90])
+            summary[name] = {"count": int(values.size), "total": float(values.sum()),
+                             "mean": float(values.mean()), "p50": float(p50), "p90": float(p90),
+                             "max": float(values.max())}
+        return summary
+
+    def table(self):
+        """Summary as a text table with the share of the wall time per stage."""
+        summary = self.summary()
+        wall = max((e["start"] + e["duration"] for e in self.events), default=0.0)
+        lines = [f"{'stage':<20}{'count':>7}{'total [s]':>11}{'mean [ms]':>11}"
+                 f"{'p50 [ms]':>10}{'p90 [ms]':>10}{'max [ms]':>10}{'% wall':>8}"]
+        for name, s in summary.items():
+            share = 100 * s["total"] / wall if wall > 0 else 0.0
+            lines.append(f"{name:<20}{s['count']:>7}{s['total']:>11.3f}{1e3 * s['mean']:>11.2f}"
+                         f"{1e3 * s['p50']:>10.2f}{1e3 * s['p90']:>10.2f}{1e3 * s['max']:>10.2f}{share:>8.1f}")
+        lines.append(f"{'wall':<20}{'':>7}{wall:>11.3f}")
+        return "\n".join(lines)
+
+    def frame_records(self):
+        """
+        Durations of the FRAME_STAGES per acquired frame.
+
+        Returns:
+            list: One dict per (level, frame), with level, frame, patches and
+                one duration [s] per stage found, sorted by level and frame.
+        """
+        records = {}
+        for event in self.events:
+            args = event["args"]
+            if event["name"] not in FRAME_STAGES or "frame" not in args:
+                continue
+            key = (args.get("level", 0), args["frame"])
+            record = records.setdefault(key, {"level": key[0], "frame": key[1],
+                                              "patches": args.get("patches", [])})
+            record[event["name"]] = record.get(event["name"], 0.0) + event["duration"]
+        return [records[key] for key in sorted(records)]
+
+    def chrome_trace(self):
+        """
+        Records in the Chrome trace event format (complete "X" events in µs).
+
+        Returns:
+            dict: Trace with the summary and frame records under "otherData".
+        """
+        threads = {}
+        trace = []
+        for event in self.events:
+            tid = threads.setdefault(event["thread"], len(threads))
+            trace.append({"name": event["name"], "ph": "X", "pid": os.getpid(), "tid": tid,
+                          "ts": 1e6 * event["start"], "dur": 1e6 * event["duration"],
+                          "args": event["args"]})
+        trace += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                   "args": {"name": name}} for name, tid in threads.items()]
+        return {"traceEvents": trace, "displayTimeUnit": "ms",
+                "otherData": {"summary": self.summary(), "frames": self.frame_records()}}
+
+
+def save_trace(path, trace):
+    """Write a trace from StageProfiler.chrome_trace() as JSON."""
+    with open(path, "w") as f:
+        json.dump(trace, f, default=_to_builtin)
+
+
+def _to_builtin(obj):
+    """JSON fallback for numpy scalars and arrays in record arguments."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
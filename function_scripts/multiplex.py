@@ -0,0 +1,92 @@
+"""
+Frequency-multiplexed patch acquisition.
+
+The fringes of a patch interfering with the reference patch sit on a carrier
+set by the offset between the two apertures (k * dx / fl). Several patches can
+therefore be displayed in one SLM frame and demodulated from one camera frame,
+as long as their spectral components do not overlap. For the patches p_i of a
+frame and the reference r, the camera frame holds
+    DC (all self terms), +-(p_i - r) (the measured sidebands) and
+    +-(p_i - p_j) (cross terms between displayed patches),
+each spread over the cross-correlation of two apertures, i.e. +-width around
+its centre along x and y. plan_groups() packs the scanned apertures greedily
+into frames of up to k patches whose components are all at least
+2 * width apart (Chebyshev distance) and whose cross terms stay within the
+offset range already resolved by the camera, so nothing aliases onto a sideband.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import numpy as np
+
+
+def components(offsets):
+    """
+    Spectral component centres of a frame showing patches at the given offsets.
+
+    Args:
+        offsets (np.ndarray): (n, 2) patch offsets from the reference [px].
+
+    Returns:
+        np.ndarray: (m, 2) centres: DC, +-sidebands and +-cross terms [px].
+    """
+    offsets = np.asarray(offsets, dtype=float).reshape(-1, 2)
+    cross = (offsets[:, None, :] - offsets[None, :, :])[~np.eye(len(offsets), dtype=bool)]
+    return np.concatenate((np.zeros((1, 2)), offsets, -offsets, cross))
+
+
+def separable(offsets, min_sep, max_offset=None):
+    """
+    True if patches at the given offsets can be demodulated from one frame.
+
+    Args:
+        offsets (np.ndarray): (n, 2) patch offsets from the reference [px].
+        min_sep (float): Minimum Chebyshev distance between components [px].
+        max_offset (np.ndarray): Largest |offset| per axis the camera resolves [px];
+            cross terms beyond it are rejected. None skips the check.
+
+    Returns:
+        bool: Whether all components are separated.
+    """
+    offsets = np.asarray(offsets, dtype=float).reshape(-1, 2)
+    if len(offsets) < 2:
+        return True
+    comps = components(offsets)
+    if max_offset is not None and np.any(np.abs(comps) > np.asarray(max_offset) + 1e-9):
+        return False
+    dist = np.max(np.abs(comps[:, None, :] - comps[None, :, :]), axis=-1)
+    np.fill_diagonal(dist, np.inf)
+    return bool(dist.min() >= min_sep)
+
+
+def plan_groups(offsets, k, width, max_offset=None):
+    """
+    Pack patches into frames of up to k separable patches (first fit).
+
+    Patches too close to the reference to share a frame get a frame of their own.
+
+    Args:
+        offsets (np.ndarray): (n, 2) patch offsets (y, x) from the reference [px].
+        k (int): Maximum number of patches per frame.
+        width (float): Aperture width [px]; components must be 2 * width apart.
+        max_offset (np.ndarray): Per-axis limit for cross terms [px]; defaults to
+            the largest |offset| of the scan.
+
+    Returns:
+        np.ndarray: (n_frames, k) patch indices per frame, padded with -1.
+    """
+    offsets = np.asarray(offsets, dtype=float).reshape(-1, 2)
+    if max_offset is None:
+        max_offset = np.abs(offsets).max(axis=0) if len(offsets) else np.zeros(2)
+    groups = []
+    for i in range(len(offsets)):
+        for group in groups:
+            if len(group) < k and separable(offsets[group + [i]], 2 * width, max_offset):
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+    plan = np.full((len(groups), max(k, 1)), -1, dtype=int)
+    for row, group in zip(plan, groups):
+        row[:len(group)] = group
+    return plan
@@ -0,0 +1,167 @@
+"""
+Precomputed SLM frame sequences for aperture (patch) scans.
+
+A wavefront measurement displays the same set of frames every time: the
+reference aperture and one scanned aperture showing the grating, on top of the
+static correction components. PatchSequence converts the static background and
+every aperture to grey levels once; frame i is then a copy of the background
+with the aperture patches pasted in, composed when it is requested, so memory
+does not grow with the number of frames. Sequences are keyed by a hash of the
+scan geometry and the phase components; with a cache folder all frames are
+composed once into a uint8 stack (n_frames, height, width) stored as a .npy
+file and memory-mapped, so repeat scans reuse them without recomposing.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import hashlib
+import os
+import weakref
+
+import numpy as np
+
+from function_scripts.phase_compose import to_fixed
+
+# Weak reference to the last sequence built in this process, reused while it is alive
+_last_sequence = None
+
+
+def aperture_bounds(n_ap_x, n_ap_y, x_min, y_min, dx, dy):
+    """
+    Pixel bounds of a grid of apertures, row by row.
+
+    Args:
+        n_ap_x (int): Number of apertures along x (columns).
+        n_ap_y (int): Number of apertures along y (rows).
+        x_min (float): Left edge of the first aperture [px].
+        y_min (float): Top edge of the first aperture [px].
+        dx (int): Aperture width [px].
+        dy (int): Aperture height [px].
+
+    Returns:
+        tuple: (top, bottom, left, right) integer arrays of length n_ap_x * n_ap_y.
+    """
+    start_x = (x_min + np.arange(n_ap_x) * dx).astype(int)
+    start_y = (y_min + np.arange(n_ap_y) * dy).astype(int)
+    top, left = np.meshgrid(start_y, start_x, indexing="ij")
+    top, left = top.ravel(), left.ravel()
+    return top, top + dy, left, left + dx
+
+
+def _scan_key(shape, bounds, centre, indices, grating, static, lut):
+    """SHA-1 of everything that determines the frames of a scan."""
+    h = hashlib.sha1()
+    h.update(repr((tuple(shape), int(centre), np.shape(indices))).encode())
+    h.update(np.ascontiguousarray(lut).tobytes())
+    for arr in (*bounds, indices):
+        h.update(np.ascontiguousarray(arr, dtype=np.int64).tobytes())
+    for comp in (grating, *static):
+        h.update(np.ascontiguousarray(comp).tobytes())
+    return h.hexdigest()
+
+
+class PatchSequence:
+    """
+    uint8 frames of an aperture scan.
+
+    Frame i shows the grating inside the reference aperture and inside aperture
+    indices[i] (or inside every aperture of the row indices[i], for frames that
+    show several patches at once), and the static components everywhere.
+
+    Attributes:
+        frames (np.ndarray): (n_frames, height, width) memory-mapped uint8 stack, or
+            None if frames are composed on access.
+        key (str): Hash of the scan geometry and components.
+        path (str): .npy file backing the stack, or None.
+    """
+
+    def __init__(self, frames, key, path=None, background=None, levels=None, rows=None, centre=None):
+        self.frames = frames
+        self.key = key
+        self.path = path
+        # Grey levels of the background and of each aperture, for frames composed on access
+        self._background = background
+        self._levels = levels
+        self._rows = rows
+        self._centre = centre
+
+    def __len__(self):
+        return len(self.frames) if self.frames is not None else len(self._rows)
+
+    def __getitem__(self, i):
+        if self.frames is not None:
+            return self.frames[i]
+        return self._compose(i, np.empty_like(self._background))
+
+    def _compose(self, i, out):
+        """Frame i written into out: the background with the patches of the frame pasted in."""
+        out[...] = self._background
+        row = self._rows[i]
+        for idx in (self._centre, *row[row >= 0]):
+            region, patch = self._levels[idx]
+            out[region] = patch
+        return out
+
+    @classmethod
+    def build(cls, composer, grating, bounds, centre, indices, static=(), cache_dir=None):
+        """
+        Compose (or reuse) the frame stack of a scan.
+
+        Args:
+            composer (PhaseComposer): Supplies the grey-level lookup table.
+            grating (np.ndarray): Measurement grating in units of 2*pi.
+            bounds (tuple): (top, bottom, left, right) arrays, see aperture_bounds.
+            centre (int): Index of the reference aperture.
+            indices (np.ndarray): Aperture index shown in each frame (n_frames,), or
+                (n_frames, k) indices of the apertures shown together, padded with -1.
+            static (list): uint16 components displayed everywhere (corrections).
+            cache_dir (str): Folder for memory-mapped stacks; None composes frames on access.
+
+        Returns:
+            PatchSequence: The frame sequence.
+        """
+        global _last_sequence
+        shape = composer.shape
+        grating = to_fixed(grating)
+        indices = np.asarray(indices, dtype=int)
+        top, bot, left, right = (np.asarray(b, dtype=int) for b in bounds)
+        key = _scan_key(shape, (top, bot, left, right), centre, indices, grating, static, composer.lut)
+
+        last = _last_sequence() if _last_sequence is not None else None
+        if last is not None and last.key == key:
+            return last
+
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, f"patch_frames_{key[:16]}.npy")
+            if os.path.exists(path):
+                sequence = cls(np.load(path, mmap_mode="r"), key, path)
+                _last_sequence = weakref.ref(sequence)
+                return sequence
+
+        base = np.zeros(shape, dtype=np.uint16)
+        for comp in static:
+            np.add(base, comp, out=base)
+        background = np.array(composer.levels(base))
+
+        # Grey levels of every aperture that appears in the scan, computed once
+        levels = {}
+        for idx in np.unique(np.append(indices[indices >= 0], centre)):
+            region = np.s_[top[idx]:bot[idx], left[idx]:right[idx]]
+            levels[idx] = (region, np.array(composer.levels(base[region] + grating[region])))
+
+        sequence = cls(None, key, background=background, levels=levels,
+                       rows=indices.reshape(len(indices), -1), centre=centre)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = path + ".part"
+            frames = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                               shape=(len(indices),) + tuple(shape))
+            for i in range(len(indices)):
+                sequence._compose(i, frames[i])
+            frames.flush()
+            del frames
+            os.replace(tmp_path, path)
+            sequence = cls(np.load(path, mmap_mode="r"), key, path)
+        _last_sequence = weakref.ref(sequence)
+        return sequence
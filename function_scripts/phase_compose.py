@@ -0,0 +1,197 @@
+"""
+Cached, fixed-point composition of SLM phase frames.
+
+Phase components are stored as uint16 fixed point, where 65536 corresponds to
+2*pi. Summing components in uint16 therefore wraps modulo 2*pi for free, which
+replaces mod_1() on float64 frames. A 65536-entry lookup table then maps the
+wrapped phase to the uint8 grey level for the current modulation depth.
+Components are memoized: gratings by key (e.g. period), correction BMPs by path,
+reloaded only when the file's modification time changes.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from function_scripts.helpers import normalize
+
+PHASE_ONE = 1 << 16  # fixed-point value of a full 2*pi wave
+
+
+def to_fixed(phase, out=None):
+    """
+    Convert a phase in units of 2*pi (any range) to uint16 fixed point, wrapped mod 1.
+
+    Args:
+        phase (np.ndarray): Phase in units of 2*pi.
+        out (np.ndarray): Optional uint16 array to write into.
+
+    Returns:
+        np.ndarray: Wrapped fixed-point phase (uint16).
+    """
+    scaled = np.rint(np.asarray(phase) * PHASE_ONE).astype(np.int64)
+    if out is None:
+        return np.bitwise_and(scaled, PHASE_ONE - 1).astype(np.uint16)
+    np.bitwise_and(scaled, PHASE_ONE - 1, out=scaled)
+    np.copyto(out, scaled, casting='unsafe')
+    return out
+
+
+def mod_depth_lut(mod_depth):
+    """
+    Linear lookup table from uint16 fixed-point phase to uint8 grey levels.
+
+    Args:
+        mod_depth (int): Grey level of a 2*pi phase shift.
+
+    Returns:
+        np.ndarray: 65536-entry uint8 table.
+    """
+    # Evaluate each fixed-point value at the centre of its bin so phases that
+    # sit exactly on a grey-level boundary are not rounded down
+    levels = ((2 * np.arange(PHASE_ONE, dtype=np.int64) + 1) * int(mod_depth)) >> 17
+    return levels.astype(np.uint8)
+
+
+class PhaseComposer:
+    """
+    Compose SLM frames from cached fixed-point phase components.
+
+    Attributes:
+        mod_depth (int): Grey level of a 2*pi phase shift; setting it rebuilds the LUT.
+        lut (np.ndarray): Current 65536-entry phase -> grey level table (read-only view).
+        shape (tuple): (height, width) of the composed frames.
+    """
+
+    def __init__(self, mod_depth=198, shape=(1024, 1272)):
+        self.shape = tuple(shape)
+        self._components = {}
+        self._corrections = {}
+        self._acc = np.zeros(self.shape, dtype=np.uint16)
+        self._out = np.zeros(self.shape, dtype=np.uint8)
+        self._mod_depth = None
+        self._lut = None
+        self.mod_depth = mod_depth
+
+    @property
+    def mod_depth(self):
+        return self._mod_depth
+
+    @mod_depth.setter
+    def mod_depth(self, value):
+        if value != self._mod_depth:
+            self._lut = mod_depth_lut(value)
+            self._mod_depth = value
+
+    @property
+    def lut(self):
+        return self._lut
+
+    def set_lut(self, lut, mod_depth):
+        """
+        Use a measured (e.g. nonlinear) lookup table instead of the linear one.
+
+        The table is kept until mod_depth is set to a different value.
+
+        Args:
+            lut (np.ndarray): 65536-entry uint8 table indexed by fixed-point phase.
+            mod_depth (int): Grey level of a 2*pi phase shift the table belongs to.
+        """
+        if lut is self._lut:
+            return
+        lut = np.asanyarray(lut)
+        if lut.shape != (PHASE_ONE,) or lut.dtype != np.uint8:
+            raise ValueError(f"LUT must be uint8 with {PHASE_ONE} entries, got {lut.dtype} {lut.shape}")
+        self._lut = lut
+        self._mod_depth = mod_depth
+
+    def component(self, key, factory):
+        """
+        Return a memoized fixed-point component, building it with factory() once.
+
+        Args:
+            key (hashable): Cache key, e.g. ("grating", period).
+            factory (callable): Returns the component as a phase in units of 2*pi.
+
+        Returns:
+            np.ndarray: Read-only uint16 component.
+        """
+        comp = self._components.get(key)
+        if comp is None:
+            comp = to_fixed(factory())
+            comp.setflags(write=False)
+            self._components[key] = comp
+        return comp
+
+    def correction(self, path):
+        """
+        Return the normalized correction BMP at path as a fixed-point component.
+
+        The file is decoded once and reloaded only when its mtime changes.
+
+        Args:
+            path (str): Path of the correction .bmp file.
+
+        Returns:
+            np.ndarray: Read-only uint16 component, or None if the file does not exist.
+        """
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self._corrections.pop(path, None)
+            return None
+
+        cached = self._corrections.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with Image.open(path) as img:
+            correction = normalize(np.asarray(img, dtype=np.uint16))
+        comp = to_fixed(correction)
+        comp.setflags(write=False)
+        self._corrections[path] = (mtime, comp)
+        return comp
+
+    def clear(self):
+        """Drop all cached components."""
+        self._components.clear()
+        self._corrections.clear()
+
+    def levels(self, fixed, out=None):
+        """
+        Map wrapped fixed-point phase to grey levels with the mod_depth lookup table.
+
+        Args:
+            fixed (np.ndarray): uint16 phase.
+            out (np.ndarray): Optional uint8 array of the same shape to write into.
+
+        Returns:
+            np.ndarray: Grey levels (uint8).
+        """
+        return np.take(self._lut, fixed, out=out)
+
+    def compose(self, components, out=None):
+        """
+        Sum fixed-point components (wrapping mod 2*pi) and map them to grey levels.
+
+        Args:
+            components (list): uint16 components; None entries are skipped.
+            out (np.ndarray): Optional uint8 frame to write into. Defaults to the
+                composer's own buffer, which the next compose() call overwrites.
+
+        Returns:
+            np.ndarray: Composed SLM frame (uint8).
+        """
+        out = self._out if out is None else out
+        acc = self._acc
+        components = [c for c in components if c is not None]
+        if components:
+            np.copyto(acc, components[0])
+            for comp in components[1:]:
+                np.add(acc, comp, out=acc)
+        else:
+            acc.fill(0)
+        return self.levels(acc, out=out)
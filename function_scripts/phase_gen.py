@@ -1,35 +1,132 @@
 """
 phase_gen.py
 
-Stub module for SLM phase pattern generation.
+Module for SLM phase pattern generation.
 Originally adapted from the 'phasamp' and 'hologradpy' repositories.
 
-To be implemented in full later. Provides interface-compatible dummy behavior.
+Phase components (grating, measurement patch, manufacturer correction pattern,
+a previously measured correction phase and a computed hologram) are kept as
+module state in units of 2*pi, i.e. in [0, 1], and combined by
+make_full_slm_array() into the uint8 frame uploaded to the SLM. Holograms are
+computed with the GS / weighted-GS engine of function_scripts/holography.py.
 
 Author: Dimitrios Karanikolopoulos
 """
 
+import glob
+import os
+
 import numpy as np
 
+from function_scripts.holography import HologramEngine
+from function_scripts.phase_compose import PhaseComposer, PHASE_ONE, to_fixed
+
 # Internal storage
 grating = None
 patch = None
 final_phase = None
+correction_phase = None  # measured correction in [0, 1], applied with "corr_phase"
+calibration = None  # Calibration from a CalibrationStore, see use_calibration()
+hologram = None  # computed hologram phase in [0, 1], applied with "hologram"
 
 # Control flags
 grating_as_usual = True
 correction_path = ""
+mod_depth = 198  # uint8 level of a 2*pi phase shift (752 nm)
 which_phases = {
     "grating": False,
     "patch": False,
     "corr_patt": False,
-    "corr_phase": False
+    "corr_phase": False,
+    "hologram": False
 }
 
+# Composition caches: one composer per frame shape, memoized gratings and the
+# fixed-point copies of the last grating / correction phase arrays seen
+_composers = {}
+_engines = {}
+_gratings = {}
+_fixed = {}
+_missing_reported = set()
+
+
+def get_composer(shape=(1024, 1272)):
+    """Return the shared PhaseComposer for frames of the given shape."""
+    shape = tuple(shape)
+    composer = _composers.get(shape)
+    if composer is None:
+        composer = _composers[shape] = PhaseComposer(mod_depth, shape)
+    if calibration is not None and calibration.lut is not None and calibration.mod_depth == mod_depth:
+        composer.set_lut(calibration.lut, mod_depth)
+    else:
+        composer.mod_depth = mod_depth
+    return composer
+
+
+def use_calibration(cal):
+    """
+    Compose frames with a stored calibration (see function_scripts/calibration_store.py).
+
+    Sets mod_depth (and the LUT of a measured calibration); its correction frame
+    replaces the BMP at correction_path for "corr_patt". None goes back to the BMP.
+
+    Args:
+        cal (Calibration): Calibration to use, or None.
+    """
+    global calibration, mod_depth
+    calibration = cal
+    if cal is not None:
+        mod_depth = cal.mod_depth
+
+
+def get_engine(shape=(1024, 1272)):
+    """Return the shared HologramEngine (and its FFT buffers) for SLM frames of the given shape."""
+    shape = tuple(shape)
+    engine = _engines.get(shape)
+    if engine is None:
+        engine = _engines[shape] = HologramEngine(shape)
+    return engine
+
+
+def compute_hologram(target, shape=(1024, 1272), n_iter=30, weighted=True, **kwargs):
+    """
+    Compute a hologram for a focal-plane target and keep it for make_full_slm_array.
+
+    Enable it with which_phases["hologram"]. The target is an intensity on the
+    engine's FFT grid (get_engine(shape).fft_shape), zero order in the centre,
+    e.g. from holography.lg_target or holography.spot_array_target. A stack of
+    targets is computed as one batch and the last hologram is kept.
+
+    Args:
+        target (np.ndarray): Target intensity, or a stack of targets.
+        shape (tuple): (height, width) of the SLM.
+        n_iter (int): GS iterations.
+        weighted (bool): Weighted GS (uniform spot arrays) instead of plain GS.
+        **kwargs: Passed to HologramEngine.compute (init_phase, seed).
+
+    Returns:
+        np.ndarray: Hologram phase in [0, 1), one per target of a stack.
+    """
+    global hologram
+    phases = get_engine(shape).compute(target, n_iter=n_iter, weighted=weighted, **kwargs)
+    hologram = phases if phases.ndim == 2 else phases[-1]
+    return phases
+
+
+def _fixed_by_identity(name, arr):
+    """Fixed-point copy of arr, converted again only when a different array is passed."""
+    cached = _fixed.get(name)
+    if cached is None or cached[0] is not arr:
+        cached = _fixed[name] = (arr, to_fixed(arr))
+    return cached[1]
+
+
 def linear_grating(shape=(1024, 1272), period_px=40):
     """
     Create a horizontal grating pattern.
 
+    Gratings are memoized by (shape, period); the returned array is read-only.
+
     Args:
         shape (tuple): (height, width) of the SLM.
         period_px (int): Pixel period of the grating.
@@ -37,30 +134,109 @@ def linear_grating(shape=(1024, 1272), period_px=40):
     Returns:
         np.ndarray: Grating phase in [0, 1].
     """
-    h, w = shape
-    x = np.arange(w)
-    grating_line = np.mod(x, period_px) / period_px
-    gr = np.tile(grating_line, (h, 1))
     global grating
+    key = (tuple(shape), period_px)
+    gr = _gratings.get(key)
+    if gr is None:
+        h, w = shape
+        x = np.arange(w)
+        grating_line = np.mod(x, period_px) / period_px
+        gr = np.tile(grating_line, (h, 1))
+        gr.setflags(write=False)
+        _gratings[key] = gr
     grating = gr
     return gr
 
-def make_full_slm_array():
+
+def _correction_file():
+    """Resolve correction_path (a .bmp file or a folder holding one) to a file path."""
+    if os.path.isdir(correction_path):
+        bmp_files = sorted(glob.glob(os.path.join(correction_path, "*.bmp")))
+        return bmp_files[0] if bmp_files else None
+    return correction_path if os.path.isfile(correction_path) else None
+
+
+def _correction_fixed(shape):
+    """Cached fixed-point correction pattern, or None if there is no BMP."""
+    if calibration is not None and calibration.frame is not None and calibration.frame.shape == tuple(shape):
+        return calibration.fixed()
+    path = _correction_file()
+    correction = get_composer(shape).correction(path) if path else None
+    if correction is None and correction_path not in _missing_reported:
+        print("Correction pattern BMP not found.")
+        _missing_reported.add(correction_path)
+    return correction
+
+
+def load_correction_pattern(shape=(1024, 1272)):
     """
-    Combines available phase components into a final SLM array.
+    Load the manufacturer correction pattern from correction_path.
 
-    To be replaced with logic that loads correction files, applies patches, etc.
+    correction_path may point at a .bmp file or at a folder holding one. The
+    decoded pattern is cached until the file changes on disk. The frame of a
+    calibration set with use_calibration() takes precedence.
+
+    Args:
+        shape (tuple): (height, width) used when no pattern is found.
 
     Returns:
-        np.ndarray: Final SLM phase pattern (normalized, float32).
+        np.ndarray: Correction phase in [0, 1), zeros if no BMP was found.
     """
-    global grating, patch, final_phase
-    shape = grating.shape if grating is not None else (1024, 1272)
+    correction = _correction_fixed(shape)
+    if correction is None:
+        return np.zeros(shape)
+    return correction / PHASE_ONE
 
-    # For now: simply return grating if available
-    if grating is not None:
-        final_phase = grating.copy()
-    else:
-        final_phase = np.zeros(shape)
 
+def static_components(shape=(1024, 1272)):
+    """
+    Fixed-point components selected in which_phases, except the patch.
+
+    Args:
+        shape (tuple): (height, width) of the SLM frame.
+
+    Returns:
+        list: uint16 components (grating, hologram, correction pattern, correction phase).
+    """
+    components = []
+    if which_phases.get("grating") and grating is not None:
+        components.append(_fixed_by_identity("grating", grating))
+    if which_phases.get("hologram") and hologram is not None:
+        components.append(_fixed_by_identity("hologram", hologram))
+    if which_phases.get("corr_patt"):
+        correction = _correction_fixed(shape)
+        if correction is not None:
+            components.append(correction)
+    if which_phases.get("corr_phase") and correction_phase is not None:
+        components.append(_fixed_by_identity("correction_phase", correction_phase))
+    return components
+
+
+def make_full_slm_array(out=None):
+    """
+    Combines the phase components selected in which_phases into a final SLM array.
+
+    Enabled components are summed in fixed point (wrapping mod 2*pi) and mapped to
+    grey levels with the mod_depth lookup table. Gratings, the hologram and the
+    correction pattern are cached, so only the patch is converted per call.
+
+    Args:
+        out (np.ndarray): Optional uint8 frame to write into. By default the result
+            is written into a buffer shared by calls with the same shape.
+
+    Returns:
+        np.ndarray: Final SLM phase pattern (uint8).
+    """
+    global final_phase
+    shape = next((arr.shape for arr in (patch, grating, hologram) if arr is not None), (1024, 1272))
+    composer = get_composer(shape)
+
+    components = static_components(shape)
+    if which_phases.get("patch") and patch is not None:
+        buf = _fixed.get("patch_buffer")
+        if buf is None or buf.shape != patch.shape:
+            buf = _fixed["patch_buffer"] = np.empty(patch.shape, dtype=np.uint16)
+        components.append(to_fixed(patch, out=buf))
+
+    final_phase = composer.compose(components, out=out)
     return final_phase
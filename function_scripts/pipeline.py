@@ -0,0 +1,99 @@
+"""
+Producer/consumer pipeline used to overlap hardware acquisition with fitting.
+
+A producer thread runs the acquisition callable (SLM upload + camera exposure)
+patch by patch and pushes each frame into a bounded queue. The calling thread
+consumes frames in batches while the next patch is being exposed, so the total
+time approaches max(acquisition, fitting) instead of their sum.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+
+class _ProducerError:
+    """Wraps an exception raised in the producer thread."""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def run_pipelined(acquire, consume, n_items, queue_depth=4, max_batch=None):
+    """
+    Run acquire(i) for i in range(n_items) in a producer thread and feed the
+    results to consume(indices, items) in the calling thread.
+
+    Args:
+        acquire (callable): acquire(i) -> item, e.g. a background-subtracted frame.
+        consume (callable): consume(indices, items), called with batches of
+            consecutive items in acquisition order.
+        n_items (int): Number of items to acquire.
+        queue_depth (int): Maximum number of acquired items waiting to be consumed.
+            Bounds the memory held by the pipeline. 0 disables the producer thread
+            and acquires every item before consuming them.
+        max_batch (int): Maximum number of items handed to one consume call.
+            None takes everything available (all items when queue_depth is 0).
+
+    Raises:
+        Any exception raised by acquire or consume. The other side is stopped first.
+    """
+    if queue_depth <= 0:
+        items = [acquire(i) for i in range(n_items)]
+        step = max_batch or max(n_items, 1)
+        for start in range(0, n_items, step):
+            end = min(start + step, n_items)
+            consume(list(range(start, end)), items[start:end])
+        return
+
+    q = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def producer():
+        try:
+            for i in range(n_items):
+                if stop.is_set():
+                    return
+                put((i, acquire(i)))
+        except BaseException as exc:
+            put(_ProducerError(exc))
+        finally:
+            put(_DONE)
+
+    thread = threading.Thread(target=producer, name="acquisition-producer", daemon=True)
+    thread.start()
+    try:
+        finished = False
+        while not finished:
+            batch = [q.get()]
+            while max_batch is None or len(batch) < max_batch:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            indices, items = [], []
+            for entry in batch:
+                if entry is _DONE:
+                    finished = True
+                elif isinstance(entry, _ProducerError):
+                    raise entry.exc
+                else:
+                    indices.append(entry[0])
+                    items.append(entry[1])
+            if items:
+                consume(indices, items)
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,171 @@
+"""
+Full-resolution SLM correction from a retrieved dphi grid.
+
+measure_slm_wavefront returns the wrapped phase of every aperture on a coarse
+grid. build_correction() turns it into the correction displayed on the SLM:
+
+1. least-squares phase unwrapping: the wrapped phase differences define a
+   Poisson equation with Neumann boundaries, solved in one forward and one
+   inverse DCT (Ghiglia & Romero, JOSA A 11, 107 (1994));
+2. amplitude-weighted smoothing (normalized convolution), so apertures with
+   little light and noisy fits are filled in from their neighbours;
+3. bilinear upsampling to the SLM resolution as two small matrix products
+   (separable interpolation weights along rows and columns), clamped to the
+   edge values outside the scanned block.
+
+The correction cancels the retrieved phase, i.e. it is -dphi in units of 2*pi,
+wrapped to [0, 1) like the other phase_gen components. correction_frame() maps
+it to uint8 grey levels with the fixed-point LUT of PhaseComposer.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import numpy as np
+import scipy.fft as sfft
+from scipy.ndimage import gaussian_filter
+
+from function_scripts.phase_compose import PhaseComposer, to_fixed
+
+
+def _wrap(phase):
+    """Wrap a phase to [-pi, pi)."""
+    return np.mod(phase + np.pi, 2 * np.pi) - np.pi
+
+
+def unwrap_phase(wrapped):
+    """
+    Unweighted least-squares unwrapping of a 2D phase map with a DCT Poisson solver.
+
+    Args:
+        wrapped (np.ndarray): Wrapped phase [rad] (H x W).
+
+    Returns:
+        np.ndarray: Unwrapped phase [rad] with zero mean.
+    """
+    wrapped = np.asarray(wrapped, dtype=float)
+    h, w = wrapped.shape
+    # Wrapped gradients, zero across the boundary (Neumann condition)
+    gy = np.zeros((h + 1, w))
+    gx = np.zeros((h, w + 1))
+    gy[1:-1] = _wrap(np.diff(wrapped, axis=0))
+    gx[:, 1:-1] = _wrap(np.diff(wrapped, axis=1))
+    rho = np.diff(gy, axis=0) + np.diff(gx, axis=1)
+
+    rho_hat = sfft.dctn(rho, type=2, norm="ortho")
+    ky = 2 * np.cos(np.pi * np.arange(h) / h) - 2
+    kx = 2 * np.cos(np.pi * np.arange(w) / w) - 2
+    denom = ky[:, None] + kx[None, :]
+    denom[0, 0] = 1.0
+    phi_hat = rho_hat / denom
+    phi_hat[0, 0] = 0.0
+    return sfft.idctn(phi_hat, type=2, norm="ortho")
+
+
+def weighted_smooth(phase, weights, sigma=1.0):
+    """
+    Gaussian smoothing of a map, weighting every cell (normalized convolution).
+
+    Args:
+        phase (np.ndarray): Map to smooth (H x W).
+        weights (np.ndarray): Non-negative weights, e.g. the retrieved amplitude.
+        sigma (float): Gaussian width [cells]; 0 returns phase unchanged.
+
+    Returns:
+        np.ndarray: Smoothed map.
+    """
+    if sigma <= 0:
+        return np.asarray(phase, dtype=float)
+    weights = np.clip(np.asarray(weights, dtype=float), 0, None)
+    norm = gaussian_filter(weights, sigma, mode="nearest")
+    smooth = gaussian_filter(weights * phase, sigma, mode="nearest")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norm > 0, smooth / norm, phase)
+
+
+def interp_weights(n_out, n_in, start, cell):
+    """
+    Bilinear interpolation matrix from cell centres to output pixels along one axis.
+
+    Cell i covers pixels [start + i * cell, start + (i + 1) * cell); pixels
+    outside the first / last cell centre take the edge value.
+
+    Args:
+        n_out (int): Number of output pixels.
+        n_in (int): Number of grid cells.
+        start (float): First pixel of the grid [px].
+        cell (float): Cell width [px].
+
+    Returns:
+        np.ndarray: (n_out x n_in) float32 weight matrix with rows summing to 1.
+    """
+    pos = (np.arange(n_out) + 0.5 - start) / cell - 0.5
+    pos = np.clip(pos, 0, n_in - 1)
+    lo = np.minimum(np.floor(pos).astype(int), max(n_in - 2, 0))
+    frac = pos - lo
+    weights = np.zeros((n_out, n_in), dtype=np.float32)
+    rows = np.arange(n_out)
+    weights[rows, lo] = 1 - frac
+    if n_in > 1:
+        weights[rows, lo + 1] += frac
+    return weights
+
+
+def upsample(grid, shape, top, left, cell):
+    """
+    Bilinear upsampling of a cell grid to a full frame, as Wy @ grid @ Wx.T.
+
+    Args:
+        grid (np.ndarray): Values per cell (n_rows x n_cols).
+        shape (tuple): (height, width) of the output frame [px].
+        top (float): First frame row covered by the grid [px].
+        left (float): First frame column covered by the grid [px].
+        cell (float): Cell width [px].
+
+    Returns:
+        np.ndarray: float32 frame.
+    """
+    wy = interp_weights(shape[0], grid.shape[0], top, cell)
+    wx = interp_weights(shape[1], grid.shape[1], left, cell)
+    return wy @ np.asarray(grid, dtype=np.float32) @ wx.T
+
+
+def build_correction(dphi, amplitude, shape=(1024, 1272), top=0, left=0, cell=64, sigma=1.0):
+    """
+    Full-resolution correction phase cancelling a retrieved dphi grid.
+
+    Args:
+        dphi (np.ndarray): Wrapped retrieved phase per aperture [rad].
+        amplitude (np.ndarray): Retrieved amplitude per aperture (smoothing weights).
+        shape (tuple): (height, width) of the SLM frame [px].
+        top (float): First SLM row of the dphi grid [px].
+        left (float): First SLM column of the dphi grid [px].
+        cell (float): Aperture width of the grid [px].
+        sigma (float): Width of the amplitude-weighted smoothing [apertures].
+
+    Returns:
+        np.ndarray: float32 correction in units of 2*pi, wrapped to [0, 1).
+    """
+    weights = np.asarray(amplitude, dtype=float)
+    weights = weights / weights.max() if weights.max() > 0 else np.ones_like(weights)
+    phase = weighted_smooth(unwrap_phase(dphi), weights, sigma)
+    phase -= np.sum(weights * phase) / np.sum(weights) if np.sum(weights) > 0 else phase.mean()
+    full = upsample(phase, shape, top, left, cell)
+    full *= np.float32(-1 / (2 * np.pi))
+    return np.mod(full, np.float32(1.0), out=full)
+
+
+def correction_frame(correction, mod_depth=198, composer=None):
+    """
+    uint8 grey levels of a correction phase for the given modulation depth.
+
+    Args:
+        correction (np.ndarray): Correction in units of 2*pi.
+        mod_depth (int): Grey level of a 2*pi phase shift.
+        composer (PhaseComposer): Composer whose LUT to use; a new one if None.
+
+    Returns:
+        np.ndarray: uint8 frame.
+    """
+    if composer is None:
+        composer = PhaseComposer(mod_depth, correction.shape)
+    return composer.levels(to_fixed(correction))
@@ -0,0 +1,128 @@
+"""
+Optional reporting layer of a wavefront measurement: result files and figures.
+
+matplotlib is only imported when a figure is actually drawn, so headless runs
+(plots=False) never load it. ResultWriter moves np.save and figure rendering to
+a background thread: measure_slm_wavefront queues its results and returns as
+soon as they are computed, while the files are written behind it. Figures are
+drawn on a standalone matplotlib Figure with the Agg canvas, which is safe
+outside the main thread; only the live view of plot_within uses pyplot.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import collections
+import os
+import threading
+
+import numpy as np
+
+
+def save_array(path, arr):
+    """Write an array to a .npy file atomically (through a .part file)."""
+    with open(path + ".part", "wb") as f:
+        np.save(f, arr)
+    os.replace(path + ".part", path)
+
+
+def save_figure(path, image, title, cmap):
+    """
+    Render an image with a colorbar to a file, without pyplot.
+
+    Args:
+        path (str): Output file; the format follows the extension.
+        image (np.ndarray): 2D map to show.
+        title (str): Figure title.
+        cmap (str): Colormap name.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots()
+    fig.colorbar(ax.imshow(image, cmap=cmap), ax=ax)
+    ax.set_title(title)
+    fig.savefig(path)
+
+
+def show_frame(image, title, pause=0.3):
+    """Show a camera frame in the interactive pyplot window for a moment."""
+    import matplotlib.pyplot as plt
+
+    plt.imshow(image, cmap='inferno')
+    plt.title(title)
+    plt.colorbar()
+    plt.pause(pause)
+    plt.clf()
+
+
+class ResultWriter:
+    """
+    Background thread that writes result arrays and figures in submission order.
+
+    The thread is started on demand and exits once the queue is empty. It is
+    not a daemon thread, so the interpreter waits for pending files before
+    exiting. Queued arrays are written as they are at write time: do not modify
+    them after submitting.
+    """
+
+    def __init__(self):
+        self._jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._errors = []
+
+    @property
+    def pending(self):
+        """Number of jobs not written yet (including the one in progress)."""
+        with self._cond:
+            return len(self._jobs) + (self._thread is not None)
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) for the writer thread."""
+        with self._cond:
+            self._jobs.append((fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="result-writer")
+                self._thread.start()
+
+    def save(self, path, arr):
+        """Queue an array for save_array."""
+        self.submit(save_array, path, arr)
+
+    def figure(self, path, image, title, cmap):
+        """Queue a figure for save_figure."""
+        self.submit(save_figure, path, image, title, cmap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._jobs:
+                    self._thread = None
+                    self._cond.notify_all()
+                    return
+                fn, args = self._jobs.popleft()
+            try:
+                fn(*args)
+            except Exception as exc:
+                with self._cond:
+                    self._errors.append(exc)
+
+    def wait(self, timeout=None):
+        """
+        Block until every queued job is written.
+
+        Args:
+            timeout (float): Maximum wait [s]; None waits indefinitely.
+
+        Returns:
+            bool: True if the queue was drained, False on timeout.
+
+        Raises:
+            Exception: The first error raised by a job since the last wait().
+        """
+        with self._cond:
+            done = self._cond.wait_for(lambda: self._thread is None, timeout)
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+        return done
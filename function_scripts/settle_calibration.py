@@ -0,0 +1,228 @@
+"""
+Calibration of the SLM settle time (liquid-crystal response).
+
+After an upload the liquid crystal needs time to reach the new phase; until
+then the camera sees a mix of the old and the new pattern. Instead of a fixed
+sleep, calibrate_settle_time() measures the response: it toggles the SLM
+between two patterns (by default flat and the measurement grating, which move
+light in and out of the camera window), streams camera frames after every
+upload and finds when the window intensity stays within a tolerance of its
+final level. The slowest transition, times a safety margin, is the settle time.
+
+Results are kept per device serial and head temperature (the response slows
+down when the liquid crystal is cold) in a SettleStore JSON file. SLM drivers
+with a settle_store look up the entry closest to their current temperature
+(update_settle_time), and the wavefront measurement refreshes it before every
+scan.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+import function_scripts.phase_gen as phase_gen
+
+
+class SettleStore:
+    """
+    Calibrated settle times per device and temperature, stored as JSON.
+
+    Attributes:
+        path (str): JSON file; created on the first add().
+        entries (dict): serial -> list of {temperature, settle_time, tolerance, date}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def add(self, serial, temperature, settle_time, **info):
+        """
+        Record a calibration and rewrite the file atomically.
+
+        An earlier entry of the device within 0.1 degC is replaced.
+
+        Args:
+            serial (str): Device serial number.
+            temperature (float): SLM head temperature during the calibration [degC].
+            settle_time (float): Safe settle time [s].
+            **info: Further JSON-serializable details (tolerance, margin, ...).
+        """
+        entries = [e for e in self.entries.get(serial, []) if abs(e["temperature"] - temperature) > 0.1]
+        entries.append({"temperature": float(temperature), "settle_time": float(settle_time),
+                        "date": time.strftime("%Y-%m-%d %H:%M:%S"), **info})
+        self.entries[serial] = sorted(entries, key=lambda e: e["temperature"])
+        with open(self.path + ".part", "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(self.path + ".part", self.path)
+
+    def lookup(self, serial, temperature, max_delta=2.0):
+        """
+        Settle time calibrated closest to a temperature.
+
+        Args:
+            serial (str): Device serial number.
+            temperature (float): Current head temperature [degC].
+            max_delta (float): Largest accepted temperature difference [degC].
+
+        Returns:
+            float: Settle time [s], or None if no entry is close enough.
+        """
+        entries = self.entries.get(serial, [])
+        if not entries:
+            return None
+        best = min(entries, key=lambda e: abs(e["temperature"] - temperature))
+        if abs(best["temperature"] - temperature) > max_delta:
+            return None
+        return best["settle_time"]
+
+
+def default_patterns(slm):
+    """Flat frame and the measurement grating as uint8 frames for slm."""
+    shape = tuple(slm.res)
+    flat = np.zeros(shape, dtype=np.uint8)
+    grating = np.rint(phase_gen.linear_grating(shape) * slm.mod_depth).astype(np.uint8)
+    return flat, grating
+
+
+def settle_curve(slm, cam, pattern, duration):
+    """
+    Upload a pattern without settle wait and stream camera frames for a while.
+
+    Args:
+        slm: SLM driver with load_phase() and settle_time.
+        cam: Camera with grab_frame().
+        pattern (np.ndarray): Frame to upload.
+        duration (float): Streaming time after the upload [s].
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Time after the upload at the end of each
+            frame [s] and the summed intensity of each frame.
+    """
+    settle_time, slm.settle_time = slm.settle_time, 0.0
+    try:
+        slm.load_phase(pattern)
+        t0 = time.perf_counter()
+        times, signal = [], []
+        while not times or times[-1] < duration:
+            signal.append(float(np.sum(cam.grab_frame(), dtype=float)))
+            times.append(time.perf_counter() - t0)
+    finally:
+        slm.settle_time = settle_time
+    return np.asarray(times), np.asarray(signal)
+
+
+def settled_after(times, signal, band):
+    """
+    First time after which the signal stays within band of its final level.
+
+    The final level is the median of the last quarter of the samples.
+
+    Args:
+        times (np.ndarray): Sample times [s].
+        signal (np.ndarray): Samples.
+        band (float): Accepted deviation from the final level.
+
+    Returns:
+        float: Time of the first sample of the settled tail [s].
+    """
+    final = np.median(signal[-max(len(signal) // 4, 1):])
+    outside = np.flatnonzero(np.abs(signal - final) > band)
+    if outside.size == 0:
+        return float(times[0])
+    return float(times[min(outside[-1] + 1, len(times) - 1)])
+
+
+def calibrate_settle_time(slm, cam, store=None, patterns=None, n_toggles=3, duration=0.3, tol=0.02,
+                          margin=1.2):
+    """
+    Measure the minimal safe settle time of an SLM and optionally store it.
+
+    The SLM is first held on pattern A for `duration`, then toggled A -> B -> A
+    n_toggles times. For every transition the window intensity is streamed for
+    `duration` and the settle time is the end of the first frame from which on
+    the intensity stays within tol * |I_B - I_A| of its final level. The result
+    is the slowest transition times margin.
+
+    Args:
+        slm: SLM driver (SlmHamamatsu or SimulatedSlm).
+        cam: Camera with grab_frame(); the open shutter must light the window.
+        store (SettleStore): Where to record the result with serial and head temperature.
+        patterns (tuple): Two uint8 frames; default_patterns(slm) if None.
+        n_toggles (int): Number of A -> B -> A cycles.
+        duration (float): Streaming time per transition [s]; must exceed the response.
+        tol (float): Tolerance as a fraction of the intensity contrast between the patterns.
+        margin (float): Safety factor applied to the slowest transition.
+
+    Returns:
+        dict: settle_time [s], temperature [degC], contrast and the per-transition
+            settle times ("transitions") and curves ("curves": (times, signal)).
+
+    Raises:
+        ValueError: If the patterns give no contrast or a transition does not
+            settle within the first half of duration.
+    """
+    pattern_a, pattern_b = default_patterns(slm) if patterns is None else patterns
+    settle_curve(slm, cam, pattern_a, duration)
+    curves = []
+    for _ in range(n_toggles):
+        curves.append(settle_curve(slm, cam, pattern_b, duration))
+        curves.append(settle_curve(slm, cam, pattern_a, duration))
+
+    levels = [np.median(signal[-max(len(signal) // 4, 1):]) for _, signal in curves[:2]]
+    contrast = abs(levels[0] - levels[1])
+    if contrast == 0:
+        raise ValueError("The two patterns give the same camera intensity; nothing to time")
+    transitions = [settled_after(times, signal, tol * contrast) for times, signal in curves]
+    if max(transitions) > duration / 2:
+        raise ValueError(f"SLM did not settle within {duration / 2:.3f} s; increase duration")
+
+    settle_time = margin * max(transitions)
+    temperature = slm.check_temp()[0]
+    if store is not None:
+        store.add(slm.serial, temperature, settle_time, tolerance=tol, margin=margin)
+    return {"settle_time": settle_time, "temperature": temperature, "contrast": contrast,
+            "transitions": transitions, "curves": curves}
+
+
+def calibrated_settle_time(slm, store, max_delta=2.0):
+    """
+    Settle time stored for an SLM at its current head temperature.
+
+    Args:
+        slm: SLM driver with serial and check_temp().
+        store (SettleStore): Calibration store.
+        max_delta (float): Largest accepted temperature difference [degC].
+
+    Returns:
+        float: Settle time [s], or None without a matching calibration.
+    """
+    return store.lookup(slm.serial, slm.check_temp()[0], max_delta)
+
+
+def update_settle_time(slm, max_delta=2.0):
+    """
+    Set an SLM driver's settle_time for its current head temperature.
+
+    Shared by SlmHamamatsu and SimulatedSlm. Falls back to the driver's
+    default_settle_time without a settle_store or a calibration within max_delta.
+
+    Args:
+        slm: SLM driver with serial, check_temp(), settle_store and default_settle_time.
+        max_delta (float): Largest accepted temperature difference [degC].
+
+    Returns:
+        float: The settle time now used by the driver [s].
+    """
+    calibrated = None
+    if slm.settle_store is not None:
+        calibrated = calibrated_settle_time(slm, slm.settle_store, max_delta)
+    slm.settle_time = slm.default_settle_time if calibrated is None else calibrated
+    return slm.settle_time
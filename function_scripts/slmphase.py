@@ -10,46 +10,50 @@ Author: Dimitrios Karanikolopoulos
 import os
 import time
 import copy
+import shutil
 import numpy as np
-import matplotlib.pyplot as plt
 
 import function_scripts.fitting as ft
+import function_scripts.phase_gen as phase_gen
+from function_scripts.adaptive_scan import AdaptiveGrid
+from function_scripts.averaging import fringe_phase_error
+from function_scripts.checkpoint import ScanCheckpoint
+from function_scripts.frame_store import FrameStore
+from function_scripts.instrumentation import StageProfiler, save_trace
+from function_scripts.multiplex import plan_groups
 from function_scripts.helpers import meshgrid_slm, closest_arr, make_grid
-
-# Dummy phase generator placeholder (used until full logic is ported)
-class DummyPhasor:
-    """
-    Stub class to emulate phase generation logic.
-    To be replaced with complete routines from slm_hamamatsu.py.
-    """
-    def __init__(self):
-        self.patch = None
-        self.final_phase = None
-        self.correction_path = None
-        self.which_phases = {}
-
-    def linear_grating(self):
-        pass
-
-    def make_full_slm_array(self):
-        self.final_phase = np.zeros((1024, 1272), dtype=np.uint8)
-
-
-phase_gen = DummyPhasor()
-
+from function_scripts.patch_sequence import PatchSequence, aperture_bounds
+from function_scripts.pipeline import run_pipelined
+from function_scripts.reconstruction import build_correction, correction_frame, unwrap_phase
+from function_scripts.reporting import ResultWriter, save_array, save_figure, show_frame
+from function_scripts.zernike import get_basis, save_record, zernike_modes
 
 class PhaseAmplitudeRetriever:
     """
     The main class for retrieving the phase and intensity profile of the SLM wavefront.
     """
 
-    def __init__(self, data_path, wavelength=752e-9):
+    def __init__(self, data_path, wavelength=752e-9, calibration_store=None):
+        """
+        Args:
+            data_path (str): Folder of the measurement runs.
+            wavelength (float): Laser wavelength [m].
+            calibration_store (CalibrationStore): Stored corrections and mod-depth LUTs
+                (function_scripts/calibration_store.py); the one matching the SLM,
+                wavelength and head temperature is applied before each scan.
+        """
         self.data_path = data_path
         self.wavelength = wavelength
         self.k = 2 * np.pi / self.wavelength
         self.the_path = data_path
         self.use_prev_dphi = False
         self.bckgrnd_full = None
+        self.correction_phase = None  # full-resolution correction in [0, 1), see build_correction
+        self.writer = ResultWriter()  # background np.save / figure rendering
+        self.profiler = StageProfiler()  # per-stage timing of the last measurement
+        self.calibration_store = calibration_store
+        self.calibration = None  # Calibration applied in the last measurement
+        self.zernike = None  # Zernike record of the correction, see ZernikeBasis.record
 
     def measure_slm_wavefront(
         self,
@@ -67,21 +71,203 @@ class PhaseAmplitudeRetriever:
         sv_data=False,
         rm_fringes=True,
         use_correction=False,
+        refine_fit=False,
+        fit_backend="sine",
+        workers=None,
+        pipeline_depth=4,
+        frame_cache_dir=None,
+        frame_dtype=np.float32,
+        cam_roi=None,
+        binning=1,
+        target_phase_err=None,
+        resume=False,
+        refine_levels=0,
+        refine_step=np.pi / 2,
+        refine_err=None,
+        smooth_sigma=1.0,
+        zernike_order=6,
+        multiplex=1,
+        plots=True,
+        background_save=True,
     ):
         """
         Main function to retrieve the SLM wavefront by projecting small aperture gratings
         and fitting the resulting interferograms.
 
+        Patches are fitted in vectorized batches, either with a linear least-squares
+        solve (fit_backend="sine", FitSine.fit_stack) or by Fourier-transform fringe
+        demodulation (fit_backend="fft", FitFFT.fit_stack). Set refine_fit=True to
+        polish each patch with safe_fit; workers=n spreads that refinement over a
+        pool of n processes (workers > 1 without refine_fit raises ValueError).
+
+        Acquisition and fitting are pipelined: a producer thread uploads patches and
+        exposes the camera while the calling thread fits the frames already taken.
+        pipeline_depth bounds the number of frames waiting in the queue; 0 acquires
+        every patch before fitting.
+
+        The background and aperture grey levels of the patch frames are computed
+        before the loop and each frame is composed when it is displayed (see
+        PatchSequence). With frame_cache_dir set all frames are composed once and kept
+        there as memory-mapped .npy stacks, keyed by scan geometry, and reused by
+        later scans with the same settings.
+
+        Camera frames are streamed into a chunked, memory-mapped FrameStore (in the
+        camera ROI shape, stored as frame_dtype, e.g. np.uint16 for raw counts) and
+        read back in chunks for fitting, so memory does not grow with roi_n. The
+        store lives in <save_dir>/frames; with sv_data=True it is kept after the
+        run and can be refitted later with FrameStore.open().
+
+        Cameras that provide average_into(out, num_frames) (see SimulatedCamera) are
+        averaged with a running mean straight into a preallocated frame. For those,
+        cam_roi=(height, width) reads out only a sensor subarray centred on the
+        interference spot and binning bins the frames in software before fitting.
+
+        With target_phase_err [rad] set, averaging is adaptive: after every frame the
+        expected fit error of the running mean is estimated from its fringe contrast
+        and pixel noise (fringe_phase_error), and the patch stops as soon as it
+        drops below the target. num_frames is then the maximum per patch. The frame
+        count of every patch is saved in frames_used.npy.
+
+        The run is checkpointed as it goes (see ScanCheckpoint): the scan settings
+        are written to scan.json, every acquired frame to the FrameStore in
+        <save_dir>/frames and the fit results to fit_checkpoint.npz after every
+        fitted batch. resume=True continues the latest run under data_path,
+        resume=<folder> a given one: patches already acquired are not exposed
+        again, frames not fitted yet are fitted, and the stored background and
+        camera subarray are reused. Resuming with different scan settings, or a run
+        that already completed, raises ValueError. Without sv_data the frames are
+        removed once the run completes.
+
+        refine_levels=L > 0 turns the scan coarse-to-fine (see AdaptiveGrid): after
+        the roi_n x roi_n grid, every aperture whose phase differs from a neighbour
+        by more than refine_step [rad], or whose fit error exceeds refine_err [rad],
+        is split into 2 x 2 apertures of half the width and measured again, up to L
+        times. dphi, amplitude and dphi_err are then interpolated from all measured
+        apertures onto the (roi_n * 2**L)^2 grid of the finest level, and the
+        per-level results are saved in apertures.npz. Half-width apertures give
+        twice as large camera spots, so cam_roi must leave room for them.
+
+        multiplex=K > 1 displays up to K apertures per frame (see plan_groups). Each
+        interferes with the reference on a carrier set by its offset, so apertures
+        are grouped such that their sidebands, the DC term and the cross terms
+        between them do not overlap; every camera frame is then demodulated once
+        per carrier. This divides the number of uploads and exposures by up to K.
+        fit_backend="fft" is preferred, as it only looks at each sideband.
+
+        At the end the retrieved dphi is turned into a full-resolution correction
+        (build_correction: DCT least-squares unwrapping, amplitude-weighted
+        smoothing over smooth_sigma apertures, bilinear upsampling). It is kept in
+        self.correction_phase and phase_gen.correction_phase, so the next call with
+        use_correction=True displays it during the scan and adds the residual it
+        measures on top (closed loop).
+
+        dphi is also decomposed into Zernike modes up to zernike_order
+        (function_scripts/zernike.py: one amplitude-weighted least-squares solve on a
+        cached, orthonormalized basis). The coefficients, accumulated over
+        use_correction runs like the correction itself, are kept in self.zernike
+        and saved to zernike.json; zernike.correction_from_record rebuilds the
+        correction from them.
+
+        Every stage is timed by self.profiler (StageProfiler): frame composition,
+        SLM upload and settle wait (recorded by SLMs with a profiler attribute),
+        camera exposure and readout, frame read-back with background subtraction,
+        fitting, checkpointing and reconstruction. Each acquired frame has its own
+        records (StageProfiler.frame_records). The summary table is printed at the
+        end and the trace is saved as timing_trace.json (Chrome trace format);
+        self.profiler.add_hook() feeds the records to an external collector.
+
+        SLMs with a settle_store (see calibrate_settle_time) switch to the settle
+        time calibrated for their current head temperature before the scan.
+        SLMs with frame-memory slots (SlmHamamatsu(frame_slots=n)) display every
+        patch frame from a slot and transfer the next n - 2 frames in the
+        background while the current one is exposed.
+        With a calibration_store, the stored calibration closest to the SLM
+        serial, wavelength and head temperature replaces the correction BMP and
+        mod_depth of the frames.
+
+        Result files are written by a background thread (self.writer, see
+        ResultWriter) so the call returns as soon as the results are computed;
+        call wait_for_results() before reading them. background_save=False writes
+        them before returning. plots=False skips the phase and intensity figures,
+        and with plot_within off matplotlib is then never imported.
+
         Saves:
+            frames: raw interferograms, background and index (sv_data=True;
+                frames_L<level> for refinement levels)
             dphi: retrieved relative phase
             dphi_err: error from sine fitting
-            i_fit: intensity from amplitude product of fits
+            amplitude: intensity from amplitude product of fits
+            correction_phase: full-resolution correction in units of 2*pi (float32)
+            correction_frame: the correction as uint8 grey levels for mod_depth
+            zernike.json: Zernike coefficients of the correction and their pupil
+            timing_trace.json: per-stage timing (Chrome trace, see StageProfiler)
+
+        Returns:
+            str: The run folder holding the saved results.
         """
 
+        if workers is not None and workers > 1 and not refine_fit:
+            raise ValueError("workers only parallelizes the refine_fit pass; set refine_fit=True")
+        prof = self.profiler
+        prof.reset()
+        if hasattr(slm_disp_obj, "profiler"):
+            slm_disp_obj.profiler = prof
+        if getattr(slm_disp_obj, "settle_store", None) is not None:
+            # Calibrated liquid-crystal settle time for the current head temperature
+            print(f"SLM settle time: {1e3 * slm_disp_obj.update_settle_time():.1f} ms")
+        self.calibration = None
+        if self.calibration_store is not None:
+            # Stored correction frame and mod_depth for this wavelength and head temperature
+            wavelength_nm = round(self.wavelength * 1e9, 6)
+            self.calibration = self.calibration_store.lookup(
+                slm_disp_obj.serial, wavelength_nm, slm_disp_obj.check_temp()[0], interpolate=True)
+            if self.calibration is None:
+                print(f"No stored calibration of {slm_disp_obj.serial} at {wavelength_nm:g} nm")
+            if hasattr(slm_disp_obj, "apply_calibration"):
+                # None also drops the calibration of a previous run
+                slm_disp_obj.apply_calibration(self.calibration)
+
         self.use_prev_dphi = use_correction
-        timestamp = time.strftime("%y-%m-%d_%H-%M-%S", time.localtime())
-        save_dir = os.path.join(self.data_path, f"{timestamp}_wavefront")
-        os.makedirs(save_dir)
+        if use_correction and self.correction_phase is not None:
+            phase_gen.correction_phase = self.correction_phase
+
+        # Settings that determine the frames and fits; a resumed run must match them
+        geometry = {
+            "aperture_number": aperture_number,
+            "aperture_width": aperture_width,
+            "roi_min_x": roi_min_x,
+            "roi_min_y": roi_min_y,
+            "roi_n": roi_n,
+            "exposure_time": exposure_time,
+            "num_frames": num_frames,
+            "rm_fringes": rm_fringes,
+            "use_correction": use_correction,
+            "fit_backend": fit_backend,
+            "frame_dtype": np.dtype(frame_dtype).str,
+            "cam_roi": None if cam_roi is None else list(cam_roi),
+            "binning": binning,
+            "target_phase_err": target_phase_err,
+            "refine_levels": refine_levels,
+            "refine_step": refine_step,
+            "refine_err": refine_err,
+            "multiplex": multiplex,
+        }
+        stored = None
+        if resume:
+            save_dir = ScanCheckpoint.latest(self.data_path) if resume is True else resume
+            if save_dir is None:
+                raise ValueError(f"No measurement to resume in {self.data_path}")
+            checkpoint = ScanCheckpoint(save_dir)
+            if checkpoint.is_complete():
+                raise ValueError(f"Measurement {save_dir} is already complete; nothing to resume")
+            stored = checkpoint.check_geometry(geometry, list(geometry))
+        else:
+            timestamp = time.strftime("%y-%m-%d_%H-%M-%S", time.localtime())
+            save_dir = os.path.join(self.data_path, f"{timestamp}_wavefront")
+            os.makedirs(save_dir)
+            checkpoint = ScanCheckpoint(save_dir)
+        store_dir = os.path.join(save_dir, "frames")
+        resumed = stored is not None and os.path.exists(os.path.join(store_dir, "meta.json"))
 
         # Setup
         res_y, res_x = slm_disp_obj.res
@@ -92,15 +278,9 @@ class PhaseAmplitudeRetriever:
 
         # Create phase mask for measurement
         phase_gen.correction_path = self.the_path
-        phase_gen.which_phases = {
-            "grating": True,
-            "patch": False,
-            "corr_patt": True,
-            "corr_phase": use_correction,
-        }
-        phase_gen.linear_grating()
-        phase_gen.make_full_slm_array()
-        slm_phase = phase_gen.final_phase
+        phase_gen.mod_depth = slm_disp_obj.mod_depth
+        phase_gen.use_calibration(self.calibration)
+        slm_phase = phase_gen.linear_grating((res_y, res_x))
 
         # Get aperture coordinates
         slm_idx = self._get_aperture_indices(
@@ -110,119 +290,358 @@ class PhaseAmplitudeRetriever:
         roi_idxs = roi_idxs[roi_min_x : roi_min_x + roi_n, roi_min_y : roi_min_y + roi_n].flatten()
         n_centre = aperture_number**2 // 2 + aperture_number // 2 - 1
 
-        # Capture background image
-        print("Recording background...")
-        if rm_fringes:
-            phase_gen.which_phases = {
-                "grating": False,
-                "patch": False,
-                "corr_patt": True,
-                "corr_phase": use_correction,
-            }
-            phase_gen.make_full_slm_array()
-            slm_disp_obj.load_phase(phase_gen.final_phase)
-            shutter_obj.shutter_enable()
-        else:
-            shutter_obj.shutter_enable(False)
+        # Patch offsets are taken between aperture centres, so apertures of any size share one reference
+        slm_top, slm_bot, slm_left, slm_right = slm_idx
+        ref_x = (slm_left[n_centre] + slm_right[n_centre]) / 2
+        ref_y = (slm_top[n_centre] + slm_bot[n_centre]) / 2
+
+        def frame_groups(bounds, width):
+            # Patches shown together in each frame (see plan_groups), one per frame without multiplexing
+            top, bot, left, right = bounds
+            if multiplex <= 1:
+                return np.arange(len(top))[:, None]
+            offsets = np.c_[(top + bot) / 2 - ref_y, (left + right) / 2 - ref_x]
+            return plan_groups(offsets, multiplex, width)
+
+        roi_bounds = tuple(b[roi_idxs] for b in slm_idx)
+        roi_groups = frame_groups(roi_bounds, aperture_width)
+
+        # Compose every patch frame up front: reference + scanned patch on top of the corrections
+        phase_gen.which_phases = {
+            "grating": False,
+            "patch": True,
+            "corr_patt": True,
+            "corr_phase": use_correction,
+        }
+        with prof.stage("compose_frames", level=0):
+            frames = PatchSequence.build(
+                phase_gen.get_composer((res_y, res_x)), slm_phase, slm_idx, n_centre,
+                np.where(roi_groups >= 0, roi_idxs[roi_groups], -1),
+                static=phase_gen.static_components((res_y, res_x)), cache_dir=frame_cache_dir,
+            )
 
         cam_obj.exposure = exposure_time
         cam_obj.num = num_frames
-        cam_obj.prep_acq()
-        cam_obj.take_average_image(num_frames)
-        bckgr = copy.deepcopy(cam_obj.last_frame)
+        streaming = hasattr(cam_obj, "average_into")
+        if (cam_roi is not None or binning != 1 or target_phase_err is not None) and not streaming:
+            raise ValueError("cam_roi, binning and target_phase_err need a camera with average_into()")
+        if (cam_roi is not None or binning != 1) and stored is not None and stored.get("subarray"):
+            # Read out the same sensor window as the interrupted run
+            cam_obj.set_binning(binning)
+            cam_obj.set_subarray(*stored["subarray"])
+        elif cam_roi is not None or binning != 1:
+            # Centre the readout window on the spot of the first patch, measured
+            # against a patch-free frame so zero-order light does not pull it away
+            with prof.stage("centre_roi"):
+                shutter_obj.shutter_enable(True)
+                cam_obj.set_binning(binning)
+                cam_obj.set_subarray()
+                phase_gen.which_phases = dict(phase_gen.which_phases, patch=False)
+                slm_disp_obj.load_phase(phase_gen.make_full_slm_array())
+                no_spot = cam_obj.grab_frame()
+                slm_disp_obj.load_phase(frames[0])
+                cam_obj.centre_subarray(cam_roi, background=no_spot)
+        if stored is None:
+            if streaming:
+                geometry["subarray"] = list(cam_obj.subarray)
+            checkpoint.save_geometry(geometry)
+
+        def average_frame(out, stop=None):
+            # Running-mean average into out when the camera supports it
+            if streaming:
+                return cam_obj.average_into(out, num_frames, stop=stop)
+            cam_obj.take_average_image(num_frames)
+            return cam_obj.last_frame
+
+        if resumed:
+            # Interferograms and background of the interrupted run
+            store = FrameStore.open(store_dir)
+            store.close()
+            bckgr = store.background
+            if streaming and store.frame_shape != tuple(cam_obj.frame_shape):
+                raise ValueError(f"Stored frames are {store.frame_shape}, the camera delivers {cam_obj.frame_shape}")
+            cam_obj.prep_acq()
+        else:
+            # Capture background image
+            print("Recording background...")
+            if rm_fringes:
+                phase_gen.which_phases = {
+                    "grating": False,
+                    "patch": False,
+                    "corr_patt": True,
+                    "corr_phase": use_correction,
+                }
+                phase_gen.make_full_slm_array()
+                slm_disp_obj.load_phase(phase_gen.final_phase)
+                shutter_obj.shutter_enable()
+            else:
+                shutter_obj.shutter_enable(False)
+
+            cam_obj.prep_acq()
+            with prof.stage("background"):
+                if streaming:
+                    bckgr = average_frame(np.empty(cam_obj.frame_shape))
+                else:
+                    bckgr = copy.deepcopy(average_frame(None))
 
         # Activate shutter
         shutter_obj.shutter_enable(True)
 
-        # Initialize image stack
-        img_stack = np.zeros((300, 300, roi_n**2))
-        ph_central = np.zeros((res_y, res_x))
-        ph_central[slm_idx[0][n_centre]:slm_idx[1][n_centre],
-                   slm_idx[2][n_centre]:slm_idx[3][n_centre]] = \
-            slm_phase[slm_idx[0][n_centre]:slm_idx[1][n_centre],
-                      slm_idx[2][n_centre]:slm_idx[3][n_centre]]
-
-        # Loop over apertures
-        print("Starting measurement loop...")
-        for i, idx in enumerate(roi_idxs):
-            masked_phase = np.copy(ph_central)
-            masked_phase[slm_idx[0][idx]:slm_idx[1][idx],
-                         slm_idx[2][idx]:slm_idx[3][idx]] = \
-                slm_phase[slm_idx[0][idx]:slm_idx[1][idx],
-                          slm_idx[2][idx]:slm_phase[3][idx]]
-
-            phase_gen.patch = masked_phase
-            phase_gen.make_full_slm_array()
-            slm_disp_obj.load_phase(phase_gen.final_phase)
+        # Fitting setup
+        if fit_backend == "sine":
+            fitter = ft.FitSine(fl, k)
+        elif fit_backend == "fft":
+            fitter = ft.FitFFT(fl, k)
+        else:
+            raise ValueError(f"Unknown fit_backend: {fit_backend!r} (expected 'sine' or 'fft')")
+
+        # Cached float32 axes; the fitters broadcast the carrier over them
+        x, y = make_grid(bckgr, scale=cam_obj.pitch, dtype=np.float32, sparse=True)
+        frame_buf = np.empty(bckgr.shape, dtype=np.float32)
+        level_dirs = []
+        # SLMs with frame-memory slots: show cached frames by index and preload the next ones
+        memory = getattr(slm_disp_obj, "frame_memory", None)
+        preload_ahead = 0 if memory is None else memory.n_slots - 2
+
+        def snr_reached(dx, dy):
+            # Stop criterion for a frame: fit error of the running mean below target for all its patches
+            carriers = [np.exp(-1j * k / fl * (dx_i * x + dy_i * y)) for dx_i, dy_i in zip(dx, dy)]
+
+            def stop(mean, noise_var, n):
+                return all(fringe_phase_error(mean - bckgr, noise_var, n, carrier) <= target_phase_err
+                           for carrier in carriers)
+            return stop
+
+        def scan(level, frames, bounds, patch_ids, groups):
+            # Acquire and fit one set of apertures, checkpointed in its own store.
+            # Frame f shows the patches groups[f] (padded with -1).
+            top, bot, left, right = bounds
+            dx = ((left + right) / 2 - ref_x) * slm_pitch
+            dy = ((top + bot) / 2 - ref_y) * slm_pitch
+            n_patch = len(patch_ids)
+            members = [g[g >= 0] for g in groups]
+            patch_frame = np.empty(n_patch, dtype=int)
+            for f, m in enumerate(members):
+                patch_frame[m] = f
+
+            level_dir = store_dir if level == 0 else os.path.join(save_dir, f"frames_L{level}")
+            level_dirs.append(level_dir)
+            if os.path.exists(os.path.join(level_dir, "meta.json")):
+                store = FrameStore.open(level_dir)
+            else:
+                # Interferograms go to disk as they arrive; only the chunk being fitted is in memory
+                store = FrameStore(level_dir, bckgr.shape, len(groups), dtype=frame_dtype, background=bckgr,
+                                   patches_per_frame=max(len(m) for m in members))
+
+            phi = np.zeros(n_patch)
+            amp = np.zeros(n_patch)
+            dphi_err = np.zeros(n_patch)
+            frames_used = np.full(n_patch, num_frames)
+            fitted = np.zeros(n_patch, dtype=bool)
+            frame_written = np.array(store.index["written"], dtype=bool)
+            written = frame_written[patch_frame]
+            state = checkpoint.load_fit(level) if stored is not None else None
+            if state is not None:
+                phi[:], amp[:], dphi_err[:] = state["phi"], state["amp"], state["dphi_err"]
+                fitted[:] = state["fitted"]
+            fitted &= written
+            frames_used[written] = store.index["n_frames"][patch_frame[written]]
+            if written.any():
+                print(f"Resuming {level_dir}: {written.sum()} of {written.size} patches acquired, "
+                      f"{fitted.sum()} fitted")
+
+            def patch_stack(frame_idx, img_stack):
+                # One column per patch: frames showing several patches are demodulated once per carrier
+                sel = np.concatenate([members[f] for f in frame_idx])
+                if len(sel) == len(frame_idx):
+                    return sel, img_stack
+                cols = np.repeat(np.arange(len(frame_idx)), [len(members[f]) for f in frame_idx])
+                return sel, img_stack[..., cols]
+
+            def acquire(f, upcoming=()):
+                # Producer side: display frame f and store its raw camera frame
+                sel = members[f]
+                with prof.stage("upload", level=level, frame=f, patches=patch_ids[sel].tolist()):
+                    if memory is None:
+                        slm_disp_obj.load_phase(frames[f])
+                    else:
+                        slm_disp_obj.display((frames.key, f), frames[f])
+                        # Transfer the next frames while this one is exposed
+                        slm_disp_obj.preload([((frames.key, g), frames[g]) for g in upcoming], background=True)
+                stop = snr_reached(dx[sel], dy[sel]) if target_phase_err is not None else None
+                with prof.stage("exposure", level=level, frame=f):
+                    frame = average_frame(frame_buf, stop)
+                if streaming:
+                    frames_used[sel] = cam_obj.frames_used
+                with prof.stage("store_write", level=level, frame=f):
+                    store.write(f, frame, patch_ids[sel], dx[sel], dy[sel], frames_used[sel[0]])
+                return f
+
+            def consume(_, frame_idx):
+                # Consumer side: fit the frames acquired so far, read back from the store
+                with prof.stage("read_frames", level=level, frames=len(frame_idx)):
+                    img_stack = store.read(frame_idx)
+                if plot_within:
+                    for n, f in enumerate(frame_idx):
+                        show_frame(img_stack[..., n], f"Patch {', '.join(str(i) for i in members[f])}")
+
+                sel, img_stack = patch_stack(frame_idx, img_stack)
+                with prof.stage("fit", level=level, patches=len(sel)):
+                    phi[sel], amp[sel], _, dphi_err[sel] = fitter.fit_stack(
+                        x, y, img_stack, dx[sel], dy[sel]
+                    )
+                fitted[sel] = True
+                with prof.stage("checkpoint", level=level):
+                    checkpoint.save_fit(level, phi=phi, amp=amp, dphi_err=dphi_err, fitted=fitted)
+
+            try:
+                # Frames of an interrupted run that were stored but not fitted
+                pending = np.flatnonzero(frame_written & np.array([not fitted[m].all() for m in members]))
+                for start in range(0, len(pending), store.chunk_frames):
+                    consume(None, list(pending[start:start + store.chunk_frames]))
+
+                # Loop over the remaining frames, fitting while the next one is exposed
+                todo = np.flatnonzero(~frame_written)
+                print(f"Starting measurement loop ({len(todo)} frames, {(~written).sum()} patches)...")
+                run_pipelined(lambda j: acquire(int(todo[j]), todo[j + 1:j + 1 + preload_ahead]), consume,
+                              len(todo), queue_depth=pipeline_depth, max_batch=store.chunk_frames)
+                if memory is not None:
+                    memory.wait()
+
+                if refine_fit:
+                    x_data = np.vstack([np.ravel(g) for g in np.broadcast_arrays(x, y)]).astype(float)
+                    refiner = ft.FitSine(fl, k)
+                    for frame_idx, img_stack in store.iter_chunks(max_frames=8 * store.chunk_frames):
+                        sel, img_stack = patch_stack(frame_idx, img_stack)
+                        with prof.stage("refine_fit", level=level, patches=len(sel)):
+                            popt_sv = refiner.refine_stack(x_data, img_stack, dx[sel], dy[sel], phi[sel],
+                                                           amp[sel], workers=workers)
+                        phi[sel] = popt_sv[:, 0]
+                        amp[sel] = np.abs(popt_sv[:, 1] * popt_sv[:, 2])
+            finally:
+                store.close()
+            return -phi, amp, dphi_err, frames_used
+
+        # Level 0: the uniform roi_n x roi_n grid
+        dphi, amp, dphi_err, frames_used = scan(0, frames, roi_bounds, roi_idxs, roi_groups)
+
+        if refine_levels:
+            # Coarse-to-fine: split apertures where the phase varies quickly or the fit is poor
+            grid = AdaptiveGrid(roi_n, aperture_width, slm_top[roi_idxs[0]], slm_left[roi_idxs[0]])
+            grid.add(0, np.arange(roi_n**2), dphi, amp, dphi_err)
+            ref_bounds = tuple(b[[n_centre]] for b in slm_idx)
+            for level in range(1, refine_levels + 1):
+                cells = grid.refine(level - 1, refine_step, refine_err)
+                if cells.size == 0:
+                    break
+                print(f"Refining level {level}: {cells.size} apertures of {aperture_width // 2 ** level} px")
+                bounds = grid.bounds(level, cells)
+                groups = frame_groups(bounds, aperture_width // 2 ** level)
+                with prof.stage("compose_frames", level=level):
+                    level_frames = PatchSequence.build(
+                        phase_gen.get_composer((res_y, res_x)), slm_phase,
+                        tuple(np.append(b, r) for b, r in zip(bounds, ref_bounds)), cells.size, groups,
+                        static=phase_gen.static_components((res_y, res_x)), cache_dir=frame_cache_dir,
+                    )
+                grid.add(level, cells, *scan(level, level_frames, bounds, cells, groups)[:3])
+
+            np.savez(os.path.join(save_dir, "apertures.npz"),
+                     **{f"{name}_L{level}": arr for level, values in grid.levels.items()
+                        for name, arr in zip(("cells", "dphi", "amplitude", "dphi_err"), values)})
+            dphi, amp, dphi_err = grid.resample(refine_levels)
+        else:
+            dphi = dphi.reshape(roi_n, roi_n)
+            amp = amp.reshape(roi_n, roi_n)
+            dphi_err = dphi_err.reshape(roi_n, roi_n)
+
+        # Full-resolution correction, added to the one displayed during the scan
+        cell = aperture_width / 2 ** refine_levels
+        with prof.stage("reconstruct"):
+            correction = build_correction(dphi, amp, (res_y, res_x), slm_top[roi_idxs[0]],
+                                          slm_left[roi_idxs[0]], cell, sigma=smooth_sigma)
+            if use_correction and phase_gen.correction_phase is not None:
+                correction += phase_gen.correction_phase
+                np.mod(correction, 1, out=correction)
+            corr_frame = correction_frame(correction, phase_gen.mod_depth, phase_gen.get_composer((res_y, res_x)))
+        self.correction_phase = correction
+        phase_gen.correction_phase = correction
+
+        # Zernike decomposition; the coefficients add up over closed-loop runs on the same pupil
+        record = None
+        if zernike_order and dphi.size >= len(zernike_modes(zernike_order)):
+            with prof.stage("zernike"):
+                basis = get_basis(dphi.shape, slm_top[roi_idxs[0]], slm_left[roi_idxs[0]], cell, zernike_order)
+                coeffs = basis.fit(unwrap_phase(dphi), amp)
+                previous = self.zernike
+                if (use_correction and previous is not None and previous["order"] == basis.order
+                        and previous["center"] == list(basis.center) and previous["radius"] == basis.radius):
+                    coeffs = coeffs + np.asarray(previous["coeffs"])
+                record = basis.record(coeffs)
+        elif zernike_order:
+            print(f"Too few apertures for Zernike order {zernike_order}; decomposition skipped")
+        self.zernike = record
+
+        # Save results, in the background unless background_save is off
+        results = {
+            "correction_phase": correction,
+            "correction_frame": corr_frame,
+            "dphi": dphi,
+            "amplitude": amp,
+            "dphi_err": dphi_err,
+            "frames_used": frames_used.reshape(roi_n, roi_n),
+        }
+        figures = [("phase_map.png", dphi, "Retrieved Phase Map", 'magma'),
+                   ("intensity_map.png", amp, "Retrieved Intensity (a*b)", 'inferno')] if plots else []
+        write = self.writer.save if background_save else save_array
+        draw = self.writer.figure if background_save else save_figure
+        for name, arr in results.items():
+            write(os.path.join(save_dir, name + ".npy"), arr)
+        for name, *args in figures:
+            draw(os.path.join(save_dir, name), *args)
+        if record is not None:
+            if background_save:
+                self.writer.submit(save_record, os.path.join(save_dir, "zernike.json"), record)
+            else:
+                save_record(os.path.join(save_dir, "zernike.json"), record)
+
+        print(prof.table())
+        trace_path = os.path.join(save_dir, "timing_trace.json")
+        result_paths = [os.path.join(save_dir, name + ".npy") for name in results]
+
+        def finish():
+            # Only a run whose results are on disk is complete; until then it can be resumed
+            if not all(os.path.exists(path) for path in result_paths):
+                return
+            checkpoint.mark_complete()
+            if not sv_data:
+                for level_dir in level_dirs:
+                    shutil.rmtree(level_dir, ignore_errors=True)
+
+        if background_save:
+            self.writer.submit(save_trace, trace_path, prof.chrome_trace())
+            self.writer.submit(finish)
+        else:
+            save_trace(trace_path, prof.chrome_trace())
+            finish()
+        return save_dir
 
-            cam_obj.take_average_image(num_frames)
-            img_stack[..., i] = cam_obj.last_frame - bckgr
-
-            if plot_within:
-                plt.imshow(img_stack[..., i], cmap='inferno')
-                plt.title(f"Patch {i}")
-                plt.colorbar()
-                plt.pause(0.3)
-                plt.clf()
-
-        # Fit retrieved phase
-        print("Fitting phase data...")
-        fit_sine = ft.FitSine(fl, k)
-        popt_sv = []
-
-        x, y = make_grid(img_stack[..., 0], scale=cam_obj.pitch)
-        x_data = np.vstack((x.ravel(), y.ravel()))
-
-        for i, idx in enumerate(roi_idxs):
-            dx = (slm_idx[2][idx] - slm_idx[2][n_centre]) * slm_pitch
-            dy = (slm_idx[0][idx] - slm_idx[0][n_centre]) * slm_pitch
-            fit_sine.set_dx_dy(dx, dy)
-
-            a_guess = np.sqrt(np.max(img_stack[..., i])) / 2
-            p0 = [0, a_guess, a_guess]
-            bounds = ([-np.pi, 0, 0], [np.pi, 2 * a_guess, 2 * a_guess])
-            popt, _ = ft.safe_fit(fit_sine.fit_sine, x_data, img_stack[..., i].ravel(), p0, bounds)
-            popt_sv.append(popt)
-
-        popt_sv = np.array(popt_sv)
-        dphi = -popt_sv[:, 0].reshape(roi_n, roi_n)
-        amp = np.abs(popt_sv[:, 1] * popt_sv[:, 2]).reshape(roi_n, roi_n)
-
-        # Save results
-        np.save(os.path.join(save_dir, "dphi.npy"), dphi)
-        np.save(os.path.join(save_dir, "amplitude.npy"), amp)
-
-        plt.imshow(dphi, cmap='magma')
-        plt.title("Retrieved Phase Map")
-        plt.colorbar()
-        plt.savefig(os.path.join(save_dir, "phase_map.png"))
-        plt.close()
-
-        plt.imshow(amp, cmap='inferno')
-        plt.title("Retrieved Intensity (a*b)")
-        plt.colorbar()
-        plt.savefig(os.path.join(save_dir, "intensity_map.png"))
-        plt.close()
+    def wait_for_results(self, timeout=None):
+        """
+        Wait until the result files of previous measurements are written.
+
+        Args:
+            timeout (float): Maximum wait [s]; None waits indefinitely.
+
+        Returns:
+            bool: True once all files are written, False on timeout.
+        """
+        return self.writer.wait(timeout)
 
     def _get_aperture_indices(self, n_ap_x, n_ap_y, x_min, x_max, y_min, y_max, dx, dy):
         """
         Computes ROI pixel bounds for a grid of patches.
+
+        Returns:
+            tuple: (top, bottom, left, right) index arrays, see aperture_bounds.
         """
-        patch_start_x = [int(x_min + i * dx) for i in range(n_ap_x)]
-        patch_end_x = [x + dx for x in patch_start_x]
-        patch_start_y = [int(y_min + i * dy) for i in range(n_ap_y)]
-        patch_end_y = [y + dy for y in patch_start_y]
-
-        patch_top = []
-        patch_bot = []
-        patch_left = []
-        patch_right = []
-
-        for i in patch_start_y:
-            for j in patch_start_x:
-                patch_top.append(i)
-                patch_bot.append(i + dy)
-                patch_left.append(j)
-                patch_right.append(j + dx)
-
-        return patch_top, patch_bot, patch_left, patch_right
+        return aperture_bounds(n_ap_x, n_ap_y, x_min, y_min, dx, dy)
@@ -0,0 +1,280 @@
+"""
+Zernike decomposition of retrieved dphi grids and synthesis of corrections.
+
+Zernike polynomials Z_n^m (OSA / ANSI order, j = (n(n+2)+m)/2; cos for m > 0,
+sin for m < 0) are normalized to unit RMS over the unit disk. Every Z_n^m is a
+polynomial in x and y, so a mode is stored as its (order+1) x (order+1)
+monomial coefficient matrix P with Z = sum P[q, p] x^p y^q. Evaluated on a
+rectangular set of points, a combination of modes is then Vy @ C @ Vx.T, with
+C = sum c_j P_j and the Vandermonde matrices Vy (rows) and Vx (columns): the
+full-resolution correction of an SLM frame is two thin matrix products instead
+of an interpolation over the whole SLM.
+
+ZernikeBasis samples the modes at the aperture centres of a dphi grid and
+orthonormalizes them on the points inside the pupil (QR), which keeps the
+amplitude-weighted fit well conditioned; the fit is a single least-squares solve
+and its result is mapped back to Zernike coefficients. Bases are cached per
+(grid shape, aperture geometry, pupil, order) in a bounded LRU cache
+(get_basis). A decomposition is stored as a small JSON record (order, pupil,
+coefficients) from which the correction is rebuilt for any frame shape.
+
+Author: Dimitrios Karanikolopoulos
+"""
+
+import json
+from functools import lru_cache
+from math import comb, factorial
+
+import numpy as np
+from scipy.linalg import solve_triangular
+
+# Bound of the basis cache (distinct grid / pupil / order combinations)
+ZERNIKE_CACHE_SIZE = 8
+
+
+def zernike_modes(order):
+    """
+    (n, m) of all modes up to radial order, in OSA / ANSI order.
+
+    Args:
+        order (int): Highest radial order n.
+
+    Returns:
+        list: (n, m) tuples; mode j is at index j.
+    """
+    return [(n, m) for n in range(order + 1) for m in range(-n, n + 1, 2)]
+
+
+def _polymul(a, b):
+    """Product of two 2D monomial coefficient arrays a[q, p] (x^p y^q)."""
+    out = np.zeros((a.shape[0] + b.shape[0] - 1, a.shape[1] + b.shape[1] - 1))
+    for (q, p), coef in np.ndenumerate(a):
+        if coef:
+            out[q:q + b.shape[0], p:p + b.shape[1]] += coef * b
+    return out
+
+
+def _mode_polynomial(n, m, size):
+    """Monomial coefficients of the RMS-normalized Z_n^m, padded to size x size."""
+    am = abs(m)
+    # rho^|m| cos(|m| theta) = Re (x + iy)^|m|, rho^|m| sin(|m| theta) = Im (x + iy)^|m|
+    angular = np.zeros((am + 1, am + 1))
+    for t in range(am + 1):
+        if (t % 2 == 0) == (m >= 0):
+            angular[t, am - t] = comb(am, t) * (-1) ** (t // 2)
+    poly = np.zeros((size, size))
+    for k in range((n - am) // 2 + 1):
+        coef = (-1) ** k * factorial(n - k) / (
+            factorial(k) * factorial((n + am) // 2 - k) * factorial((n - am) // 2 - k))
+        s = (n - am) // 2 - k
+        radial = np.zeros((2 * s + 1, 2 * s + 1))  # (x^2 + y^2)^s
+        for u in range(s + 1):
+            radial[2 * u, 2 * (s - u)] = comb(s, u)
+        term = coef * _polymul(radial, angular)
+        poly[:term.shape[0], :term.shape[1]] += term
+    return poly * np.sqrt((2 - (m == 0)) * (n + 1))
+
+
+@lru_cache(maxsize=None)
+def mode_polynomials(order):
+    """
+    Monomial coefficients of all modes up to order.
+
+    Returns:
+        np.ndarray: Read-only (n_modes, order+1, order+1) array P with
+            Z_j = sum P[j, q, p] x^p y^q.
+    """
+    polys = np.stack([_mode_polynomial(n, m, order + 1) for n, m in zernike_modes(order)])
+    polys.flags.writeable = False
+    return polys
+
+
+def _vandermonde(coords, order):
+    return np.asarray(coords, dtype=float)[:, None] ** np.arange(order + 1)
+
+
+def synthesize(coeffs, shape, center, radius, mask=True):
+    """
+    Phase of a Zernike combination on a full frame, as Vy @ C @ Vx.T.
+
+    Args:
+        coeffs (np.ndarray): Coefficients in OSA order [rad]; the order follows from their number.
+        shape (tuple): (height, width) of the frame [px].
+        center (tuple): (row, col) of the pupil centre [px].
+        radius (float): Pupil radius [px].
+        mask (bool): Set pixels outside the pupil to 0 instead of extrapolating.
+
+    Returns:
+        np.ndarray: float32 phase [rad].
+    """
+    coeffs = np.asarray(coeffs, dtype=float)
+    order = int(round((np.sqrt(8 * len(coeffs) + 1) - 3) / 2))
+    if len(zernike_modes(order)) != len(coeffs):
+        raise ValueError(f"{len(coeffs)} coefficients do not fill a radial order")
+    y = (np.arange(shape[0]) + 0.5 - center[0]) / radius
+    x = (np.arange(shape[1]) + 0.5 - center[1]) / radius
+    c = np.tensordot(coeffs, mode_polynomials(order), axes=1).astype(np.float32)
+    vy = _vandermonde(y, order).astype(np.float32)
+    vx = _vandermonde(x, order).astype(np.float32)
+    phase = vy @ c @ vx.T
+    if mask:
+        # Pupil chord of every row as a column range, so no H x W radius map is needed
+        half = np.sqrt(np.clip(1 - y ** 2, 0, None))
+        lo = np.searchsorted(x, -half, side="left")
+        hi = np.where(np.abs(y) <= 1, np.searchsorted(x, half, side="right"), lo)
+        cols = np.arange(shape[1])
+        phase *= (cols >= lo[:, None]) & (cols < hi[:, None])
+    return phase
+
+
+def zernike_correction(coeffs, shape, center, radius, mask=True):
+    """
+    Correction cancelling a Zernike phase, in units of 2*pi wrapped to [0, 1).
+
+    Same convention as reconstruction.build_correction; arguments as synthesize().
+
+    Returns:
+        np.ndarray: float32 correction.
+    """
+    full = synthesize(coeffs, shape, center, radius, mask)
+    full *= np.float32(-1 / (2 * np.pi))
+    # x - floor(x) wraps like np.mod(x, 1), which is an order of magnitude slower on float32
+    full -= np.floor(full)
+    return full
+
+
+class ZernikeBasis:
+    """
+    Zernike modes sampled at the aperture centres of a dphi grid, orthonormalized.
+
+    Attributes:
+        grid_shape (tuple): (rows, cols) of the dphi grid.
+        order (int): Highest radial order.
+        modes (list): (n, m) of each mode.
+        center (tuple): (row, col) of the pupil centre [SLM px].
+        radius (float): Pupil radius [SLM px].
+        samples (np.ndarray): (rows*cols, n_modes) mode values at the cell centres.
+        inside (np.ndarray): Cells whose centre lies in the pupil (grid_shape).
+        q (np.ndarray): Orthonormal basis of samples[inside] (QR).
+        r (np.ndarray): Upper-triangular factor, samples[inside] = q @ r.
+    """
+
+    def __init__(self, grid_shape, top, left, cell, order=6, center=None, radius=None):
+        """
+        Args:
+            grid_shape (tuple): (rows, cols) of the dphi grid.
+            top (float): First SLM row of the grid [px].
+            left (float): First SLM column of the grid [px].
+            cell (float): Aperture width of the grid [px].
+            order (int): Highest radial order (order 6: 28 modes).
+            center (tuple): (row, col) of the pupil [px]; the grid centre if None.
+            radius (float): Pupil radius [px]; the half diagonal of the grid if None,
+                so the pupil covers every aperture.
+
+        Raises:
+            ValueError: If fewer apertures than modes lie in the pupil.
+        """
+        rows, cols = self.grid_shape = tuple(grid_shape)
+        self.order = order
+        self.modes = zernike_modes(order)
+        if center is None:
+            center = (top + rows * cell / 2, left + cols * cell / 2)
+        if radius is None:
+            radius = np.hypot(rows * cell, cols * cell) / 2
+        self.center = (float(center[0]), float(center[1]))
+        self.radius = float(radius)
+
+        y = (top + (np.arange(rows) + 0.5) * cell - self.center[0]) / self.radius
+        x = (left + (np.arange(cols) + 0.5) * cell - self.center[1]) / self.radius
+        vy, vx = _vandermonde(y, order), _vandermonde(x, order)
+        self.samples = np.einsum("iq,jqp,kp->ikj", vy, mode_polynomials(order), vx).reshape(rows * cols, -1)
+        self.inside = (y[:, None] ** 2 + x[None, :] ** 2) <= 1 + 1e-12
+        if np.count_nonzero(self.inside) < len(self.modes):
+            raise ValueError(f"{np.count_nonzero(self.inside)} apertures in the pupil cannot fit "
+                             f"{len(self.modes)} modes; lower the order")
+        self.q, self.r = np.linalg.qr(self.samples[self.inside.ravel()])
+        for arr in (self.samples, self.inside, self.q, self.r):
+            arr.flags.writeable = False
+
+    def fit(self, phase, weights=None):
+        """
+        Zernike coefficients of a phase grid in one weighted least-squares solve.
+
+        The fit is solved in the orthonormalized basis and mapped back with r.
+
+        Args:
+            phase (np.ndarray): Unwrapped phase per aperture [rad] (grid_shape).
+            weights (np.ndarray): Non-negative weights, e.g. the retrieved amplitude;
+                uniform if None.
+
+        Returns:
+            np.ndarray: Coefficients in OSA order [rad RMS over the pupil].
+        """
+        sel = self.inside.ravel()
+        values = np.asarray(phase, dtype=float).ravel()[sel]
+        if weights is None:
+            sw = np.ones_like(values)
+        else:
+            sw = np.sqrt(np.clip(np.asarray(weights, dtype=float).ravel()[sel], 0, None))
+        c_q = np.linalg.lstsq(sw[:, None] * self.q, sw * values, rcond=None)[0]
+        return solve_triangular(self.r, c_q)
+
+    def evaluate(self, coeffs):
+        """Phase of a combination at the cell centres [rad] (grid_shape), 0 outside the pupil."""
+        grid = (self.samples @ np.asarray(coeffs, dtype=float)).reshape(self.grid_shape)
+        return np.where(self.inside, grid, 0.0)
+
+    def synthesize(self, coeffs, shape=(1024, 1272), mask=True):
+        """Full-resolution phase of a combination [rad], see synthesize()."""
+        return synthesize(coeffs, shape, self.center, self.radius, mask)
+
+    def record(self, coeffs):
+        """JSON-serializable decomposition: order, pupil, modes and coefficients."""
+        return {"order": self.order, "center": list(self.center), "radius": self.radius,
+                "modes": [list(mode) for mode in self.modes], "coeffs": np.asarray(coeffs, dtype=float).tolist()}
+
+
+@lru_cache(maxsize=ZERNIKE_CACHE_SIZE)
+def _cached_basis(grid_shape, top, left, cell, order, center, radius):
+    return ZernikeBasis(grid_shape, top, left, cell, order, center, radius)
+
+
+def get_basis(grid_shape, top, left, cell, order=6, center=None, radius=None):
+    """
+    Shared ZernikeBasis of a grid geometry, built once (LRU cache of ZERNIKE_CACHE_SIZE).
+
+    Arguments as ZernikeBasis.
+    """
+    center = None if center is None else (float(center[0]), float(center[1]))
+    radius = None if radius is None else float(radius)
+    return _cached_basis(tuple(int(n) for n in grid_shape), float(top), float(left), float(cell), int(order),
+                         center, radius)
+
+
+def clear_basis_cache():
+    """Drop all cached bases."""
+    _cached_basis.cache_clear()
+
+
+def save_record(path, record):
+    """Write a ZernikeBasis.record() as JSON."""
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+
+
+def correction_from_record(record, shape=(1024, 1272), mask=True):
+    """
+    Correction frame rebuilt from a stored decomposition.
+
+    Args:
+        record (dict or str): ZernikeBasis.record() or the path of its JSON file.
+        shape (tuple): (height, width) of the frame [px].
+        mask (bool): Zero correction outside the pupil.
+
+    Returns:
+        np.ndarray: float32 correction in units of 2*pi, wrapped to [0, 1).
+    """
+    if isinstance(record, str):
+        with open(record) as f:
+            record = json.load(f)
+    return zernike_correction(record["coeffs"], shape, record["center"], record["radius"], mask)
@@ -0,0 +1,368 @@
+# simulation/simulated_bench.py
+
+import time
+import numpy as np
+import scipy.fft as sfft
+
+from function_scripts.averaging import FrameAverager, spot_window
+from function_scripts.settle_calibration import update_settle_time
+from slm.frame_memory import FrameMemory
+
+__author__ = "Dimitrios Karanikolopoulos"
+
+
+class SimulatedSlm:
+    """
+    Drop-in stand-in for SlmHamamatsu without hardware.
+
+    Keeps the last uploaded uint8 frame so a SimulatedCamera can image it, and
+    converts grey levels to phase with mod_depth (level mod_depth = 2*pi).
+    With response_time > 0 the liquid crystal relaxes exponentially from the
+    previous frame to the new one, so images taken right after an upload show
+    a mix of both (see settle_calibration). With frame_slots > 0 it emulates the
+    frame memory of SlmHamamatsu (display, preload).
+
+    Attributes:
+        res (list): [height, width] in pixels.
+        pitch (float): Pixel pitch [m].
+        mod_depth (int): Grey level of a 2*pi phase shift.
+        settle_time (float): Wait after each upload [s], as in SlmHamamatsu.
+        response_time (float): Time constant of the liquid-crystal response [s].
+        head_temp (float): Head temperature reported by check_temp [degC].
+        serial (str): Device serial used for settle-time calibrations.
+        settle_store (SettleStore): Calibrated settle times, see update_settle_time.
+        displayed (np.ndarray): Frame currently shown on the SLM (uint8).
+        uploads (int): Number of load_phase calls.
+        slot_writes (int): Frames written to frame-memory slots.
+        switches (int): Slot switches.
+        frame_memory (FrameMemory): Slot cache, None without frame_slots.
+        profiler (StageProfiler): Receives slm.upload / slm.settle records if set.
+    """
+
+    def __init__(self, res=(1024, 1272), pitch=12.5e-6, mod_depth=198, settle_time=0.0, response_time=0.0,
+                 head_temp=30.0, settle_store=None, frame_slots=0, serial="simulated"):
+        self.slmY, self.slmX = res
+        self.res = [self.slmY, self.slmX]
+        self.pitch = pitch
+        self.slm_size = self.pitch * np.asarray(self.res)
+        self.mod_depth = mod_depth
+        self.settle_time = settle_time
+        self.default_settle_time = settle_time
+        self.response_time = response_time
+        self.head_temp = head_temp
+        self.serial = serial
+        self.settle_store = settle_store
+        self.displayed = np.zeros((self.slmY, self.slmX), dtype=np.uint8)
+        self._previous = self.displayed
+        self._upload_end = 0.0
+        self.uploads = 0
+        self.slot_writes = 0
+        self.switches = 0
+        self._slot_frames = {}
+        self.frame_memory = FrameMemory(self._write_slot, self._switch_slot, frame_slots) if frame_slots else None
+        self.bID = 1
+        self.profiler = None
+
+    def connect(self) -> int:
+        return self.bID
+
+    def check_temp(self) -> tuple[float, float]:
+        return self.head_temp, self.head_temp + 5.0
+
+    def update_settle_time(self, max_temp_delta=2.0) -> float:
+        """Use the settle time calibrated for the current temperature, if any."""
+        return update_settle_time(self, max_temp_delta)
+
+    def close(self) -> None:
+        pass
+
+    def load_phase(self, image: np.ndarray) -> None:
+        """
+        Display a 2D phase pattern (uint8).
+
+        Args:
+            image (np.ndarray): Phase array, values in [0, 255].
+        """
+        t0 = time.perf_counter()
+        self._show(np.asarray(image).astype(np.uint8).reshape(self.slmY, self.slmX))
+        self.uploads += 1
+        if self.frame_memory is not None:
+            self.frame_memory.displayed = 0
+        self._settle(t0, "slm.upload")
+
+    def _show(self, frame):
+        if self.response_time > 0:
+            self._previous = self._levels()
+        self.displayed = frame
+        self._upload_end = time.perf_counter()
+
+    def _settle(self, t0, stage):
+        t1 = time.perf_counter()
+        if self.settle_time > 0:
+            time.sleep(self.settle_time)
+        if self.profiler is not None:
+            self.profiler.record(stage, t0, t1 - t0)
+            self.profiler.record("slm.settle", t1, time.perf_counter() - t1)
+
+    def _write_slot(self, slot, image):
+        self._slot_frames[slot] = np.asarray(image).astype(np.uint8).reshape(self.slmY, self.slmX)
+        self.slot_writes += 1
+
+    def _switch_slot(self, slot):
+        self._show(self._slot_frames[slot])
+        self.switches += 1
+
+    def display(self, key, image=None) -> bool:
+        """Display a frame from frame memory, like SlmHamamatsu.display."""
+        t0 = time.perf_counter()
+        _, written = self.frame_memory.show(key, image)
+        self._settle(t0, "slm.upload" if written else "slm.switch")
+        return written
+
+    def preload(self, items, background=False) -> None:
+        """Write (key, image) pairs into frame memory, like SlmHamamatsu.preload."""
+        self.frame_memory.preload(items, background)
+
+    @property
+    def settling(self) -> bool:
+        """True while the liquid crystal is still visibly moving (within 15 time constants)."""
+        return self.response_time > 0 and time.perf_counter() - self._upload_end < 15 * self.response_time
+
+    def _levels(self):
+        # Grey levels the liquid crystal is at now (fractional while settling)
+        if not self.settling:
+            return self.displayed
+        done = 1 - np.exp(-(time.perf_counter() - self._upload_end) / self.response_time)
+        return self._previous + done * (self.displayed - np.asarray(self._previous, dtype=np.float32))
+
+    def phase(self) -> np.ndarray:
+        """Return the displayed phase [rad]."""
+        return self._levels() * (2 * np.pi / self.mod_depth)
+
+
+class SimulatedShutter:
+    """Drop-in stand-in for the Thorlabs SC10 shutter."""
+
+    def __init__(self):
+        self.is_open = False
+
+    def shutter_enable(self, enable=True):
+        self.is_open = bool(enable)
+
+
+class SimulatedCamera:
+    """
+    Drop-in stand-in for the ORCA camera imaging the SLM through a lens.
+
+    The focal plane is modelled as the Fourier transform of the SLM field
+        E = A(x, y) * exp(i * (phase_slm + aberration))
+    zero-padded to n_fft points. The camera window is centred on the first
+    diffraction order of the measurement grating (period grating_period along x).
+    Its pixel pitch is the focal-plane sampling wavelength * fl / (n_fft * slm_pitch),
+    so fringes follow the same carrier as the FitSine model.
+
+    Like the ORCA, the camera can read out a subarray of the sensor and bin pixels;
+    average_into() streams exposures through a running mean into a caller-owned
+    buffer. Readout time scales with the number of subarray rows.
+
+    Attributes:
+        slm (SimulatedSlm): SLM whose displayed frame is imaged.
+        shutter (SimulatedShutter): Optional shutter; a closed shutter gives dark frames.
+        aberration (np.ndarray): Ground-truth SLM phase error [rad] (res_y x res_x).
+        roi_shape (tuple): Full sensor (height, width) in pixels.
+        subarray (tuple): (top, left, height, width) of the read-out sensor region.
+        binning (int): Software binning of the read-out region.
+        frame_shape (tuple): (height, width) of the delivered frames.
+        pitch (float): Pixel pitch of the delivered frames as used by helpers.make_grid [m].
+        noise (float): Standard deviation of additive read noise [counts].
+        frame_time (float): Simulated exposure latency per frame [s].
+        readout_time (float): Simulated readout latency of a full-sensor frame [s].
+        peak_counts (float): Counts of the brightest pixel of a single patch spot.
+    """
+
+    def __init__(self, slm, shutter=None, aberration=None, beam_waist=None, wavelength=752e-9, fl=0.3,
+                 n_fft=2048, roi_shape=(300, 300), grating_period=40, noise=0.0, frame_time=0.0,
+                 readout_time=0.0, peak_counts=1000.0, seed=None):
+        self.slm = slm
+        self.shutter = shutter
+        self.wavelength = wavelength
+        self.fl = fl
+        self.n_fft = n_fft
+        self.roi_shape = tuple(roi_shape)
+        self.noise = noise
+        self.frame_time = frame_time
+        self.readout_time = readout_time
+        self.rng = np.random.default_rng(seed)
+
+        self.exposure = 0.0
+        self.num = 1
+        self.last_frame = np.zeros(self.roi_shape)
+
+        res_y, res_x = slm.res
+        if aberration is None:
+            aberration = np.zeros((res_y, res_x))
+        self.aberration = np.asarray(aberration, dtype=float)
+
+        # Illumination: Gaussian beam centred on the SLM, flat if beam_waist is None
+        yy, xx = np.indices((res_y, res_x), dtype=float)
+        r2 = ((xx - (res_x - 1) / 2) ** 2 + (yy - (res_y - 1) / 2) ** 2) * slm.pitch ** 2
+        self.amplitude = np.ones((res_y, res_x)) if beam_waist is None else np.exp(-r2 / beam_waist ** 2)
+
+        # The camera is centred on the first diffraction order of the grating, with the
+        # window centre at pixel (h - 1) / 2, (w - 1) / 2 like helpers.make_grid. Sub-bin
+        # offsets are applied as a linear phase ramp on the SLM (Fourier shift theorem).
+        h, w = self.roi_shape
+        start_y = 0 - (h - 1) / 2
+        start_x = n_fft / grating_period - (w - 1) / 2
+        frac_y, frac_x = start_y - np.floor(start_y), start_x - np.floor(start_x)
+        self._rows = (int(np.floor(start_y)) + np.arange(h)) % n_fft
+        self._cols = (int(np.floor(start_x)) + np.arange(w)) % n_fft
+        ramp = np.exp(-2j * np.pi * (frac_x * xx + frac_y * yy) / n_fft)
+        self._static_field = (self.amplitude * ramp * np.exp(1j * self.aberration)).astype(np.complex64)
+
+        # helpers.make_grid spans w - 1 steps over 2 * (w // 2) pixels; compensate so
+        # the grid step equals the focal-plane sampling
+        self._step = wavelength * fl / (n_fft * slm.pitch)
+
+        # Scale so that a single 64 x 64 patch peaks near peak_counts
+        self.peak_counts = peak_counts
+        self._scale = peak_counts / (64 * 64) ** 2
+        self._cache_key = None
+        self._cache_img = None
+
+        self.subarray = (0, 0) + self.roi_shape
+        self.binning = 1
+        self._averager = FrameAverager(self.roi_shape)
+
+    @property
+    def frame_shape(self):
+        return self._averager.out_shape
+
+    @property
+    def pitch(self):
+        # helpers.make_grid spans w - 1 steps over 2 * (w // 2) pixels; compensate so
+        # the grid step equals the (binned) focal-plane sampling
+        w = self.frame_shape[1]
+        return self._step * self.binning * (w - 1) / (2 * (w // 2))
+
+    def set_subarray(self, top=0, left=0, height=None, width=None):
+        """
+        Read out only a region of the sensor.
+
+        Args:
+            top (int): First sensor row.
+            left (int): First sensor column.
+            height (int): Rows, defaults to the rest of the sensor.
+            width (int): Columns, defaults to the rest of the sensor.
+        """
+        height = self.roi_shape[0] - top if height is None else height
+        width = self.roi_shape[1] - left if width is None else width
+        if top < 0 or left < 0 or top + height > self.roi_shape[0] or left + width > self.roi_shape[1]:
+            raise ValueError(f"Subarray {(top, left, height, width)} exceeds the sensor {self.roi_shape}")
+        self.subarray = (int(top), int(left), int(height), int(width))
+        self._averager = FrameAverager((height, width), self.binning)
+        self.last_frame = np.zeros(self.frame_shape)
+
+    def set_binning(self, binning=1):
+        """Bin binning x binning pixels of every frame."""
+        self.binning = int(binning)
+        self._averager = FrameAverager(self.subarray[2:], self.binning)
+        self.last_frame = np.zeros(self.frame_shape)
+
+    def centre_subarray(self, shape=None, background=None):
+        """
+        Centre a subarray of the given (height, width) on the current spot.
+
+        Takes one full-sensor frame of what is displayed now. shape=None restores
+        the full sensor.
+
+        Args:
+            shape (tuple): (height, width) of the subarray in sensor pixels.
+            background (np.ndarray): Full-sensor frame without the spot, subtracted
+                before locating it (removes zero-order light).
+
+        Returns:
+            tuple: The new subarray (top, left, height, width).
+        """
+        self.set_subarray()
+        if shape is not None:
+            frame = self.grab_frame()
+            if background is not None:
+                frame = frame - background
+            top, left = spot_window(frame, shape)
+            self.set_subarray(top, left, *shape)
+        return self.subarray
+
+    def prep_acq(self):
+        pass
+
+    def grab_frame(self) -> np.ndarray:
+        """
+        Expose and read out one frame of the current subarray (unbinned).
+
+        Returns:
+            np.ndarray: Noisy frame [counts] (float32).
+        """
+        if self.frame_time > 0:
+            time.sleep(self.frame_time)
+        top, left, h, w = self.subarray
+        if self.readout_time > 0:
+            time.sleep(self.readout_time * h / self.roi_shape[0])
+        frame = self.ideal_image()[top:top + h, left:left + w].astype(np.float32)
+        if self.noise > 0:
+            frame += self.noise * self.rng.standard_normal((h, w), dtype=np.float32)
+        return frame
+
+    def average_into(self, out, num_frames, stop=None, min_frames=2):
+        """
+        Average num_frames exposures into a caller-owned buffer with a running mean.
+
+        Args:
+            out (np.ndarray): Array of frame_shape to write into.
+            num_frames (int): Number of frames to average (maximum if stop is given).
+            stop (callable): Early-stopping criterion, see FrameAverager.average.
+            min_frames (int): Frames taken before stop is consulted.
+
+        Returns:
+            np.ndarray: out.
+        """
+        return self._averager.average(self.grab_frame, num_frames, out=out, stop=stop, min_frames=min_frames)
+
+    @property
+    def frames_used(self):
+        """Number of frames averaged by the last average_into call."""
+        return self._averager.n_frames
+
+    def ideal_image(self) -> np.ndarray:
+        """
+        Noise-free camera image of the currently displayed SLM frame.
+
+        Returns:
+            np.ndarray: Intensity in the camera window [counts].
+        """
+        if self.shutter is not None and not self.shutter.is_open:
+            return np.zeros(self.roi_shape)
+
+        key = (id(self.slm.displayed), self.slm.uploads)
+        settling = getattr(self.slm, "settling", False)
+        if key == self._cache_key and not settling:
+            return self._cache_img
+
+        field = self._static_field * np.exp(1j * self.slm.phase().astype(np.float32))
+        far = sfft.fft2(field, s=(self.n_fft, self.n_fft), workers=-1)
+        img = np.abs(far[np.ix_(self._rows, self._cols)]) ** 2 * self._scale
+
+        if not settling:
+            self._cache_key = key
+            self._cache_img = img
+        return img
+
+    def take_average_image(self, num_frames):
+        """
+        Average num_frames noisy exposures into a new last_frame.
+
+        Args:
+            num_frames (int): Number of frames to average.
+        """
+        self.last_frame = self.average_into(np.empty(self.frame_shape), num_frames)
+        return self.last_frame
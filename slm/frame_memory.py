@@ -0,0 +1,180 @@
+# slm/frame_memory.py
+
+import threading
+from collections import OrderedDict, deque
+
+__author__ = "Dimitrios Karanikolopoulos"
+
+
+class FrameMemory:
+    """
+    LRU cache of frames held in the numbered frame-memory slots of an SLM.
+
+    Frames are identified by a hashable key (e.g. (PatchSequence.key, frame)).
+    load() writes a frame into a free slot, or into the least recently used one
+    when all slots are taken, unless it is cached already; show() switches the
+    display to the slot of a key. preload(..., background=True) queues writes
+    for a worker thread, so frames can be transferred while the camera exposes
+    the one on display. Device calls are serialized by a lock, so a show()
+    waits for a write in progress but never for queued ones.
+
+    Slot numbers start at first_slot; slot 0 is left to SlmHamamatsu.load_phase.
+    The displayed slot is never evicted. Preloading more frames ahead than
+    n_slots - 1 evicts frames before they are shown, so keep the look-ahead
+    below that.
+
+    Attributes:
+        n_slots (int): Number of slots managed.
+        first_slot (int): Number of the first managed slot.
+        displayed (int): Slot on display, None before the first show().
+        writes (int): Frames written so far.
+        hits (int): load() calls served from the cache.
+    """
+
+    def __init__(self, write, switch, n_slots, first_slot=1):
+        """
+        Args:
+            write (callable): write(slot, image) transfers a frame into a slot.
+            switch (callable): switch(slot) displays a slot.
+            n_slots (int): Number of slots managed.
+            first_slot (int): Number of the first managed slot.
+        """
+        if n_slots < 2:
+            raise ValueError(f"FrameMemory needs at least 2 slots, got {n_slots}")
+        self._write = write
+        self._switch = switch
+        self.n_slots = n_slots
+        self.first_slot = first_slot
+        self.displayed = None
+        self.writes = 0
+        self.hits = 0
+        self._slots = OrderedDict()  # key -> slot, least recently used first
+        self._lock = threading.RLock()
+        self._cond = threading.Condition()
+        self._jobs = deque()
+        self._thread = None
+        self._error = None
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._slots
+
+    def slot_of(self, key):
+        """Slot holding key, or None."""
+        with self._lock:
+            return self._slots.get(key)
+
+    def _free_slot(self):
+        used = set(self._slots.values())
+        for slot in range(self.first_slot, self.first_slot + self.n_slots):
+            if slot not in used:
+                return slot
+        for key, slot in self._slots.items():
+            if slot != self.displayed:
+                del self._slots[key]
+                return slot
+        raise RuntimeError("No frame-memory slot can be evicted")
+
+    def load(self, key, image=None):
+        """
+        Make sure a frame is in a slot.
+
+        Args:
+            key: Hashable frame identifier.
+            image (np.ndarray): The frame; only needed if key is not cached.
+
+        Returns:
+            Tuple[int, bool]: The slot and whether the frame had to be written.
+
+        Raises:
+            KeyError: If key is not cached and no image is given.
+        """
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._slots.move_to_end(key)
+                self.hits += 1
+                return slot, False
+            if image is None:
+                raise KeyError(f"Frame {key!r} is not in frame memory")
+            slot = self._free_slot()
+            self._write(slot, image)
+            self._slots[key] = slot
+            self.writes += 1
+            return slot, True
+
+    def show(self, key, image=None):
+        """
+        Display a frame, writing it first if it is not cached.
+
+        Returns:
+            Tuple[int, bool]: The slot shown and whether the frame had to be written.
+        """
+        with self._lock:
+            slot, written = self.load(key, image)
+            if slot != self.displayed:
+                self._switch(slot)
+                self.displayed = slot
+            return slot, written
+
+    def switch_to(self, slot):
+        """Display a slot outside the cache (e.g. slot 0), switching only if needed."""
+        with self._lock:
+            if slot != self.displayed:
+                self._switch(slot)
+                self.displayed = slot
+
+    def preload(self, items, background=False):
+        """
+        Write frames that are not cached yet, in order.
+
+        Args:
+            items (iterable): (key, image) pairs.
+            background (bool): Queue the writes for the worker thread and return.
+        """
+        if not background:
+            for key, image in items:
+                self.load(key, image)
+            return
+        with self._cond:
+            self._jobs.extend(items)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slm-preload", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._jobs:
+                    self._thread = None
+                    self._cond.notify_all()
+                    return
+                key, image = self._jobs.popleft()
+            try:
+                self.load(key, image)
+            except Exception as exc:
+                with self._cond:
+                    self._error = self._error or exc
+                    self._jobs.clear()
+
+    def wait(self):
+        """
+        Block until queued preloads are written.
+
+        Raises:
+            Exception: The first error of a background write since the last wait().
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._thread is None)
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def clear(self):
+        """Drop queued preloads and forget the slot contents."""
+        with self._cond:
+            self._jobs.clear()
+        self.wait()
+        with self._lock:
+            self._slots.clear()
+            self.displayed = None
@@ -3,11 +3,14 @@
 import os
 import time
 import glob
+import threading
 import numpy as np
-from PIL import Image
 from cffi import FFI
 
-from function_scripts.helpers import mod_1, normalize
+from function_scripts.helpers import meshgrid_slm, normalize
+from function_scripts.phase_compose import PhaseComposer, PHASE_ONE
+from function_scripts.settle_calibration import update_settle_time
+from slm.frame_memory import FrameMemory
 
 __author__ = "Dimitrios Karanikolopoulos"
 __coauthor__ = "John Balas (International Center of Polaritonics, Westlake University, Hangzhou)"
@@ -21,25 +24,66 @@ class SlmHamamatsu:
     phase mask generation and SLM correction in research-grade setups.
     """
 
-    def __init__(self):
+    def __init__(self, dll=None, settle_time=0.1, settle_store=None, frame_slots=0, serial="LSH0803420"):
+        """
+        Args:
+            dll: Optional stand-in for hpkSLMdaLV.dll (e.g. slm.stub_dll.StubSlmDll).
+                If None, the vendor DLL is loaded.
+            settle_time (float): Wait after each upload for the liquid crystal to settle [s].
+                Used when no calibrated value matches (see update_settle_time).
+            settle_store (SettleStore): Calibrated settle times per device and temperature
+                (function_scripts/settle_calibration.py).
+            frame_slots (int): Frame-memory slots (1..frame_slots) managed as an LRU
+                cache of frames, see display(); 0 uploads every frame to slot 0.
+                Must not exceed the slots of the device's frame-memory mode.
+            serial (str): Serial number of the head. Settle times, stored calibrations and
+                the manufacturer correction BMP (CAL_<serial>_750nm.bmp) are per serial.
+        """
         # SLM characteristics
         self.slmX = 1272
         self.slmY = 1024
         self.res = [self.slmY, self.slmX]
         self.pitch = 12.5e-6
         self.slm_size = self.pitch * np.asarray(self.res)
+        self.serial = serial
 
         # Phase modulation depth (uint8 range, specific to wavelength)
         self.mod_depth = 198  # Value for 752 nm per manufacturer spec
+        self.default_mod_depth = self.mod_depth  # restored when a calibration is removed
 
         # Final phase image (uint8)
         self.final_phase = np.zeros((self.slmY, self.slmX), dtype=np.uint8)
 
+        # Cached fixed-point phase components (gratings, correction pattern)
+        self.composer = PhaseComposer(self.mod_depth, (self.slmY, self.slmX))
+        # Stored calibration replacing mod_depth and the correction BMP, see apply_calibration
+        self.calibration = None
+
+        # Upload timing: settle wait after each frame and the last measured durations
+        self.settle_time = settle_time
+        self.default_settle_time = settle_time
+        self.settle_store = settle_store
+        self.last_upload_time = 0.0
+        self.last_settle_time = 0.0
+        # Optional StageProfiler (function_scripts/instrumentation.py) for per-stage timing
+        self.profiler = None
+
         # SLM driver
         self.ffi = FFI()
         self.slmffi = None
         self.bID = []
-        self._load_dll()
+        if dll is None:
+            self._load_dll()
+        else:
+            self.slmffi = dll
+
+        # Reusable staging frame for inputs that are not contiguous uint8 already
+        self._staging = np.zeros((self.slmY, self.slmX), dtype=np.uint8)
+        self._staging_ptr = self.ffi.from_buffer('uint8_t[]', self._staging)
+
+        # Frame memory: slot writes can run in a preload thread, so device calls are serialized
+        self._dll_lock = threading.RLock()
+        self.frame_memory = FrameMemory(self.write_slot, self.change_slot, frame_slots) if frame_slots else None
 
     def _load_dll(self):
         cur_path = os.getcwd()
@@ -67,6 +111,8 @@ class SlmHamamatsu:
         self.slmffi.Open_Dev(bIDList, 10)
         self.bID = bIDList[0]
         print(f"SLM connected with bID: {self.bID}")
+        if self.settle_store is not None:
+            self.update_settle_time()
         return self.bID
 
     def check_temp(self) -> tuple[float, float]:
@@ -82,25 +128,115 @@ class SlmHamamatsu:
         self.slmffi.Check_Temp(bID, HeadTemp, CBTemp)
         return HeadTemp[0], CBTemp[0]
 
+    def update_settle_time(self, max_temp_delta=2.0) -> float:
+        """
+        Use the settle time calibrated for the current head temperature.
+
+        Falls back to the settle_time given at construction if there is no
+        settle_store or no calibration within max_temp_delta.
+
+        Args:
+            max_temp_delta (float): Largest accepted temperature difference [degC].
+
+        Returns:
+            float: The settle time now used by load_phase [s].
+        """
+        return update_settle_time(self, max_temp_delta)
+
     def load_phase(self, image: np.ndarray) -> None:
         """
         Upload 2D phase pattern (uint8) to the SLM.
 
+        C-contiguous uint8 frames are handed to the DLL without any copy. Other
+        inputs are cast once into a preallocated staging frame. After the upload
+        the call waits settle_time seconds; the measured upload and settle
+        durations are kept in last_upload_time and last_settle_time, and recorded
+        as slm.upload / slm.settle stages if a profiler is set.
+
         Args:
             image (np.ndarray): Phase array, values in [0, 255].
         """
-        image = image.astype(np.uint8).flatten().tolist()
-        array_sz = self.ffi.cast('int32_t', self.slmX * self.slmY)
-        array_in = self.ffi.new(f'uint8_t [{self.slmX * self.slmY}]', image)
-        self.slmffi.Write_FMemArray(
-            self.ffi.cast('uint8_t', self.bID),
-            array_in,
-            array_sz,
-            self.ffi.cast('uint32_t', self.slmX),
-            self.ffi.cast('uint32_t', self.slmY),
-            self.ffi.cast('uint32_t', 0)
-        )
-        time.sleep(0.1)
+        t0 = time.perf_counter()
+        self.write_slot(0, image)
+        if self.frame_memory is not None:
+            self.frame_memory.switch_to(0)
+        self._settle(t0, "slm.upload")
+
+    def _settle(self, t0, stage):
+        # Settle wait after an upload or slot switch started at t0, with timing records
+        t1 = time.perf_counter()
+        if self.settle_time > 0:
+            time.sleep(self.settle_time)
+        self.last_upload_time = t1 - t0
+        self.last_settle_time = time.perf_counter() - t1
+        if self.profiler is not None:
+            self.profiler.record(stage, t0, self.last_upload_time)
+            self.profiler.record("slm.settle", t1, self.last_settle_time)
+
+    def write_slot(self, slot: int, image: np.ndarray) -> None:
+        """
+        Transfer a frame into a frame-memory slot (Write_FMemArray), without settle wait.
+
+        Args:
+            slot (int): Slot number; 0 is the slot used by load_phase.
+            image (np.ndarray): Phase array, values in [0, 255].
+        """
+        with self._dll_lock:
+            if (isinstance(image, np.ndarray) and image.dtype == np.uint8
+                    and image.shape == self._staging.shape and image.flags['C_CONTIGUOUS']):
+                array_in = self.ffi.from_buffer('uint8_t[]', image)
+            else:
+                np.copyto(self._staging, np.reshape(image, self._staging.shape), casting='unsafe')
+                array_in = self._staging_ptr
+
+            self.slmffi.Write_FMemArray(
+                self.ffi.cast('uint8_t', self.bID),
+                array_in,
+                self.ffi.cast('int32_t', self.slmX * self.slmY),
+                self.ffi.cast('uint32_t', self.slmX),
+                self.ffi.cast('uint32_t', self.slmY),
+                self.ffi.cast('uint32_t', slot)
+            )
+
+    def change_slot(self, slot: int) -> None:
+        """Display a frame-memory slot (Change_DispSlot), without settle wait."""
+        with self._dll_lock:
+            self.slmffi.Change_DispSlot(self.ffi.cast('uint8_t', self.bID), self.ffi.cast('uint32_t', slot))
+
+    def display(self, key, image=None) -> bool:
+        """
+        Display a frame from frame memory, writing it to a slot first if needed.
+
+        Frames are cached by key in the slots given by frame_slots (least
+        recently used evicted first), so a frame preloaded with preload() or
+        shown before only costs a slot switch. Waits settle_time afterwards;
+        the upload or switch is recorded as slm.upload / slm.switch.
+
+        Args:
+            key: Hashable frame identifier, e.g. (PatchSequence.key, index).
+            image (np.ndarray): The frame; only needed if key is not cached.
+
+        Returns:
+            bool: True if the frame was transferred, False if it was in memory.
+        """
+        if self.frame_memory is None:
+            raise ValueError("display() needs frame_slots > 0")
+        t0 = time.perf_counter()
+        _, written = self.frame_memory.show(key, image)
+        self._settle(t0, "slm.upload" if written else "slm.switch")
+        return written
+
+    def preload(self, items, background=False) -> None:
+        """
+        Write (key, image) pairs into frame memory ahead of display().
+
+        Args:
+            items (iterable): (key, image) pairs; cached keys are skipped.
+            background (bool): Transfer in a worker thread, e.g. while the camera exposes.
+        """
+        if self.frame_memory is None:
+            raise ValueError("preload() needs frame_slots > 0")
+        self.frame_memory.preload(items, background)
 
     def close(self) -> None:
         """Close connection to SLM."""
@@ -122,35 +258,76 @@ class SlmHamamatsu:
         grating = np.tile(grating_line, (self.slmY, 1))
         return normalize(grating)
 
-    def load_correction_pattern(self) -> np.ndarray:
-        """
-        Load correction phase pattern from .bmp file.
-
-        Returns:
-            np.ndarray: Normalized correction phase pattern.
-        """
+    def correction_pattern_path(self) -> str:
+        """Path of the manufacturer correction BMP."""
         current_path = os.getcwd()
         if "tests" in current_path:
             current_path = current_path.replace("\\tests", "")
-        search_path = os.path.join(current_path, "slm", "correction_patterns", "CAL_LSH0803420_750nm.bmp")
+        search_path = os.path.join(current_path, "slm", "correction_patterns", f"CAL_{self.serial}_750nm.bmp")
         bmp_files = glob.glob(search_path)
+        return bmp_files[0] if bmp_files else search_path
 
-        if not bmp_files:
+    def apply_calibration(self, calibration) -> None:
+        """
+        Use a calibration from a CalibrationStore (function_scripts/calibration_store.py).
+
+        Sets mod_depth and, if stored, the measured LUT; the calibration's
+        correction frame replaces the manufacturer BMP. None goes back to the BMP
+        and to default_mod_depth, so no setting of a previous calibration remains.
+
+        Args:
+            calibration (Calibration): e.g. store.lookup(slm.serial, 752, slm.check_temp()[0]).
+        """
+        self.calibration = calibration
+        self.mod_depth = self.default_mod_depth if calibration is None else calibration.mod_depth
+
+    def _correction_fixed(self):
+        """Fixed-point correction: the calibration frame, else the cached BMP (None if missing)."""
+        if self.calibration is not None and self.calibration.frame is not None:
+            return self.calibration.fixed()
+        correction = self.composer.correction(self.correction_pattern_path())
+        if correction is None:
             print("Correction pattern BMP not found.")
-            return np.zeros((self.slmY, self.slmX))
+        return correction
+
+    def _update_lut(self):
+        calibration = self.calibration
+        if calibration is not None and calibration.lut is not None and calibration.mod_depth == self.mod_depth:
+            self.composer.set_lut(calibration.lut, self.mod_depth)
+        else:
+            self.composer.mod_depth = self.mod_depth
 
-        with Image.open(bmp_files[0]) as img:
-            correction = np.asarray(img, dtype=np.uint16)
-        return normalize(correction)
+    def load_correction_pattern(self) -> np.ndarray:
+        """
+        Load correction phase pattern from .bmp file, or from the applied calibration.
 
-    def combine_and_upload_phase(self):
+        The BMP is decoded once and cached until the file changes on disk.
+
+        Returns:
+            np.ndarray: Normalized correction phase pattern, wrapped to [0, 1).
+        """
+        correction = self._correction_fixed()
+        if correction is None:
+            return np.zeros((self.slmY, self.slmX))
+        return correction / PHASE_ONE
+
+    def combine_and_upload_phase(self, diviX=16):
         """
         Combine grating + correction pattern, mod 1, apply modulation depth, and upload to SLM.
+
+        Components are cached in fixed point and composed in place into final_phase.
+
+        Args:
+            diviX (int): Grating period (in pixels).
         """
-        grating = self.generate_horizontal_grating()
-        correction = self.load_correction_pattern()
-        phased = mod_1(grating + correction) * self.mod_depth
-        self.final_phase = phased.astype(np.uint8)
+        grating = self.composer.component(("horizontal_grating", diviX),
+                                          lambda: self.generate_horizontal_grating(diviX))
+        correction = self._correction_fixed()
+        self._update_lut()
+        t0 = time.perf_counter()
+        self.composer.compose([grating, correction], out=self.final_phase)
+        if self.profiler is not None:
+            self.profiler.record("slm.compose", t0, time.perf_counter() - t0)
         self.load_phase(self.final_phase)
 
     @property
@@ -159,7 +336,7 @@ class SlmHamamatsu:
         Return meshgrid of SLM in meters.
 
         Returns:
-            Tuple[np.ndarray, np.ndarray]: X and Y meshgrids
+            Tuple[np.ndarray, np.ndarray]: X and Y meshgrids, writable float64 copies of
+                the cached (read-only) helpers.meshgrid_slm grids.
         """
-        x = np.arange(-self.slm_size[0] / 2, self.slm_size[0] / 2, self.pitch)
-        return np.meshgrid(x, x)
+        return tuple(np.array(g) for g in meshgrid_slm(self.slm_size, self.pitch))
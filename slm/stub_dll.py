@@ -0,0 +1,72 @@
+# slm/stub_dll.py
+
+import time
+import numpy as np
+from cffi import FFI
+
+__author__ = "Dimitrios Karanikolopoulos"
+
+
+class StubSlmDll:
+    """
+    Stand-in for the Hamamatsu hpkSLMdaLV.dll used by SlmHamamatsu.
+
+    Implements the DLL calls used by the driver with the same argument order and
+    records every call, so upload marshalling can be tested and benchmarked
+    without the SLM or Windows. Frame writes read the full buffer like the real
+    driver does before sending it over USB.
+
+    Attributes:
+        writes (list): (bID, slot, width, height) of every Write_FMemArray call.
+        switches (list): (bID, slot) of every Change_DispSlot call.
+        displayed_slot (int): Frame-memory slot on display.
+        frames (dict): Last frame written to each slot (only if record_frames).
+        write_delay (float): Simulated USB transfer time per frame [s].
+    """
+
+    def __init__(self, write_delay=0.0, record_frames=True, head_temp=30.0, cb_temp=35.0):
+        self.ffi = FFI()
+        self.write_delay = write_delay
+        self.record_frames = record_frames
+        self.head_temp = head_temp
+        self.cb_temp = cb_temp
+        self.writes = []
+        self.switches = []
+        self.displayed_slot = 0
+        self.frames = {}
+        self.is_open = False
+
+    def Open_Dev(self, bIDList, bIDSize):
+        bIDList[0] = 1
+        self.is_open = True
+        return 1
+
+    def Close_Dev(self, bIDList, bIDSize):
+        self.is_open = False
+        return 1
+
+    def Check_Temp(self, bID, HeadTemp, CBTemp):
+        HeadTemp[0] = self.head_temp
+        CBTemp[0] = self.cb_temp
+        return 1
+
+    def Write_FMemArray(self, bID, ArrayIn, ArraySize, XPixel, YPixel, SlotNo):
+        size = int(ArraySize)
+        width, height, slot = int(XPixel), int(YPixel), int(SlotNo)
+        if size != width * height:
+            raise ValueError(f"ArraySize {size} does not match {width} x {height}")
+
+        data = np.frombuffer(self.ffi.buffer(ArrayIn, size), dtype=np.uint8)
+        if self.record_frames:
+            self.frames[slot] = data.reshape(height, width).copy()
+        else:
+            data.sum()  # touch every byte, like the USB transfer would
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        self.writes.append((int(bID), slot, width, height))
+        return 1
+
+    def Change_DispSlot(self, bID, SlotNo):
+        self.displayed_slot = int(SlotNo)
+        self.switches.append((int(bID), self.displayed_slot))
+        return 1
@@ -0,0 +1,405 @@
+"""
+Benchmark suite for the hot paths of the SLM phase retrieval.
+
+Covers phase composition, SLM upload marshalling (stub DLL), camera averaging,
+grid creation, patch fitting, correction reconstruction and a full simulated
+measure_slm_wavefront run.
+Reports per-call percentiles and throughput, and compares against a saved JSON
+baseline so that regressions fail the run.
+
+Usage (from the repository root):
+    python -m tests.benchmark_suite --save-baseline     # record tests/benchmark_baseline.json
+    python -m tests.benchmark_suite                     # compare, exit 1 on regression
+    python -m tests.benchmark_suite --only fit --quick  # subset, fewer repeats
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+
+# name -> (factory, items per call, unit); factory() returns the callable to time
+BENCHMARKS = {}
+
+
+def benchmark(name, items=1, unit="calls", repeats=None):
+    """Register a benchmark factory under name."""
+    def register(factory):
+        BENCHMARKS[name] = (factory, items, unit, repeats)
+        return factory
+    return register
+
+
+def time_callable(fn, repeats=20, warmup=2):
+    """
+    Time repeated calls of fn.
+
+    Args:
+        fn (callable): Function without arguments.
+        repeats (int): Number of timed calls.
+        warmup (int): Untimed calls before measuring.
+
+    Returns:
+        np.ndarray: Duration of every timed call [s].
+    """
+    for _ in range(warmup):
+        fn()
+    times = np.empty(repeats)
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - t0
+    return times
+
+
+def summarize(times, items=1):
+    """
+    Percentiles and throughput of a set of call durations.
+
+    Returns:
+        dict: mean, min, p50, p90, p99 [s] and throughput [items/s] at the median.
+    """
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {
+        "repeats": int(len(times)),
+        "mean": float(np.mean(times)),
+        "min": float(np.min(times)),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "throughput": float(items / p50) if p50 > 0 else float("inf"),
+    }
+
+
+def compare(results, baseline, tolerance=1.5):
+    """
+    Find benchmarks whose median got slower than tolerance x baseline median.
+
+    Args:
+        results (dict): name -> summary of the current run.
+        baseline (dict): name -> summary of the baseline run.
+        tolerance (float): Allowed slowdown factor.
+
+    Returns:
+        list: (name, current p50, baseline p50) of every regression.
+    """
+    regressions = []
+    for name, summary in results.items():
+        ref = baseline.get(name)
+        if ref is not None and summary["p50"] > tolerance * ref["p50"]:
+            regressions.append((name, summary["p50"], ref["p50"]))
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+SLM_SHAPE = (1024, 1272)
+
+
+def _stub_slm(frame_slots=0):
+    from slm.slm_hamamatsu import SlmHamamatsu
+    from slm.stub_dll import StubSlmDll
+
+    slm = SlmHamamatsu(dll=StubSlmDll(record_frames=False), settle_time=0.0, frame_slots=frame_slots)
+    slm.bID = 1
+    return slm
+
+
+@benchmark("compose_mod_1")
+def _bench_mod_1():
+    from function_scripts.helpers import mod_1
+    phase = np.random.default_rng(0).uniform(0, 3, SLM_SHAPE)
+    return lambda: mod_1(phase)
+
+
+@benchmark("compose_normalize")
+def _bench_normalize():
+    from function_scripts.helpers import normalize
+    phase = np.random.default_rng(0).uniform(0, 3, SLM_SHAPE)
+    return lambda: normalize(phase)
+
+
+@benchmark("compose_horizontal_grating")
+def _bench_grating():
+    slm = _stub_slm()
+    return slm.generate_horizontal_grating
+
+
+@benchmark("compose_full_slm_array")
+def _bench_full_slm_array():
+    import function_scripts.phase_gen as phase_gen
+    phase_gen.linear_grating(SLM_SHAPE)
+    phase_gen.patch = None
+    phase_gen.which_phases = {"grating": True, "patch": False, "corr_patt": False, "corr_phase": False}
+    return phase_gen.make_full_slm_array
+
+
+@benchmark("compose_patch_sequence_144", items=144, unit="frames", repeats=5)
+def _bench_patch_sequence():
+    import function_scripts.patch_sequence as ps
+    from function_scripts.phase_compose import PhaseComposer
+    composer = PhaseComposer(198, SLM_SHAPE)
+    grating = np.mod(np.arange(SLM_SHAPE[1]), 40) / 40 * np.ones((SLM_SHAPE[0], 1))
+    bounds = ps.aperture_bounds(20, 20, 0, 0, 64, 64)
+
+    def run():
+        ps._last_sequence = None
+        sequence = ps.PatchSequence.build(composer, grating, bounds, 209, np.arange(144))
+        for i in range(len(sequence)):
+            sequence[i]
+    return run
+
+
+@benchmark("slm_load_phase", unit="frames")
+def _bench_load_phase():
+    slm = _stub_slm()
+    frame = np.random.default_rng(0).integers(0, 198, SLM_SHAPE, dtype=np.uint8)
+    return lambda: slm.load_phase(frame)
+
+
+@benchmark("slm_display_from_slot", items=8, unit="frames")
+def _bench_display_slot():
+    slm = _stub_slm(frame_slots=8)
+    frames = np.random.default_rng(0).integers(0, 198, (8,) + SLM_SHAPE, dtype=np.uint8)
+    slm.preload(enumerate(frames))
+
+    def run():
+        for i in range(8):
+            slm.display(i)
+    return run
+
+
+@benchmark("hologram_wgs_30", items=30, unit="iterations", repeats=3)
+def _bench_hologram():
+    from function_scripts.holography import HologramEngine, spot_array_target
+    engine = HologramEngine(SLM_SHAPE)
+    spots = [(r, c) for r in range(-100, 101, 50) for c in range(-150, 151, 50)]
+    target = spot_array_target(engine.fft_shape, spots)
+    return lambda: engine.compute(target, n_iter=30)
+
+
+@benchmark("calibration_switch_wavelength", items=2, unit="lookups")
+def _bench_calibration_switch():
+    from function_scripts.calibration_store import CalibrationStore
+    tmp = tempfile.TemporaryDirectory()
+    store = CalibrationStore(tmp.name)
+    rng = np.random.default_rng(0)
+    for wavelength in (752, 1064):
+        store.add("bench", wavelength, 30.0, 198, frame=rng.random(SLM_SHAPE))
+
+    def run():
+        # Cold switch: open the memory-mapped frame and convert it to fixed point
+        store.clear_cache()
+        for wavelength in (752, 1064):
+            store.lookup("bench", wavelength, 30.0).fixed()
+    run.store_dir = tmp  # removed when the benchmark is dropped
+    return run
+
+
+@benchmark("camera_average_10", items=10, unit="frames")
+def _bench_camera_average():
+    from simulation.simulated_bench import SimulatedCamera, SimulatedSlm
+    cam = SimulatedCamera(SimulatedSlm(), roi_shape=(300, 300), noise=1.0, seed=0)
+    cam.ideal_image()
+    return lambda: cam.take_average_image(10)
+
+
+@benchmark("camera_average_into_roi_10", items=10, unit="frames")
+def _bench_camera_average_roi():
+    from simulation.simulated_bench import SimulatedCamera, SimulatedSlm
+    cam = SimulatedCamera(SimulatedSlm(), roi_shape=(300, 300), noise=1.0, seed=0)
+    cam.set_subarray(118, 118, 64, 64)
+    cam.set_binning(2)
+    out = np.empty(cam.frame_shape, dtype=np.float32)
+    cam.ideal_image()
+    return lambda: cam.average_into(out, 10)
+
+
+@benchmark("make_grid_300")
+def _bench_make_grid():
+    from function_scripts.helpers import make_grid
+    img = np.zeros((300, 300))
+    return lambda: make_grid(img, scale=6.5e-6)
+
+
+def _fit_inputs(n_patch, n_side=300):
+    from function_scripts.helpers import make_grid
+    rng = np.random.default_rng(0)
+    fl, k = 0.3, 2 * np.pi / 752e-9
+    x, y = make_grid(np.zeros((n_side, n_side)), scale=6.5e-6)
+    dx = rng.uniform(-3, 3, n_patch) * 64 * 12.5e-6
+    dy = rng.uniform(-3, 3, n_patch) * 64 * 12.5e-6
+    phi = rng.uniform(-np.pi, np.pi, n_patch)
+    carrier = k * (np.multiply.outer(x, dx) + np.multiply.outer(y, dy)) / fl
+    stack = np.cos(carrier + phi) + 0.05 * rng.standard_normal(carrier.shape)
+    return fl, k, x, y, stack, dx, dy
+
+
+@benchmark("fit_sine_stack_64", items=64, unit="patches")
+def _bench_fit_stack():
+    from function_scripts.fitting import FitSine
+    fl, k, x, y, stack, dx, dy = _fit_inputs(64)
+    fitter = FitSine(fl, k)
+    return lambda: fitter.fit_stack(x, y, stack, dx, dy)
+
+
+@benchmark("fit_sine_stack_64_sparse", items=64, unit="patches")
+def _bench_fit_stack_sparse():
+    from function_scripts.fitting import FitSine
+    from function_scripts.helpers import make_grid
+    fl, k, x, y, stack, dx, dy = _fit_inputs(64)
+    x, y = make_grid(stack[..., 0], scale=6.5e-6, dtype=np.float32, sparse=True)
+    fitter = FitSine(fl, k)
+    return lambda: fitter.fit_stack(x, y, stack, dx, dy)
+
+
+@benchmark("fit_fft_stack_64", items=64, unit="patches")
+def _bench_fit_fft():
+    from function_scripts.fitting import FitFFT
+    fl, k, x, y, stack, dx, dy = _fit_inputs(64)
+    fitter = FitFFT(fl, k)
+    return lambda: fitter.fit_stack(x, y, stack, dx, dy)
+
+
+@benchmark("fit_safe_fit_patch", unit="patches", repeats=5)
+def _bench_safe_fit():
+    from function_scripts.fitting import FitSine
+    fl, k, x, y, stack, dx, dy = _fit_inputs(1)
+    fitter = FitSine(fl, k)
+    x_data = np.vstack((x.ravel(), y.ravel()))
+    return lambda: fitter.refine_stack(x_data, stack, dx, dy, [0.0], [1.0])
+
+
+@benchmark("reconstruct_correction_24")
+def _bench_reconstruct():
+    from function_scripts.reconstruction import build_correction
+    yy, xx = np.indices((24, 24)) / 10.0
+    dphi = np.angle(np.exp(1j * 3 * (xx ** 2 + yy ** 2)))
+    amp = np.ones((24, 24))
+    return lambda: build_correction(dphi, amp, SLM_SHAPE, cell=40)
+
+
+@benchmark("zernike_correction_order6")
+def _bench_zernike():
+    from function_scripts.zernike import get_basis, zernike_correction
+    basis = get_basis((24, 24), 0, 0, 40, order=6)
+    coeffs = np.random.default_rng(0).normal(size=len(basis.modes))
+    return lambda: zernike_correction(coeffs, SLM_SHAPE, basis.center, basis.radius)
+
+
+@benchmark("measure_simulated_4x4", items=16, unit="patches", repeats=3)
+def _bench_measure():
+    from function_scripts.slmphase import PhaseAmplitudeRetriever
+    from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+    slm, shutter = SimulatedSlm(), SimulatedShutter()
+    cam = SimulatedCamera(slm, shutter, beam_waist=3e-3, n_fft=1536, roi_shape=(48, 48), noise=1.0, seed=0)
+
+    def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            retriever = PhaseAmplitudeRetriever(tmp)
+            retriever.measure_slm_wavefront(
+                slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=2,
+                roi_min_x=4, roi_min_y=3, roi_n=4,
+            )
+            retriever.wait_for_results()
+    return run
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def run_suite(names=None, repeats=20, quick=False):
+    """
+    Run the selected benchmarks.
+
+    Args:
+        names (list): Substrings selecting benchmarks; None runs all.
+        repeats (int): Timed calls per benchmark (benchmarks may use fewer).
+        quick (bool): Cut repeats to a quarter, for smoke runs.
+
+    Returns:
+        dict: name -> summary (see summarize), plus "unit".
+    """
+    results = {}
+    for name, (factory, items, unit, own_repeats) in BENCHMARKS.items():
+        if names and not any(n in name for n in names):
+            continue
+        n = min(repeats, own_repeats) if own_repeats else repeats
+        if quick:
+            n = max(2, n // 4)
+        fn = factory()
+        summary = summarize(time_callable(fn, repeats=n, warmup=1), items)
+        summary["unit"] = unit
+        results[name] = summary
+    return results
+
+
+def print_table(results, baseline=None):
+    header = f"{'benchmark':<28}{'p50 [ms]':>10}{'p90 [ms]':>10}{'p99 [ms]':>10}{'throughput':>18}{'vs base':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, s in results.items():
+        ratio = ""
+        if baseline and name in baseline:
+            ratio = f"{s['p50'] / baseline[name]['p50']:.2f}x"
+        rate = f"{s['throughput']:.1f} {s['unit']}/s"
+        print(f"{name:<28}{s['p50'] * 1e3:>10.2f}{s['p90'] * 1e3:>10.2f}{s['p99'] * 1e3:>10.2f}{rate:>18}{ratio:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="Write results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown of the median")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--only", nargs="*", help="Run benchmarks whose name contains any of these")
+    parser.add_argument("--output", help="Also write the results of this run to a JSON file")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.only, repeats=args.repeats, quick=args.quick)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+
+    record = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": platform.node(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(record, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(record, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for name, cur, ref in regressions:
+        print(f"REGRESSION {name}: p50 {cur * 1e3:.2f} ms vs baseline {ref * 1e3:.2f} ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Shared fixtures of the test suite: the injected aberration, the simulated optical
+bench used by the end-to-end scans and the phase comparison helpers.
+"""
+
+import numpy as np
+import pytest
+
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+
+def _make_aberration(res=(1024, 1272)):
+    yy, xx = np.indices(res, dtype=float)
+    x = (xx - (res[1] - 1) / 2) / (res[1] / 2)
+    y = (yy - (res[0] - 1) / 2) / (res[0] / 2)
+    return 3 * (x ** 2 + y ** 2) + 1.5 * x * y - 2 * y ** 3
+
+
+def _patch_truth(aberration, aperture_number=12, aperture_width=80, roi_min_x=4, roi_min_y=3, roi_n=4):
+    w = aperture_width
+    means = aberration[:aperture_number * w, :aperture_number * w]
+    means = means.reshape(aperture_number, w, aperture_number, w).mean(axis=(1, 3))
+    n_centre = aperture_number ** 2 // 2 + aperture_number // 2 - 1
+    ref = means.flat[n_centre]
+    roi = means[roi_min_x:roi_min_x + roi_n, roi_min_y:roi_min_y + roi_n]
+    return roi - ref
+
+
+def _remove_piston_tilt(phase):
+    rows, cols = np.indices(phase.shape)
+    basis = np.c_[np.ones(phase.size), rows.ravel(), cols.ravel()]
+    coef, *_ = np.linalg.lstsq(basis, phase.ravel(), rcond=None)
+    return (phase.ravel() - basis @ coef).reshape(phase.shape)
+
+
+@pytest.fixture
+def aberration():
+    """Smooth aberration over the full SLM [rad]."""
+    return _make_aberration()
+
+
+@pytest.fixture
+def bench():
+    """
+    Factory of simulated benches, bench(aberration=None, slm=None, **camera_kwargs).
+
+    Returns (slm, cam, shutter); the camera defaults to a 3 mm beam, 1536 px FFT,
+    48 x 48 window, unit noise and seed 1, overridden by camera_kwargs.
+    """
+    def make(aberration=None, slm=None, **camera_kwargs):
+        slm = SimulatedSlm() if slm is None else slm
+        shutter = SimulatedShutter()
+        options = dict(beam_waist=3e-3, n_fft=1536, roi_shape=(48, 48), noise=1.0, seed=1)
+        options.update(camera_kwargs)
+        return slm, SimulatedCamera(slm, shutter, aberration=aberration, **options), shutter
+    return make
+
+
+@pytest.fixture
+def patch_truth():
+    """
+    patch_truth(aberration, aperture_number=12, aperture_width=80, roi_min_x=4, roi_min_y=3, roi_n=4):
+    mean aberration of every measured patch relative to the reference patch.
+    """
+    return _patch_truth
+
+
+@pytest.fixture
+def remove_piston_tilt():
+    """Phase map minus its least-squares piston and tilt."""
+    return _remove_piston_tilt
@@ -0,0 +1,70 @@
+"""
+Tests for coarse-to-fine aperture scans in function_scripts/adaptive_scan.py.
+"""
+
+import os
+
+import numpy as np
+
+from function_scripts.adaptive_scan import AdaptiveGrid, phase_steps
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+
+
+def test_phase_steps_wrap_around():
+    dphi = np.array([[3.0, -3.0], [3.0, 3.0]])
+    step = 2 * np.pi - 6.0
+    np.testing.assert_allclose(phase_steps(dphi), [[step, step], [0.0, step]])
+
+
+def test_refine_splits_only_steep_cells_and_resamples_leaves():
+    grid = AdaptiveGrid(4, 64, top=128, left=256)
+    dphi = np.zeros((4, 4))
+    dphi[1, 2] = 2.0
+    grid.add(0, np.arange(16), dphi.ravel(), np.ones(16), np.zeros(16))
+
+    cells = grid.refine(0, max_step=1.0)
+    # (1, 2) and its four neighbours, 2 x 2 children each
+    assert cells.size == 5 * 4
+    top, bot, left, right = grid.bounds(1, cells[:1])
+    # First child: top-left quarter of the neighbour above, cell (0, 2)
+    assert (top[0], bot[0], left[0], right[0]) == (128, 160, 256 + 4 * 32, 256 + 5 * 32)
+
+    grid.add(1, cells, np.full(cells.size, 0.5), np.full(cells.size, 0.25), np.zeros(cells.size))
+    n_leaves = sum(len(leaf[1]) for leaf in grid.leaves())
+    assert n_leaves == 16 - 5 + 20
+
+    phase, amp, _ = grid.resample()
+    assert phase.shape == (8, 8)
+    np.testing.assert_allclose(phase[2:4, 4:6], 0.5)
+    np.testing.assert_allclose(amp, 1.0)  # children are rescaled by their area
+    assert np.allclose(phase[7, 0], 0.0)
+
+    assert grid.refine(0, max_step=None, max_err=1.0).size == 0
+
+
+def test_adaptive_scan_refines_local_aberration(tmp_path, bench):
+    yy, xx = np.indices((1024, 1272))
+    aberration = 4 * np.exp(-((yy - 440) ** 2 + (xx - 440) ** 2) / (2 * 40 ** 2))
+    slm, cam, shutter = bench(aberration)
+
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    retriever.measure_slm_wavefront(
+        slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=2,
+        roi_min_x=3, roi_min_y=3, roi_n=5, refine_levels=1, refine_step=1.0,
+    )
+    retriever.wait_for_results()
+    (run_dir,) = os.listdir(tmp_path)
+    dphi = np.load(os.path.join(tmp_path, run_dir, "dphi.npy"))
+    apertures = np.load(os.path.join(tmp_path, run_dir, "apertures.npz"))
+    assert dphi.shape == (10, 10)
+    n_fine = apertures["cells_L1"].size
+    assert 0 < n_fine < 100
+    assert slm.uploads == 1 + 25 + n_fine
+
+    # Truth on the 40 px grid relative to the reference aperture (12 x 12 grid, index 77)
+    truth = aberration[240:640, 240:640].reshape(10, 40, 10, 40).mean(axis=(1, 3))
+    truth -= aberration[480:560, 400:480].mean()
+    error = np.angle(np.exp(1j * (dphi - truth)))
+    coarse = np.kron(apertures["dphi_L0"].reshape(5, 5), np.ones((2, 2)))
+    coarse_error = np.angle(np.exp(1j * (coarse - truth)))
+    assert np.std(error) < 0.75 * np.std(coarse_error)
@@ -0,0 +1,114 @@
+"""
+Tests for streaming frame averaging (function_scripts/averaging.py) and the
+subarray / binning readout of the simulated camera.
+"""
+
+import os
+
+import numpy as np
+
+from function_scripts.averaging import FrameAverager, bin_frame, fringe_phase_error, spot_window
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+
+def test_running_mean_matches_batch_mean_into_caller_buffer():
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000, 30, (50, 12, 10))
+    it = iter(frames)
+    out = np.zeros((6, 5))
+    averager = FrameAverager((12, 10), binning=2)
+    assert averager.average(lambda: next(it), 50, out=out) is out
+
+    expected = frames.reshape(50, 6, 2, 5, 2).sum(axis=(2, 4)).mean(axis=0)
+    np.testing.assert_allclose(out, expected, rtol=1e-5)
+
+
+def test_bin_frame_drops_incomplete_blocks():
+    frame = np.arange(35.0).reshape(5, 7)
+    binned = bin_frame(frame, 3)
+    assert binned.shape == (1, 2)
+    assert binned[0, 1] == frame[:3, 3:6].sum()
+
+
+def test_spot_window_centres_and_clips():
+    frame = np.zeros((100, 80))
+    frame[60:64, 20:24] = 1.0
+    assert spot_window(frame, (20, 10)) == (52, 17)
+    assert spot_window(frame, (100, 80)) == (0, 0)
+
+
+def test_camera_subarray_and_binning():
+    slm, shutter = SimulatedSlm(), SimulatedShutter()
+    shutter.shutter_enable(True)
+    cam = SimulatedCamera(slm, shutter, n_fft=1024, roi_shape=(40, 40), noise=0.0)
+    full_pitch = cam.pitch
+
+    cam.set_subarray(4, 6, 20, 24)
+    cam.set_binning(2)
+    assert cam.frame_shape == (10, 12)
+    out = np.empty(cam.frame_shape)
+    cam.average_into(out, 3)
+    np.testing.assert_allclose(out, bin_frame(cam.ideal_image()[4:24, 6:30], 2), rtol=1e-4)
+    # The binned grid step is twice the sensor step
+    assert np.isclose(cam.pitch * (2 * (12 // 2)) / (12 - 1), 2 * full_pitch * (2 * (40 // 2)) / (40 - 1))
+
+
+def test_measure_with_centred_subarray_and_binning(tmp_path, aberration, bench, patch_truth, remove_piston_tilt):
+    slm, cam, shutter = bench(aberration, n_fft=2048, roi_shape=(72, 72))
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    retriever.measure_slm_wavefront(
+        slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=2,
+        roi_min_x=4, roi_min_y=3, roi_n=4, cam_roi=(64, 64), binning=2,
+    )
+    retriever.wait_for_results()
+    assert cam.frame_shape == (32, 32)
+    (run_dir,) = os.listdir(tmp_path)
+    dphi = np.load(os.path.join(tmp_path, run_dir, "dphi.npy"))
+    residual = remove_piston_tilt(np.angle(np.exp(1j * (dphi - patch_truth(aberration)))))
+    assert np.sqrt(np.mean(residual ** 2)) < 0.1
+
+
+def test_stop_criterion_ends_averaging_early():
+    rng = np.random.default_rng(1)
+    averager = FrameAverager((8, 8))
+    seen = []
+
+    def stop(mean, noise_var, n):
+        seen.append(noise_var)
+        return n == 5
+
+    averager.average(lambda: rng.normal(0, 3, (8, 8)), 50, stop=stop)
+    assert averager.n_frames == 5
+    assert 6 < seen[-1] < 12  # single-frame variance 9
+
+
+def test_fringe_phase_error_matches_fit_scatter():
+    rng = np.random.default_rng(2)
+    y, x = np.indices((32, 32))
+    theta = 0.7 * x + 0.3 * y
+    carrier = np.exp(-1j * theta)
+    sigma, amp, n = 2.0, 1.0, 4
+    predicted = fringe_phase_error(amp * np.cos(theta + 0.4), sigma ** 2, n, carrier)
+
+    phases = []
+    for _ in range(300):
+        mean = amp * np.cos(theta + 0.4) + sigma / np.sqrt(n) * rng.standard_normal(theta.shape)
+        phases.append(np.angle(np.vdot(np.conj(carrier), mean)))
+    assert np.isclose(np.std(phases), predicted, rtol=0.2)
+
+
+def test_adaptive_averaging_saves_frames(tmp_path, aberration, bench, patch_truth, remove_piston_tilt):
+    slm, cam, shutter = bench(aberration, noise=20.0)
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    retriever.measure_slm_wavefront(
+        slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=20,
+        roi_min_x=4, roi_min_y=3, roi_n=4, target_phase_err=0.02,
+    )
+    retriever.wait_for_results()
+    (run_dir,) = os.listdir(tmp_path)
+    frames_used = np.load(os.path.join(tmp_path, run_dir, "frames_used.npy"))
+    dphi = np.load(os.path.join(tmp_path, run_dir, "dphi.npy"))
+    assert frames_used.sum() < 0.5 * 20 * frames_used.size
+    residual = remove_piston_tilt(np.angle(np.exp(1j * (dphi - patch_truth(aberration)))))
+    assert np.sqrt(np.mean(residual ** 2)) < 0.1
@@ -0,0 +1,33 @@
+"""
+Tests for the benchmark runner in tests/benchmark_suite.py.
+"""
+
+import json
+
+import numpy as np
+
+from tests import benchmark_suite as bs
+
+
+def test_summarize_percentiles_and_throughput():
+    summary = bs.summarize(np.array([1.0, 2.0, 3.0, 4.0, 5.0]), items=10)
+    assert summary["p50"] == 3.0
+    assert summary["min"] == 1.0
+    assert summary["throughput"] == 10 / 3.0
+
+
+def test_compare_flags_only_slower_medians():
+    baseline = {"a": {"p50": 1.0}, "b": {"p50": 1.0}}
+    results = {"a": {"p50": 1.4}, "b": {"p50": 1.6}, "new": {"p50": 9.0}}
+    assert bs.compare(results, baseline, tolerance=1.5) == [("b", 1.6, 1.0)]
+
+
+def test_baseline_roundtrip_and_regression_exit_code(tmp_path):
+    path = tmp_path / "baseline.json"
+    assert bs.main(["--baseline", str(path), "--save-baseline", "--only", "make_grid", "--quick"]) == 0
+    assert bs.main(["--baseline", str(path), "--only", "make_grid", "--quick", "--tolerance", "100"]) == 0
+
+    record = json.loads(path.read_text())
+    record["results"]["make_grid_300"]["p50"] = 1e-12
+    path.write_text(json.dumps(record))
+    assert bs.main(["--baseline", str(path), "--only", "make_grid", "--quick"]) == 1
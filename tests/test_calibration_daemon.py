@@ -0,0 +1,119 @@
+"""
+Tests for the resident calibration daemon (function_scripts/calibration_daemon.py).
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import function_scripts.calibration_daemon as calibration_daemon
+import function_scripts.phase_gen as phase_gen
+from function_scripts.calibration_daemon import (
+    CalibrationDaemon, DaemonClient, DaemonJobError, DeviceSessions, simulated_openers,
+)
+
+AUTHKEY = b"test-key"
+MEASURE = dict(aperture_number=8, aperture_width=80, num_frames=1, roi_min_x=2, roi_min_y=2, roi_n=4,
+               zernike_order=2)
+
+
+@pytest.fixture
+def daemon(tmp_path, aberration):
+    openers = simulated_openers(aberration=aberration, beam_waist=3e-3, n_fft=1536, roi_shape=(48, 48),
+                                noise=1.0, seed=1)
+    daemon = CalibrationDaemon(openers, str(tmp_path), address=("127.0.0.1", 0), authkey=AUTHKEY)
+    daemon.start()
+    yield daemon
+    daemon.stop()
+    phase_gen.correction_phase = None
+
+
+def test_sessions_open_devices_once_and_close_in_reverse_order():
+    closed = []
+
+    class Device:
+        def __init__(self, name):
+            self.name = name
+
+        def close(self):
+            closed.append(self.name)
+
+    sessions = DeviceSessions({"slm": lambda s: Device("slm"),
+                               "camera": lambda s: (s.get("slm"), Device("camera"))[1]})
+    camera = sessions.get("camera")
+    assert sessions.get("camera") is camera and sessions.opened == {"slm": 1, "camera": 1}
+    assert list(sessions.devices) == ["slm", "camera"]
+    with pytest.raises(KeyError):
+        sessions.get("shutter")
+    sessions.close()
+    assert closed == ["camera", "slm"] and not sessions.devices
+    assert sessions.get("slm") is not None and sessions.opened["slm"] == 2
+
+
+def test_measurements_reuse_open_devices_and_stream_stages(daemon):
+    events = []
+    with DaemonClient(daemon.address, AUTHKEY) as client:
+        first = client.measure(on_event=events.append, **MEASURE)
+        second = client.measure(use_correction=True, **MEASURE)
+        status = client.status()
+    kinds = [kind for kind, _, _ in events]
+    assert kinds[:2] == ["queued", "started"]
+    stages = {payload["name"] for kind, _, payload in events if kind == "stage"}
+    assert {"background", "fit", "reconstruct", "zernike"} <= stages
+    assert first["dphi"].shape == (4, 4) and first["save_dir"] != second["save_dir"]
+    assert len(second["zernike"]["coeffs"]) == 6 and "fit" in second["timing"]
+    assert status["completed"] == 2 and status["running"] is None
+    assert all(device["opened"] == 1 for device in status["devices"].values())
+
+
+def test_failed_job_reports_error_and_daemon_keeps_serving(daemon):
+    with DaemonClient(daemon.address, AUTHKEY) as client:
+        with pytest.raises(DaemonJobError, match="does not match the SLM"):
+            client.upload(np.zeros((4, 4), dtype=np.uint8))
+        with pytest.raises(DaemonJobError, match="Unknown job"):
+            client.call("bogus")
+        frame = np.full((1024, 1272), 7, dtype=np.uint8)
+        assert client.upload(frame)["duration"] >= 0
+        client.shutter(True)
+        image = client.grab()
+        average = client.grab(num_frames=3)
+    np.testing.assert_array_equal(daemon.sessions.get("slm").displayed, frame)
+    assert image.shape == average.shape == (48, 48)
+    assert daemon.completed == 5
+
+
+def test_reset_reopens_devices_and_shutdown_stops_the_daemon(daemon):
+    with DaemonClient(daemon.address, AUTHKEY) as client:
+        client.grab()
+        assert not client.reset()["camera"]["open"]
+        client.grab()
+        assert client.status()["devices"]["camera"]["opened"] == 2
+        client.shutdown()
+    daemon.serve_forever()  # returns at once after the shutdown request, closing the devices
+    assert not daemon.sessions.devices
+
+
+def test_per_user_key_file_and_non_loopback_refusal(tmp_path, monkeypatch):
+    monkeypatch.delenv(calibration_daemon.AUTHKEY_ENV, raising=False)
+    monkeypatch.setattr(calibration_daemon, "KEY_FILE", str(tmp_path / "key"))
+    key = calibration_daemon.default_authkey()
+    assert len(key) == 64 and calibration_daemon.default_authkey() == key
+    assert os.listdir(tmp_path) == ["key"]  # the temporary key file is gone
+    if os.name == "posix":
+        assert os.stat(tmp_path / "key").st_mode & 0o777 == 0o600
+        os.chmod(tmp_path / "key", 0o644)
+        with pytest.raises(PermissionError):
+            calibration_daemon.default_authkey()
+        os.chmod(tmp_path / "key", 0o600)
+    (tmp_path / "key").write_bytes(b"")
+    with pytest.raises(ValueError, match="empty"):
+        calibration_daemon.default_authkey()
+    openers = simulated_openers()
+    with pytest.raises(ValueError, match="non-loopback"):
+        CalibrationDaemon(openers, str(tmp_path), address=("0.0.0.0", 0))
+    with pytest.raises(ValueError, match="empty"):
+        CalibrationDaemon(openers, str(tmp_path), address=("127.0.0.1", 0), authkey=b"")
+    monkeypatch.setenv(calibration_daemon.AUTHKEY_ENV, "explicit")
+    assert calibration_daemon.default_authkey() == b"explicit"
+    assert CalibrationDaemon(openers, str(tmp_path), address=("0.0.0.0", 0)).authkey == b"explicit"
@@ -0,0 +1,120 @@
+"""
+Tests for the indexed calibration store (function_scripts/calibration_store.py).
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import function_scripts.phase_gen as phase_gen
+from function_scripts.calibration_store import CalibrationStore, open_store, phase_to_frame
+from function_scripts.phase_compose import PhaseComposer, PHASE_ONE, mod_depth_lut
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+
+def random_phase(shape=(32, 40), seed=0):
+    return np.random.default_rng(seed).random(shape)
+
+
+def test_nearest_lookup_by_wavelength_temperature_and_date(tmp_path):
+    store = CalibrationStore(str(tmp_path))
+    store.add("A", 752, 25.0, 198, frame=random_phase(seed=1), date="2026-01-10 10:00:00")
+    store.add("A", 752, 35.0, 199, frame=random_phase(seed=2), date="2026-01-10 11:00:00")
+    store.add("A", 752, 35.0, 200, frame=random_phase(seed=3), date="2026-03-01 09:00:00")
+    store.add("A", 1064, 30.0, 255, date="2026-01-10 12:00:00")
+    store.add("B", 752, 30.0, 190, date="2026-01-10 12:00:00")
+
+    reloaded = CalibrationStore(str(tmp_path))
+    assert len(reloaded) == 5
+    assert reloaded.lookup("A", 752, 27.0).mod_depth == 198
+    assert reloaded.lookup("A", 751, 34.0).mod_depth == 200  # newest of the 35 degC entries
+    assert reloaded.lookup("A", 752, 34.0, before="2026-02-01 00:00:00").mod_depth == 199
+    assert reloaded.lookup("A", 1060, 30.0, max_wavelength_delta=5).mod_depth == 255
+    assert reloaded.lookup("A", 900, 30.0) is None
+    assert reloaded.lookup("A", 752, 45.0, max_temp_delta=2.0) is None
+    assert reloaded.lookup("C", 752, 30.0) is None
+    # Lookups and opened calibrations are cached
+    assert reloaded.lookup("A", 752, 27.0) is reloaded.lookup("A", 752, 27.0)
+
+
+def test_frames_are_memory_mapped_uint8_and_convert_to_fixed_point(tmp_path):
+    phase = random_phase()
+    cal = CalibrationStore(str(tmp_path)).add("A", 752, 30.0, 198, frame=phase)
+    cal = CalibrationStore(str(tmp_path)).lookup("A", 752, 30.0)
+    assert isinstance(cal.frame, np.memmap) and cal.frame.dtype == np.uint8
+    np.testing.assert_array_equal(cal.frame, phase_to_frame(phase))
+    fixed = cal.fixed()
+    assert fixed.dtype == np.uint16 and not fixed.flags.writeable
+    assert np.max(np.abs(np.angle(np.exp(2j * np.pi * (fixed / PHASE_ONE - phase))))) <= np.pi / 256 + 1e-9
+    assert cal.fixed() is fixed
+
+
+def test_bmp_import_matches_composer_correction(tmp_path):
+    bmp = tmp_path / "CAL_TEST_750nm.bmp"
+    Image.fromarray((random_phase() * 255).astype(np.uint8)).save(bmp)
+    store = CalibrationStore(str(tmp_path / "store"))
+    cal = store.add_bmp(str(bmp), "A", 750, 30.0, 196)
+    assert cal.info["source"] == "CAL_TEST_750nm.bmp"
+    reference = PhaseComposer(196, (32, 40)).correction(str(bmp))
+    diff = (cal.fixed().astype(np.int64) - reference) % PHASE_ONE
+    assert np.all(np.minimum(diff, PHASE_ONE - diff) <= PHASE_ONE // 512)
+
+
+def test_interpolated_lookup_blends_mod_depth_and_lut(tmp_path):
+    store = CalibrationStore(str(tmp_path))
+    lo = store.add("A", 700, 30.0, 180, frame=random_phase(seed=1))
+    hi = store.add("A", 800, 30.0, 220, frame=random_phase(seed=2), lut=mod_depth_lut(220))
+    store.add("A", 1064, 30.0, 255)
+    cal = store.lookup("A", 775, 30.0, interpolate=True, max_wavelength_delta=100)
+    assert cal.mod_depth == 210
+    expected = np.rint(0.25 * mod_depth_lut(180) + 0.75 * mod_depth_lut(220))
+    np.testing.assert_array_equal(cal.lut, expected)
+    assert cal.frame is hi.frame and cal.info["interpolated"] == [lo.id, hi.id]
+    assert store.lookup("A", 700, 30.0, interpolate=True) is lo
+    # Without calibrations on both sides within the tolerance the nearest one is used
+    assert store.lookup("A", 775, 30.0, interpolate=True, max_wavelength_delta=30) is hi
+    assert store.lookup("A", 650, 30.0, interpolate=True, max_wavelength_delta=100) is lo
+    assert store.lookup("A", 775, 30.0, interpolate=True) is None
+
+
+def test_interpolated_lookup_uses_single_nearby_calibration(tmp_path):
+    store = CalibrationStore(str(tmp_path))
+    cal = store.add("A", 750, 30.0, 198)
+    for wavelength in (751, 752):
+        assert store.lookup("A", wavelength, 30.0, interpolate=True) is cal
+    assert store.lookup("A", 753, 30.0, interpolate=True) is None
+    with pytest.raises(ValueError):
+        store.add("A", 900, 30.0, 230, lut=np.zeros(256, dtype=np.uint8))
+
+
+def test_calibration_replaces_bmp_in_phase_gen_and_slm(tmp_path):
+    store = open_store(str(tmp_path))
+    assert open_store(str(tmp_path)) is store
+    lut = np.roll(mod_depth_lut(200), 5)
+    cal = store.add("LSH0803420", 752, 30.0, 200, frame=random_phase((1024, 1272)), lut=lut)
+    try:
+        phase_gen.use_calibration(cal)
+        assert phase_gen.mod_depth == 200
+        np.testing.assert_array_equal(phase_gen.load_correction_pattern(), cal.frame / 256)
+        assert phase_gen.get_composer().lut is cal.lut
+    finally:
+        phase_gen.use_calibration(None)
+        phase_gen.mod_depth = 198
+    assert phase_gen.get_composer().mod_depth == 198
+
+    slm = SlmHamamatsu(dll=StubSlmDll(), settle_time=0.0)
+    slm.connect()
+    slm.apply_calibration(store.lookup(slm.serial, 752, slm.check_temp()[0]))
+    assert slm.mod_depth == 200
+    slm.combine_and_upload_phase(diviX=16)
+    grating = slm.composer.component(("horizontal_grating", 16), None)
+    expected = np.take(lut, grating + cal.fixed())
+    np.testing.assert_array_equal(slm.final_phase, expected)
+
+    # No match for a later run: back to the BMP and the default mod_depth, nothing stale remains
+    slm.apply_calibration(store.lookup(slm.serial, 1064, slm.check_temp()[0]))
+    assert slm.calibration is None and slm.mod_depth == 198
+    slm.combine_and_upload_phase(diviX=16)
+    assert slm.composer.mod_depth == 198
+    np.testing.assert_array_equal(slm.composer.lut, mod_depth_lut(198))
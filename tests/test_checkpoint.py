@@ -0,0 +1,125 @@
+"""
+Tests for checkpointed, resumable wavefront measurements (function_scripts/checkpoint.py).
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import function_scripts.slmphase as slmphase
+from function_scripts.checkpoint import ScanCheckpoint
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+SCAN = dict(aperture_number=12, aperture_width=80, num_frames=1, roi_min_x=4, roi_min_y=3, roi_n=4,
+            pipeline_depth=2)
+
+
+class FlakyCamera(SimulatedCamera):
+    """SimulatedCamera that times out after a given number of exposures."""
+
+    def __init__(self, *args, fail_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_after = fail_after
+        self.exposures = 0
+
+    def grab_frame(self):
+        if self.fail_after is not None and self.exposures >= self.fail_after:
+            raise TimeoutError("camera timeout")
+        self.exposures += 1
+        return super().grab_frame()
+
+
+def make_bench(fail_after=None):
+    slm, shutter = SimulatedSlm(), SimulatedShutter()
+    cam = FlakyCamera(slm, shutter, beam_waist=3e-3, n_fft=1536, roi_shape=(48, 48), fail_after=fail_after)
+    return slm, cam, shutter
+
+
+def test_geometry_roundtrip_and_mismatch(tmp_path):
+    checkpoint = ScanCheckpoint(str(tmp_path))
+    assert checkpoint.load_geometry() is None
+    with pytest.raises(ValueError, match="nothing to resume"):
+        checkpoint.check_geometry({"roi_n": 4}, ["roi_n"])
+
+    checkpoint.save_geometry({"roi_n": 4, "binning": 1})
+    assert checkpoint.check_geometry({"roi_n": 4, "binning": 2}, ["roi_n"])["binning"] == 1
+    with pytest.raises(ValueError, match="binning"):
+        checkpoint.check_geometry({"roi_n": 4, "binning": 2}, ["roi_n", "binning"])
+
+    checkpoint.save_fit(phi=np.arange(3.0), fitted=np.array([True, False, True]))
+    state = checkpoint.load_fit()
+    np.testing.assert_array_equal(state["phi"], np.arange(3.0))
+    assert not os.path.exists(os.path.join(str(tmp_path), "fit_checkpoint.npz.part"))
+
+
+def test_interrupted_scan_resumes_without_reacquiring(tmp_path):
+    reference_dir = tmp_path / "reference"
+    reference_dir.mkdir()
+    retriever = PhaseAmplitudeRetriever(str(reference_dir))
+    retriever.measure_slm_wavefront(*make_bench(), **SCAN)
+    retriever.wait_for_results()
+    (run_dir,) = os.listdir(reference_dir)
+    reference = np.load(os.path.join(reference_dir, run_dir, "dphi.npy"))
+
+    # Background + 6 patches, then the camera times out
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    with pytest.raises(TimeoutError):
+        retriever.measure_slm_wavefront(*make_bench(fail_after=7), **SCAN)
+    save_dir = ScanCheckpoint.latest(str(tmp_path))
+    assert not os.path.exists(os.path.join(save_dir, "dphi.npy"))
+    assert ScanCheckpoint(save_dir).load_fit()["fitted"].sum() <= 6
+
+    slm, cam, shutter = make_bench()
+    retriever.measure_slm_wavefront(slm, cam, shutter, resume=True, **SCAN)
+    retriever.wait_for_results()
+    assert cam.exposures == 16 - 6
+    assert slm.uploads == 16 - 6
+    np.testing.assert_allclose(np.load(os.path.join(save_dir, "dphi.npy")), reference, atol=1e-9)
+    assert not os.path.exists(os.path.join(save_dir, "frames"))
+
+
+def test_resume_rejects_different_scan(tmp_path):
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    with pytest.raises(TimeoutError):
+        retriever.measure_slm_wavefront(*make_bench(fail_after=3), **SCAN)
+    with pytest.raises(ValueError, match="roi_n"):
+        retriever.measure_slm_wavefront(*make_bench(), resume=True, **dict(SCAN, roi_n=5))
+
+
+def test_completed_run_cannot_be_resumed(tmp_path):
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    # Aperture counts computed with numpy must still serialize to scan.json
+    scan = dict(SCAN, roi_n=np.int64(4), aperture_width=np.int64(80))
+    save_dir = retriever.measure_slm_wavefront(*make_bench(), **scan)
+    retriever.wait_for_results()
+    checkpoint = ScanCheckpoint(save_dir)
+    assert checkpoint.is_complete() and checkpoint.load_geometry()["roi_n"] == 4
+    assert not os.path.exists(os.path.join(save_dir, "frames"))
+
+    slm, cam, shutter = make_bench()
+    with pytest.raises(ValueError, match="already complete"):
+        retriever.measure_slm_wavefront(slm, cam, shutter, resume=True, **scan)
+    assert cam.exposures == 0 and slm.uploads == 0
+
+
+def test_run_failing_after_the_scan_stays_resumable(tmp_path, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("reconstruction failed")
+
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    with monkeypatch.context() as patch:
+        patch.setattr(slmphase, "build_correction", broken)
+        with pytest.raises(RuntimeError):
+            retriever.measure_slm_wavefront(*make_bench(), **SCAN)
+    save_dir = ScanCheckpoint.latest(str(tmp_path))
+    assert not ScanCheckpoint(save_dir).is_complete()
+    assert os.path.exists(os.path.join(save_dir, "frames"))
+
+    slm, cam, shutter = make_bench()
+    retriever.measure_slm_wavefront(slm, cam, shutter, resume=True, **SCAN)
+    retriever.wait_for_results()
+    assert cam.exposures == 0 and os.path.exists(os.path.join(save_dir, "dphi.npy"))
+    assert ScanCheckpoint(save_dir).is_complete()
+    assert not os.path.exists(os.path.join(save_dir, "frames"))
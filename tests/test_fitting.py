@@ -0,0 +1,104 @@
+"""
+Tests for the interferogram fitting routines in function_scripts/fitting.py.
+"""
+
+import numpy as np
+
+import function_scripts.fitting as ft
+from function_scripts.helpers import make_grid
+
+FL = 0.3
+K = 2 * np.pi / 752e-9
+CAM_PITCH = 6.5e-6
+
+
+def synthetic_stack(n_side=64, n_patch=6, noise=0.05, seed=0):
+    """Build a noisy fringe stack with known phases, amplitudes and offsets."""
+    rng = np.random.default_rng(seed)
+    x, y = make_grid(np.zeros((n_side, n_side)), scale=CAM_PITCH)
+    dx = rng.uniform(-3, 3, n_patch) * 64 * 12.5e-6
+    dy = rng.uniform(-3, 3, n_patch) * 64 * 12.5e-6
+    phi = rng.uniform(-np.pi, np.pi, n_patch)
+    amp = rng.uniform(0.5, 2.0, n_patch)
+
+    stack = np.empty((n_side, n_side, n_patch))
+    for i in range(n_patch):
+        carrier = K * (dx[i] * x + dy[i] * y) / FL
+        stack[..., i] = amp[i] * np.cos(carrier + phi[i])
+    stack += noise * rng.standard_normal(stack.shape)
+    return x, y, stack, dx, dy, phi, amp
+
+
+def wrap(a):
+    return np.angle(np.exp(1j * a))
+
+
+def test_fit_stack_recovers_phase_and_amplitude():
+    x, y, stack, dx, dy, phi, amp = synthetic_stack()
+    fit_phi, fit_amp, pcov, dphi_err = ft.FitSine(FL, K).fit_stack(x, y, stack, dx, dy, chunk_size=4)
+
+    np.testing.assert_allclose(wrap(fit_phi - phi), 0, atol=0.01)
+    np.testing.assert_allclose(fit_amp, amp, rtol=0.01)
+    assert pcov.shape == (len(phi), 2, 2)
+    assert np.all(dphi_err > 0) and np.all(dphi_err < 0.01)
+
+
+def test_fit_stack_matches_safe_fit():
+    x, y, stack, dx, dy, _, _ = synthetic_stack(n_patch=3)
+    fit_sine = ft.FitSine(FL, K)
+    fit_phi, fit_amp, _, _ = fit_sine.fit_stack(x, y, stack, dx, dy)
+
+    x_data = np.vstack((x.ravel(), y.ravel()))
+    popt = fit_sine.refine_stack(x_data, stack, dx, dy, fit_phi, fit_amp)
+
+    np.testing.assert_allclose(wrap(popt[:, 0] - fit_phi), 0, atol=1e-4)
+    np.testing.assert_allclose(popt[:, 1] * popt[:, 2], fit_amp, rtol=1e-4)
+
+
+def test_fft_backend_agrees_with_sine_fitter():
+    x, y, stack, dx, dy, phi, amp = synthetic_stack(n_patch=8, seed=1)
+    sine = ft.FitSine(FL, K).fit_stack(x, y, stack, dx, dy)
+    fft = ft.FitFFT(FL, K).fit_stack(x, y, stack, dx, dy, chunk_size=3)
+
+    np.testing.assert_allclose(wrap(fft[0] - sine[0]), 0, atol=0.01)
+    np.testing.assert_allclose(fft[1], sine[1], rtol=0.01)
+    np.testing.assert_allclose(wrap(fft[0] - phi), 0, atol=0.01)
+    np.testing.assert_allclose(fft[3], sine[3], rtol=0.3)
+
+
+def test_fft_demodulate_single_frame_on_bin_carrier():
+    n_side = 64
+    x, y = make_grid(np.zeros((n_side, n_side)), scale=CAM_PITCH)
+    fitter = ft.FitFFT(FL, K)
+    step = x[0, 1] - x[0, 0]
+    # Carrier exactly 5 bins along x
+    dx = 5 * 2 * np.pi / (n_side * step) * FL / K
+    fitter.set_dx_dy(dx, 0.0)
+    img = 1.5 * np.cos(fitter.kx * x + 0.7)
+    phi, amp = fitter.demodulate(x, y, img)
+    assert abs(wrap(phi - 0.7)) < 1e-9
+    assert abs(amp - 1.5) < 1e-9
+
+
+def test_refine_stack_process_pool_matches_serial():
+    x, y, stack, dx, dy, _, _ = synthetic_stack(n_patch=5, seed=2)
+    stack[..., 3] = 0  # degenerate patch: fit cannot start, safe_fit semantics apply
+    fit_sine = ft.FitSine(FL, K)
+    phi, amp, _, _ = fit_sine.fit_stack(x, y, stack, dx, dy)
+    x_data = np.vstack((x.ravel(), y.ravel()))
+
+    serial = fit_sine.refine_stack(x_data, stack, dx, dy, phi, amp)
+    pooled = fit_sine.refine_stack(x_data, stack, dx, dy, phi, amp, workers=2)
+    np.testing.assert_array_equal(pooled, serial)
+
+
+def test_fit_stack_handles_zero_carrier_reference_patch():
+    x, y, stack, dx, dy, phi, _ = synthetic_stack(n_patch=4)
+    dx[0] = dy[0] = 0.0
+    stack[..., 0] = 1.0  # the reference patch: no fringes, a flat frame
+    fit_phi, fit_amp, pcov, _ = ft.FitSine(FL, K).fit_stack(x, y, stack, dx, dy)
+    assert np.all(np.isfinite(fit_phi)) and np.all(np.isfinite(pcov))
+    np.testing.assert_allclose(wrap(fit_phi[1:] - phi[1:]), 0, atol=0.01)
+    fft_phi = ft.FitFFT(FL, K).fit_stack(x, y, stack, dx, dy)[0]
+    assert np.all(np.isfinite(fft_phi))
+    np.testing.assert_allclose(wrap(fft_phi[1:] - phi[1:]), 0, atol=0.01)
@@ -0,0 +1,100 @@
+"""
+Tests for the SLM frame-memory slot cache (slm/frame_memory.py) and its use in scans.
+"""
+
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from simulation.simulated_bench import SimulatedSlm
+from slm.frame_memory import FrameMemory
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+
+def recording_memory(n_slots=3):
+    log = []
+    memory = FrameMemory(lambda slot, image: log.append(("write", slot, image)),
+                         lambda slot: log.append(("switch", slot)), n_slots)
+    return memory, log
+
+
+def test_lru_eviction_keeps_displayed_slot():
+    memory, log = recording_memory()
+    memory.preload([("a", 0), ("b", 1), ("c", 2)])
+    assert [entry[1] for entry in log] == [1, 2, 3]
+    memory.show("a")
+    assert log[-1] == ("switch", 1) and memory.hits == 1
+
+    memory.load("d", 3)  # "b" is least recently used now
+    assert log[-1] == ("write", 2, 3) and "b" not in memory
+    memory.preload([("e", 4), ("f", 5)])  # evicts "c", then "d"; never the displayed "a"
+    assert memory.slot_of("a") == 1 and "c" not in memory and "d" not in memory
+    with pytest.raises(KeyError):
+        memory.show("b")
+
+
+def test_background_preload_and_errors():
+    gate = threading.Event()
+    written = []
+
+    def slow_write(slot, image):
+        gate.wait()
+        if image == "bad":
+            raise IOError("USB transfer failed")
+        written.append(slot)
+
+    memory = FrameMemory(slow_write, lambda slot: None, 4)
+    memory.preload([("a", 1), ("b", 2)], background=True)
+    assert written == []
+    gate.set()
+    memory.wait()
+    assert written == [1, 2] and memory.writes == 2
+
+    memory.preload([("c", "bad"), ("d", 4)], background=True)
+    with pytest.raises(IOError):
+        memory.wait()
+    assert "d" not in memory  # queued writes are dropped after a failure
+
+
+def test_hamamatsu_switches_slots_instead_of_uploading():
+    dll = StubSlmDll()
+    slm = SlmHamamatsu(dll=dll, settle_time=0.0, frame_slots=4)
+    slm.connect()
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 198, size=(3, 1024, 1272), dtype=np.uint8)
+
+    slm.preload([(i, frames[i]) for i in range(3)], background=True)
+    slm.frame_memory.wait()
+    assert [w[1] for w in dll.writes] == [1, 2, 3]
+    for i in (2, 0, 2):
+        assert slm.display(i) is False
+    assert dll.switches == [(1, 3), (1, 1), (1, 3)]
+    np.testing.assert_array_equal(dll.frames[dll.displayed_slot], frames[2])
+    assert len(dll.writes) == 3
+
+    slm.load_phase(frames[1])  # direct uploads go to slot 0 and display it
+    assert dll.writes[-1][1] == 0 and dll.displayed_slot == 0
+    assert slm.display("new", frames[1]) is True and dll.writes[-1][1] == 4
+
+
+def test_scan_from_frame_memory_matches_direct_uploads(tmp_path, aberration, bench):
+    results = {}
+    for slots in (0, 6):
+        slm, cam, shutter = bench(aberration, slm=SimulatedSlm(frame_slots=slots))
+        data_dir = tmp_path / f"slots{slots}"
+        data_dir.mkdir()
+        retriever = PhaseAmplitudeRetriever(str(data_dir))
+        retriever.measure_slm_wavefront(slm, cam, shutter, aperture_number=12, aperture_width=80,
+                                        num_frames=2, roi_min_x=4, roi_min_y=3, roi_n=4, plots=False)
+        retriever.wait_for_results()
+        (run_dir,) = os.listdir(data_dir)
+        results[slots] = np.load(os.path.join(data_dir, run_dir, "dphi.npy")), slm
+
+    np.testing.assert_allclose(results[6][0], results[0][0], atol=1e-9)
+    slm = results[6][1]
+    assert slm.uploads == 1  # background frame only
+    assert slm.slot_writes == 16 and slm.switches == 16
@@ -0,0 +1,109 @@
+"""
+Tests for the chunked interferogram store in function_scripts/frame_store.py.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import function_scripts.fitting as ft
+from function_scripts.frame_store import FrameStore
+from function_scripts.helpers import make_grid
+from function_scripts.pipeline import run_pipelined
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+
+
+def test_write_read_roundtrip_across_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 4000, (10, 6, 5)).astype(np.uint16)
+    background = np.full((6, 5), 100.0)
+    store = FrameStore(str(tmp_path / "s"), (6, 5), 10, dtype=np.uint16, chunk_frames=4, background=background)
+    for i, frame in enumerate(frames):
+        store.write(i, frame, patch_id=10 + i, dx=i * 1e-4, dy=-i * 1e-4)
+    assert store.n_written == 10
+    assert len(list((tmp_path / "s").glob("frames_*.npy"))) == 3
+
+    stack = store.read([1, 9, 4])
+    assert stack.shape == (6, 5, 3)
+    np.testing.assert_array_equal(stack[..., 1], frames[9] - 100.0)
+
+    blocks = list(store.iter_chunks(max_frames=3))
+    assert [list(idx) for idx, _ in blocks] == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    store.close()
+
+    reopened = FrameStore.open(str(tmp_path / "s"))
+    assert reopened.dtype == np.uint16 and reopened.frame_shape == (6, 5)
+    np.testing.assert_array_equal(reopened.index["patch_id"], np.arange(10, 20))
+    np.testing.assert_array_equal(reopened.read(np.arange(10)), np.moveaxis(frames - 100.0, 0, -1))
+
+
+def test_float_frames_are_rounded_into_integer_stores(tmp_path):
+    store = FrameStore(str(tmp_path / "s"), (2, 3), 1, dtype=np.uint16)
+    store.write(0, np.array([[0.4, 0.6, 1.5], [2.49, -3.0, 70000.0]], dtype=np.float32))
+    np.testing.assert_array_equal(store.read([0])[..., 0], [[0, 1, 2], [2, 0, 65535]])
+
+
+def test_multiplexed_frames_record_every_patch(tmp_path):
+    store = FrameStore(str(tmp_path / "s"), (4, 4), 3, chunk_frames=2, patches_per_frame=3)
+    store.write(0, np.zeros((4, 4)), [5, 7, 9], [1e-4, 2e-4, 3e-4], [0.0, -1e-4, -2e-4], 2)
+    store.write(1, np.ones((4, 4)), [4], [4e-4], [1e-4], 3)
+    with pytest.raises(ValueError):
+        store.write(2, np.ones((4, 4)), [1, 2, 3, 6], [0] * 4, [0] * 4)
+    store.close()
+
+    reopened = FrameStore.open(str(tmp_path / "s"))
+    assert reopened.patches_per_frame == 3
+    columns, ids, dx, dy, n_frames = reopened.patches([1, 0])
+    np.testing.assert_array_equal(columns, [0, 1, 1, 1])
+    np.testing.assert_array_equal(ids, [4, 5, 7, 9])
+    np.testing.assert_allclose(dx, [4e-4, 1e-4, 2e-4, 3e-4])
+    np.testing.assert_allclose(dy, [1e-4, 0.0, -1e-4, -2e-4])
+    np.testing.assert_array_equal(n_frames, [3, 2, 2, 2])
+    assert reopened.read([1, 0])[..., columns].shape == (4, 4, 4)
+
+
+def test_serial_pipeline_respects_max_batch():
+    calls = []
+    run_pipelined(lambda i: i, lambda idx, items: calls.append(list(idx)), 5, queue_depth=0, max_batch=2)
+    assert calls == [[0, 1], [2, 3], [4]]
+
+
+def test_saved_frames_can_be_refitted(tmp_path, bench):
+    slm, cam, shutter = bench(roi_shape=(48, 40), seed=0)
+    PhaseAmplitudeRetriever(str(tmp_path)).measure_slm_wavefront(
+        slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=1,
+        roi_min_x=4, roi_min_y=3, roi_n=3, sv_data=True,
+    )
+    (run_dir,) = os.listdir(tmp_path)
+    store = FrameStore.open(os.path.join(tmp_path, run_dir, "frames"))
+    assert store.frame_shape == (48, 40)
+    assert store.n_written == 9
+    assert store.dtype == np.float32
+    assert np.all(np.diff(store.index["timestamp"]) >= 0)
+    assert store.read([0]).shape == (48, 40, 1)
+
+
+def test_saved_multiplexed_frames_can_be_refitted(tmp_path, bench):
+    slm, cam, shutter = bench()
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    retriever.measure_slm_wavefront(
+        slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=1,
+        roi_min_x=2, roi_min_y=2, roi_n=6, multiplex=3, fit_backend="fft", sv_data=True,
+    )
+    retriever.wait_for_results()
+    (run_dir,) = os.listdir(tmp_path)
+    dphi = np.load(os.path.join(tmp_path, run_dir, "dphi.npy"))
+    store = FrameStore.open(os.path.join(tmp_path, run_dir, "frames"))
+    assert store.patches_per_frame > 1 and store.n_written < dphi.size
+
+    frames = np.flatnonzero(store.index["written"])
+    columns, ids, dx, dy, _ = store.patches(frames)
+    assert np.array_equal(np.sort(ids), np.unique(ids)) and ids.size == dphi.size
+    x, y = make_grid(store.background, scale=cam.pitch, dtype=np.float32, sparse=True)
+    phi = ft.FitFFT(0.3, retriever.k).fit_stack(
+        x, y, store.read(frames)[..., columns], dx, dy)[0]
+    # Patches are stored in scan order, so the aperture indices sort into the dphi layout
+    refit = np.empty(ids.size)
+    refit[np.argsort(np.argsort(ids))] = -phi
+    np.testing.assert_allclose(np.angle(np.exp(1j * (refit - dphi.ravel()))), 0, atol=1e-6)
@@ -0,0 +1,74 @@
+"""
+Tests for the memoized coordinate grids in function_scripts/helpers.py.
+"""
+
+import numpy as np
+import pytest
+
+import function_scripts.fitting as ft
+from function_scripts import helpers
+from function_scripts.helpers import clear_grid_cache, make_grid, meshgrid_slm
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+CAM_PITCH = 6.5e-6
+
+
+def test_make_grid_matches_meshgrid_and_is_cached_read_only():
+    img = np.zeros((30, 40))
+    x, y = make_grid(img, scale=CAM_PITCH)
+    ref_x, ref_y = np.meshgrid(np.linspace(-20 * CAM_PITCH, 20 * CAM_PITCH, 40),
+                               np.linspace(-15 * CAM_PITCH, 15 * CAM_PITCH, 30))
+    np.testing.assert_array_equal(x, ref_x)
+    np.testing.assert_array_equal(y, ref_y)
+    assert x.dtype == np.float64 and not x.flags.writeable
+    with pytest.raises(ValueError):
+        x[0, 0] = 1.0
+
+    x2, _ = make_grid(np.ones((30, 40)), scale=CAM_PITCH)
+    assert np.shares_memory(x, x2)
+
+    xs, ys = make_grid(img, scale=CAM_PITCH, dtype=np.float32, sparse=True)
+    assert xs.shape == (1, 40) and ys.shape == (30, 1) and xs.dtype == np.float32
+    np.testing.assert_allclose(xs + 0 * ys, ref_x, rtol=1e-6)
+
+
+def test_grid_cache_is_bounded():
+    clear_grid_cache()
+    for n in range(helpers.GRID_CACHE_SIZE + 4):
+        make_grid(np.zeros((4, 4 + n)))
+    assert helpers._grid_axes.cache_info().currsize == helpers.GRID_CACHE_SIZE
+
+
+def test_meshgrid_slm_defaults_to_float64_and_driver_grids_stay_writable():
+    x, y = meshgrid_slm((12.8e-3, 12.8e-3), 12.5e-6)
+    assert x.shape == y.shape == (1024, 1024) and x.dtype == np.float64
+    np.testing.assert_array_equal(x, y.T)
+    xs, _ = meshgrid_slm((12.8e-3, 12.8e-3), 12.5e-6, dtype=np.float32, sparse=True)
+    assert xs.shape == (1, 1024) and xs.dtype == np.float32
+
+    slm_x, slm_y = SlmHamamatsu(dll=StubSlmDll()).meshgrid_slm
+    ref_x, ref_y = np.meshgrid(np.arange(-6.4e-3, 6.4e-3, 12.5e-6), np.arange(-6.4e-3, 6.4e-3, 12.5e-6))
+    np.testing.assert_array_equal(slm_x, ref_x)
+    np.testing.assert_array_equal(slm_y, ref_y)
+    slm_x[0, 0] = 1.0
+    assert x[0, 0] != 1.0
+
+
+def test_fit_stack_on_sparse_float32_axes_matches_dense_grid():
+    rng = np.random.default_rng(3)
+    fl, k = 0.3, 2 * np.pi / 752e-9
+    img = np.zeros((48, 64))
+    x, y = make_grid(img, scale=CAM_PITCH)
+    xs, ys = make_grid(img, scale=CAM_PITCH, dtype=np.float32, sparse=True)
+    dx = rng.uniform(-3, 3, 5) * 64 * 12.5e-6
+    dy = rng.uniform(-3, 3, 5) * 64 * 12.5e-6
+    stack = np.cos(k * (np.multiply.outer(x, dx) + np.multiply.outer(y, dy)) / fl + rng.uniform(-3, 3, 5))
+    stack += 0.05 * rng.standard_normal(stack.shape)
+
+    fitter = ft.FitSine(fl, k)
+    phi, amp, _, err = fitter.fit_stack(x, y, stack, dx, dy)
+    phi_s, amp_s, _, err_s = fitter.fit_stack(xs, ys, stack, dx, dy)
+    np.testing.assert_allclose(np.angle(np.exp(1j * (phi_s - phi))), 0, atol=1e-4)
+    np.testing.assert_allclose(amp_s, amp, rtol=1e-4)
+    np.testing.assert_allclose(err_s, err, rtol=1e-3)
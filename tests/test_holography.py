@@ -0,0 +1,84 @@
+"""
+Tests for the GS / weighted-GS hologram engine (function_scripts/holography.py).
+"""
+
+import numpy as np
+import pytest
+
+import function_scripts.phase_gen as phase_gen
+from function_scripts.holography import HologramEngine, lg_target, spot_array_target, vortex_phase
+from function_scripts.phase_compose import PhaseComposer, to_fixed
+
+SPOTS = np.array([(r, c) for r in (-20, 0, 20) for c in (-30, -10, 10, 30)]) + [5, 7]
+
+
+def spot_intensities(engine, phase):
+    far = engine.far_field(phase)
+    return far[..., SPOTS[:, 0] + engine.fft_shape[0] // 2, SPOTS[:, 1] + engine.fft_shape[1] // 2], far
+
+
+def test_fft_grid_is_padded_to_fast_lengths():
+    assert HologramEngine().fft_shape == (1024, 1280)
+    with pytest.raises(ValueError):
+        HologramEngine((64, 80), fft_shape=(64, 64))
+
+
+def test_weighted_gs_equalizes_spot_array():
+    engine = HologramEngine((128, 160))
+    target = spot_array_target(engine.fft_shape, SPOTS)
+    spots = {}
+    for weighted in (False, True):
+        phase = engine.compute(target, n_iter=30, weighted=weighted)
+        assert phase.dtype == np.float32 and phase.shape == (128, 160)
+        assert phase.min() >= 0 and phase.max() < 1
+        spots[weighted], far = spot_intensities(engine, phase)
+        assert spots[weighted].sum() / far.sum() > 0.85
+    plain, weighted = (np.std(s) / np.mean(s) for s in (spots[False], spots[True]))
+    assert weighted < 0.01 < plain
+
+
+def test_lg_donut_target_is_reproduced():
+    engine = HologramEngine((128, 160))
+    target = lg_target(engine.fft_shape, l=1, waist=6)
+    far = engine.far_field(engine.compute(target, n_iter=50))
+    assert np.corrcoef(far.ravel(), target.ravel())[0, 1] > 0.99
+    # The analytic vortex gives the donut's dark centre directly
+    far = engine.far_field(vortex_phase((128, 160), charge=1, center=(64, 80)))
+    assert far[64, 80] < 1e-3 * far.max()
+
+
+def test_batch_matches_single_targets_and_reuses_buffers():
+    engine = HologramEngine((64, 80))
+    targets = np.stack([spot_array_target(engine.fft_shape, SPOTS // 2),
+                        lg_target(engine.fft_shape, l=2, waist=5)])
+    batch = engine.compute(targets, n_iter=10, seed=3)
+    field = engine._field
+    assert batch.shape == (2, 64, 80) and field.dtype == np.complex64
+    init = np.random.default_rng(3).random((2, 64, 80))
+    for i in range(2):
+        single = HologramEngine((64, 80)).compute(targets[i], n_iter=10, init_phase=init[i:i + 1])
+        np.testing.assert_allclose(batch[i], single, atol=1e-4)
+    engine.compute(targets, n_iter=2)
+    assert engine._field is field
+    with pytest.raises(ValueError):
+        engine.compute(np.zeros(engine.fft_shape))
+
+
+def test_hologram_is_composed_into_slm_frames():
+    shape = (64, 80)
+    old = dict(phase_gen.which_phases), phase_gen.grating, phase_gen.patch
+    try:
+        target = spot_array_target(phase_gen.get_engine(shape).fft_shape, SPOTS // 2)
+        holo = phase_gen.compute_hologram(target, shape=shape, n_iter=5)
+        assert phase_gen.hologram is holo
+        phase_gen.linear_grating(shape, period_px=8)
+        phase_gen.patch = None
+        phase_gen.which_phases = {"grating": True, "patch": False, "corr_patt": False,
+                                  "corr_phase": False, "hologram": True}
+        frame = phase_gen.make_full_slm_array(out=np.empty(shape, dtype=np.uint8))
+        composer = PhaseComposer(phase_gen.mod_depth, shape)
+        expected = composer.compose([to_fixed(phase_gen.grating), to_fixed(holo)])
+        np.testing.assert_array_equal(frame, expected)
+    finally:
+        phase_gen.which_phases, phase_gen.grating, phase_gen.patch = old
+        phase_gen.hologram = None
@@ -0,0 +1,72 @@
+"""
+Tests for per-stage timing in function_scripts/instrumentation.py.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+from function_scripts.instrumentation import StageProfiler
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+
+def test_nested_stages_inherit_arguments_and_feed_hooks():
+    prof = StageProfiler()
+    seen = []
+    prof.add_hook(seen.append)
+    with prof.stage("upload", frame=3, patches=[7]):
+        t0 = time.perf_counter()
+        prof.record("slm.settle", t0, 0.002)
+    with prof.stage("exposure", frame=3):
+        pass
+
+    assert [e["name"] for e in seen] == ["slm.settle", "upload", "exposure"]
+    assert seen[0]["args"] == {"frame": 3, "patches": [7]}
+    (record,) = prof.frame_records()
+    assert record["frame"] == 3 and record["patches"] == [7] and record["slm.settle"] == 0.002
+    summary = prof.summary()
+    assert summary["upload"]["count"] == 1 and summary["slm.settle"]["total"] == 0.002
+    assert "slm.settle" in prof.table()
+
+
+def test_disabled_profiler_records_nothing():
+    prof = StageProfiler(enabled=False)
+    with prof.stage("fit"):
+        pass
+    prof.record("slm.upload", 0.0, 1.0)
+    assert prof.events == [] and prof.frame_records() == []
+
+
+def test_hamamatsu_records_upload_and_settle():
+    slm = SlmHamamatsu(dll=StubSlmDll(), settle_time=0.01)
+    slm.connect()
+    slm.profiler = StageProfiler()
+    slm.load_phase(np.zeros((1024, 1272), dtype=np.uint8))
+    summary = slm.profiler.summary()
+    assert set(summary) == {"slm.upload", "slm.settle"}
+    assert summary["slm.settle"]["total"] >= 0.01
+
+
+def test_measurement_exports_trace(tmp_path):
+    slm, shutter = SimulatedSlm(settle_time=0.002), SimulatedShutter()
+    cam = SimulatedCamera(slm, shutter, beam_waist=3e-3, n_fft=1536, roi_shape=(48, 48), seed=0)
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    retriever.measure_slm_wavefront(slm, cam, shutter, aperture_number=12, aperture_width=80,
+                                    num_frames=1, roi_min_x=5, roi_min_y=5, roi_n=2, plots=False)
+    retriever.wait_for_results()
+
+    (run_dir,) = os.listdir(tmp_path)
+    with open(os.path.join(tmp_path, run_dir, "timing_trace.json")) as f:
+        trace = json.load(f)
+    names = {e["name"] for e in trace["traceEvents"] if e["ph"] == "X"}
+    assert {"compose_frames", "background", "upload", "slm.settle", "exposure", "read_frames",
+            "fit", "reconstruct"} <= names
+    frames = trace["otherData"]["frames"]
+    assert [r["frame"] for r in frames] == [0, 1, 2, 3]
+    assert all(r["slm.settle"] >= 0.002 and r["exposure"] > 0 for r in frames)
+    assert trace["otherData"]["summary"]["fit"]["count"] >= 1
@@ -0,0 +1,78 @@
+"""
+Tests for frequency-multiplexed acquisition (function_scripts/multiplex.py).
+"""
+
+import os
+
+import numpy as np
+
+import function_scripts.patch_sequence as ps
+from function_scripts.multiplex import components, plan_groups, separable
+from function_scripts.phase_compose import PhaseComposer, to_fixed
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+
+
+def grid_offsets(n=8, width=80):
+    rows, cols = np.divmod(np.arange(n * n), n)
+    return np.c_[(rows - n // 2) * width, (cols - n // 2) * width]
+
+
+def test_components_and_separation():
+    comps = components([[0, 160], [160, 0]])
+    assert len(comps) == 1 + 2 + 2 + 2
+    assert separable([[0, 160], [160, 0]], 160)
+    assert not separable([[0, 160], [0, 320]], 160)  # cross term lands on the first sideband
+    assert not separable([[0, 160], [160, 0]], 160, max_offset=(100, 100))
+
+
+def test_plan_covers_every_patch_once_with_separable_frames():
+    offsets = grid_offsets()
+    plan = plan_groups(offsets, 4, 80)
+    assert plan.shape[1] == 4
+    members = plan[plan >= 0]
+    np.testing.assert_array_equal(np.sort(members), np.arange(len(offsets)))
+    assert len(plan) < len(offsets) // 1.5
+    for row in plan:
+        row = row[row >= 0]
+        assert separable(offsets[row], 160, np.abs(offsets).max(axis=0))
+    # Patches next to the reference cannot share a frame
+    near = np.flatnonzero(np.abs(offsets).max(axis=1) < 160)
+    for i in near:
+        assert np.count_nonzero(plan[np.any(plan == i, axis=1)] >= 0) == 1
+
+
+def test_patch_sequence_frames_show_all_grouped_apertures():
+    shape = (64, 80)
+    composer = PhaseComposer(198, shape)
+    grating = np.mod(np.arange(shape[1]), 8) / 8 * np.ones((shape[0], 1))
+    bounds = ps.aperture_bounds(5, 4, 0, 0, 16, 16)
+    ps._last_sequence = None
+    seq = ps.PatchSequence.build(composer, grating, bounds, 7, np.array([[0, 12, -1], [3, -1, -1]]))
+    fixed = to_fixed(grating)
+    expected = composer.levels(np.zeros(shape, dtype=np.uint16)).copy()
+    for idx in (7, 0, 12):
+        region = np.s_[bounds[0][idx]:bounds[1][idx], bounds[2][idx]:bounds[3][idx]]
+        expected[region] = composer.levels(fixed[region])
+    np.testing.assert_array_equal(seq[0], expected)
+    assert len(seq) == 2
+
+
+def test_multiplexed_scan_matches_single_patch_scan(tmp_path, aberration, bench, remove_piston_tilt):
+    results = {}
+    for k in (1, 3):
+        slm, cam, shutter = bench(aberration)
+        data_dir = tmp_path / f"k{k}"
+        data_dir.mkdir()
+        retriever = PhaseAmplitudeRetriever(str(data_dir))
+        retriever.measure_slm_wavefront(
+            slm, cam, shutter, aperture_number=12, aperture_width=80, num_frames=2,
+            roi_min_x=2, roi_min_y=2, roi_n=8, multiplex=k, fit_backend="fft",
+        )
+        retriever.wait_for_results()
+        (run_dir,) = os.listdir(data_dir)
+        results[k] = np.load(os.path.join(data_dir, run_dir, "dphi.npy")), slm.uploads
+
+    (single, single_uploads), (multi, multi_uploads) = results[1], results[3]
+    assert multi_uploads < 0.6 * single_uploads
+    diff = remove_piston_tilt(np.angle(np.exp(1j * (multi - single))))
+    assert np.sqrt(np.mean(diff ** 2)) < 0.06
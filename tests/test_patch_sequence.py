@@ -0,0 +1,88 @@
+"""
+Tests for the precomputed patch frame sequences in function_scripts/patch_sequence.py.
+"""
+
+import numpy as np
+
+import function_scripts.patch_sequence as ps
+import function_scripts.phase_gen as phase_gen
+from function_scripts.phase_compose import PhaseComposer, to_fixed
+
+SHAPE = (96, 120)
+WIDTH = 16
+
+
+def legacy_bounds(n_ap_x, n_ap_y, x_min, y_min, dx, dy):
+    """The original list-based _get_aperture_indices."""
+    top, bot, left, right = [], [], [], []
+    for i in [int(y_min + i * dy) for i in range(n_ap_y)]:
+        for j in [int(x_min + i * dx) for i in range(n_ap_x)]:
+            top.append(i)
+            bot.append(i + dy)
+            left.append(j)
+            right.append(j + dx)
+    return top, bot, left, right
+
+
+def scan_inputs():
+    grating = phase_gen.linear_grating(SHAPE, 8)
+    bounds = ps.aperture_bounds(6, 6, 0, 0, WIDTH, WIDTH)
+    correction = to_fixed(np.random.default_rng(0).uniform(0, 1, SHAPE))
+    return grating, bounds, correction
+
+
+def test_aperture_bounds_match_legacy_lists():
+    for args in [(6, 6, 0, 0, 16, 16), (5, 3, 2.5, 1, 10, 7)]:
+        for new, old in zip(ps.aperture_bounds(*args), legacy_bounds(*args)):
+            np.testing.assert_array_equal(new, old)
+
+
+def test_frames_match_per_patch_composition():
+    grating, bounds, correction = scan_inputs()
+    composer = PhaseComposer(198, SHAPE)
+    centre, indices = 14, np.array([0, 7, 14, 35])
+    seq = ps.PatchSequence.build(composer, grating, bounds, centre, indices, static=[correction])
+
+    top, bot, left, right = bounds
+    for i, idx in enumerate(indices):
+        masked = np.zeros(SHAPE)
+        for j in (centre, idx):
+            masked[top[j]:bot[j], left[j]:right[j]] = grating[top[j]:bot[j], left[j]:right[j]]
+        expected = composer.compose([correction, to_fixed(masked)]).copy()
+        np.testing.assert_array_equal(seq[i], expected)
+
+
+def test_stack_is_memory_mapped_and_reused(tmp_path, monkeypatch):
+    grating, bounds, correction = scan_inputs()
+    composer = PhaseComposer(198, SHAPE)
+    indices = np.arange(8)
+    first = ps.PatchSequence.build(composer, grating, bounds, 14, indices, [correction], cache_dir=str(tmp_path))
+    assert isinstance(first.frames, np.memmap)
+    assert [p.name for p in tmp_path.iterdir()] == [f"patch_frames_{first.key[:16]}.npy"]
+
+    # A new process (no in-memory sequence) maps the stored stack instead of recomposing
+    monkeypatch.setattr(ps, "_last_sequence", None)
+    monkeypatch.setattr(composer, "levels", None)
+    second = ps.PatchSequence.build(composer, grating, bounds, 14, indices, [correction], cache_dir=str(tmp_path))
+    assert second.key == first.key
+    np.testing.assert_array_equal(second.frames, first.frames)
+
+    # Different geometry gives a different key
+    composer.mod_depth = 150
+    monkeypatch.undo()
+    third = ps.PatchSequence.build(composer, grating, bounds, 14, indices, [correction], cache_dir=str(tmp_path))
+    assert third.key != first.key
+
+
+def test_frames_without_cache_are_composed_on_access():
+    grating, bounds, correction = scan_inputs()
+    composer = PhaseComposer(198, SHAPE)
+    seq = ps.PatchSequence.build(composer, grating, bounds, 14, np.arange(36), [correction])
+    assert seq.frames is None and len(seq) == 36
+    first = seq[3]
+    assert first is not seq[3]  # every access returns a new frame
+    np.testing.assert_array_equal(first, seq[3])
+    # The last sequence is reused while it is alive, and not kept alive by the module
+    assert ps.PatchSequence.build(composer, grating, bounds, 14, np.arange(36), [correction]) is seq
+    del seq
+    assert ps._last_sequence() is None
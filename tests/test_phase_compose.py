@@ -0,0 +1,93 @@
+"""
+Tests for the cached fixed-point phase composition in function_scripts/phase_compose.py.
+"""
+
+import os
+
+import numpy as np
+from PIL import Image
+
+import function_scripts.phase_gen as phase_gen
+from function_scripts.helpers import mod_1
+from function_scripts.phase_compose import PhaseComposer, to_fixed
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+SHAPE = (64, 80)
+
+
+def write_bmp(path, seed):
+    data = np.random.default_rng(seed).integers(0, 256, SHAPE, dtype=np.uint8)
+    Image.fromarray(data).save(path)
+
+
+def test_fixed_point_matches_float_composition():
+    rng = np.random.default_rng(0)
+    a, b = rng.uniform(0, 1, SHAPE), rng.uniform(-2, 3, SHAPE)
+    composer = PhaseComposer(mod_depth=198, shape=SHAPE)
+    frame = composer.compose([to_fixed(a), to_fixed(b)])
+    reference = (mod_1(a + b) * 198).astype(np.uint8)
+
+    diff = frame.astype(int) - reference
+    # Grey levels agree up to rounding at level boundaries (and the 0 / 197 wrap)
+    assert np.all((np.abs(diff) <= 1) | (np.abs(diff) == 197))
+    assert np.mean(diff == 0) > 0.99
+
+
+def test_compose_writes_in_place_and_memoizes_components():
+    composer = PhaseComposer(mod_depth=100, shape=SHAPE)
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return np.full(SHAPE, 0.25)
+
+    first = composer.component(("grating", 4), factory)
+    assert composer.component(("grating", 4), factory) is first
+    assert len(calls) == 1
+
+    out = np.zeros(SHAPE, dtype=np.uint8)
+    assert composer.compose([first, first], out=out) is out
+    assert np.all(out == 50)
+
+
+def test_correction_reloaded_only_when_file_changes(tmp_path):
+    path = str(tmp_path / "corr.bmp")
+    write_bmp(path, 0)
+    composer = PhaseComposer(shape=SHAPE)
+
+    first = composer.correction(path)
+    assert composer.correction(path) is first
+
+    write_bmp(path, 1)
+    mtime = os.path.getmtime(path)
+    os.utime(path, (mtime + 5, mtime + 5))
+    second = composer.correction(path)
+    assert second is not first
+    assert not np.array_equal(second, first)
+    assert composer.correction(str(tmp_path / "missing.bmp")) is None
+
+
+def test_phase_gen_uses_cached_grating_and_correction(tmp_path):
+    write_bmp(str(tmp_path / "corr.bmp"), 2)
+    phase_gen.correction_path = str(tmp_path)
+    phase_gen.mod_depth = 198
+    grating = phase_gen.linear_grating(SHAPE, 8)
+    assert phase_gen.linear_grating(SHAPE, 8) is grating
+
+    phase_gen.patch = None
+    phase_gen.which_phases = {"grating": True, "patch": False, "corr_patt": True, "corr_phase": False}
+    frame = phase_gen.make_full_slm_array().copy()
+    reference = (mod_1(grating + phase_gen.load_correction_pattern(SHAPE)) * 198).astype(np.uint8)
+    assert np.mean(frame == reference) > 0.99
+
+
+def test_slm_combine_and_upload_composes_into_final_phase():
+    slm = SlmHamamatsu(dll=StubSlmDll(), settle_time=0.0)
+    slm.connect()
+    buffer = slm.final_phase
+    slm.combine_and_upload_phase()
+    assert slm.final_phase is buffer
+    reference = (mod_1(slm.generate_horizontal_grating()) * slm.mod_depth).astype(np.uint8)
+    assert np.mean(slm.final_phase == reference) > 0.99
+    np.testing.assert_array_equal(slm.slmffi.frames[0], slm.final_phase)
@@ -0,0 +1,78 @@
+"""
+Tests for the acquisition/fitting pipeline in function_scripts/pipeline.py.
+"""
+
+import threading
+import time
+
+import pytest
+
+from function_scripts.pipeline import run_pipelined
+
+
+def test_items_consumed_in_order_with_bounded_queue():
+    consumed = []
+    in_flight = []
+    produced = [0]
+    lock = threading.Lock()
+
+    def acquire(i):
+        with lock:
+            produced[0] += 1
+        return i * 10
+
+    def consume(indices, items):
+        with lock:
+            in_flight.append(produced[0] - len(consumed))
+        time.sleep(0.005)
+        consumed.extend(zip(indices, items))
+
+    run_pipelined(acquire, consume, 50, queue_depth=3)
+    assert consumed == [(i, i * 10) for i in range(50)]
+    # Queue depth plus the item being acquired bounds what is waiting
+    assert max(in_flight) <= 3 + 1
+
+
+def test_acquisition_overlaps_consumption():
+    def acquire(i):
+        time.sleep(0.03)
+        return i
+
+    def consume(indices, items):
+        time.sleep(0.03 * len(items))
+
+    start = time.perf_counter()
+    run_pipelined(acquire, consume, 10, queue_depth=2, max_batch=1)
+    pipelined = time.perf_counter() - start
+    assert pipelined < 0.5  # serial would take 0.6 s
+
+
+def test_serial_mode_consumes_one_batch():
+    calls = []
+    run_pipelined(lambda i: i, lambda idx, items: calls.append(list(items)), 4, queue_depth=0)
+    assert calls == [[0, 1, 2, 3]]
+
+
+def test_producer_error_is_raised_in_caller():
+    def acquire(i):
+        if i == 2:
+            raise RuntimeError("camera timeout")
+        return i
+
+    with pytest.raises(RuntimeError, match="camera timeout"):
+        run_pipelined(acquire, lambda idx, items: None, 5, queue_depth=1)
+
+
+def test_consumer_error_stops_producer():
+    acquired = []
+
+    def acquire(i):
+        acquired.append(i)
+        return i
+
+    def consume(indices, items):
+        raise ValueError("fit failed")
+
+    with pytest.raises(ValueError):
+        run_pipelined(acquire, consume, 100, queue_depth=1)
+    assert len(acquired) < 100
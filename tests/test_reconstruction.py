@@ -0,0 +1,88 @@
+"""
+Tests for the full-resolution correction reconstruction in function_scripts/reconstruction.py.
+"""
+
+import os
+import time
+
+import numpy as np
+
+import function_scripts.phase_gen as phase_gen
+from function_scripts.reconstruction import (
+    build_correction, correction_frame, unwrap_phase, upsample, weighted_smooth,
+)
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from function_scripts.zernike import correction_from_record
+
+
+def smooth_phase(shape=(20, 24)):
+    yy, xx = np.indices(shape) / 10.0
+    return 3 * (xx ** 2 + yy ** 2) + 2 * xx * yy
+
+
+def test_unwrap_recovers_phase_beyond_2pi():
+    truth = smooth_phase()
+    assert np.ptp(truth) > 4 * np.pi
+    unwrapped = unwrap_phase(np.angle(np.exp(1j * truth)))
+    np.testing.assert_allclose(unwrapped, truth - truth.mean(), atol=1e-9)
+
+
+def test_weighted_smooth_ignores_dark_cells():
+    phase = np.zeros((9, 9))
+    weights = np.ones((9, 9))
+    phase[4, 4], weights[4, 4] = 10.0, 0.0
+    assert abs(weighted_smooth(phase, weights, sigma=1.0)[4, 4]) < 1e-12
+
+
+def test_upsample_is_exact_for_ramps_and_clamped_outside():
+    grid = np.add.outer(np.arange(4.0), 2 * np.arange(5.0))
+    full = upsample(grid, (200, 300), top=20, left=40, cell=40)
+    # Cell i is centred on pixel start + 40 * i + 19.5; inside the centres the ramp is exact
+    rows = (np.arange(200) + 0.5 - 20) / 40 - 0.5
+    cols = (np.arange(300) + 0.5 - 40) / 40 - 0.5
+    inside = np.ix_((rows >= 0) & (rows <= 3), (cols >= 0) & (cols <= 4))
+    np.testing.assert_allclose(full[inside], np.add.outer(rows, 2 * cols)[inside], atol=1e-5)
+    np.testing.assert_allclose(full[:39, :59], grid[0, 0])
+    np.testing.assert_allclose(full[-1, -1], grid[-1, -1])
+
+
+def test_full_resolution_correction_is_fast():
+    dphi = np.angle(np.exp(1j * smooth_phase((24, 24))))
+    amp = np.ones((24, 24))
+    build_correction(dphi, amp, cell=40)
+    t0 = time.perf_counter()
+    correction = build_correction(dphi, amp, cell=40)
+    frame = correction_frame(correction, 198)
+    elapsed = time.perf_counter() - t0
+    assert correction.shape == (1024, 1272) and correction.dtype == np.float32
+    assert 0 <= correction.min() and correction.max() < 1
+    assert frame.dtype == np.uint8 and frame.max() < 198
+    assert elapsed < 0.5
+
+
+def test_closed_loop_correction_reduces_residual(tmp_path, aberration, bench, remove_piston_tilt):
+    slm, cam, shutter = bench(aberration)
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    residuals = []
+    try:
+        for i in range(2):
+            retriever.data_path = str(tmp_path / f"iter{i}")
+            os.makedirs(retriever.data_path)
+            retriever.measure_slm_wavefront(slm, cam, shutter, aperture_number=12, aperture_width=80,
+                                            num_frames=2, roi_min_x=2, roi_min_y=2, roi_n=8,
+                                            use_correction=i > 0)
+            retriever.wait_for_results()
+            (run_dir,) = os.listdir(retriever.data_path)
+            dphi = np.load(os.path.join(retriever.data_path, run_dir, "dphi.npy"))
+            residuals.append(np.std(remove_piston_tilt(dphi)))
+        saved = np.load(os.path.join(retriever.data_path, run_dir, "correction_phase.npy"))
+        np.testing.assert_array_equal(saved, retriever.correction_phase)
+        zernike = correction_from_record(os.path.join(retriever.data_path, run_dir, "zernike.json"))
+    finally:
+        phase_gen.correction_phase = None
+    assert residuals[1] < 0.5 * residuals[0]
+    # The accumulated Zernike coefficients rebuild the closed-loop correction on the scanned block
+    cy, cx = (int(c) for c in retriever.zernike["center"])
+    block = np.s_[cy - 320:cy + 320, cx - 320:cx + 320]
+    diff = np.angle(np.exp(2j * np.pi * (zernike[block] - retriever.correction_phase[block])))
+    assert np.std(diff) / (2 * np.pi) < 0.1
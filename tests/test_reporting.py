@@ -0,0 +1,68 @@
+"""
+Tests for the background result writer and lazy plotting in function_scripts/reporting.py.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from function_scripts.reporting import ResultWriter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_writer_saves_in_background_and_waits(tmp_path):
+    writer = ResultWriter()
+    gate = threading.Event()
+    writer.submit(gate.wait)
+    writer.save(str(tmp_path / "a.npy"), np.arange(5))
+    try:
+        assert writer.pending >= 1 and not (tmp_path / "a.npy").exists()
+        assert writer.wait(timeout=0.05) is False
+    finally:
+        gate.set()
+    assert writer.wait() is True
+    np.testing.assert_array_equal(np.load(tmp_path / "a.npy"), np.arange(5))
+    assert writer.pending == 0 and not (tmp_path / "a.npy.part").exists()
+
+
+def test_writer_reraises_job_errors_on_wait(tmp_path):
+    writer = ResultWriter()
+    writer.save(str(tmp_path / "missing" / "a.npy"), np.zeros(3))
+    writer.save(str(tmp_path / "b.npy"), np.ones(3))
+    with pytest.raises(FileNotFoundError):
+        writer.wait()
+    assert (tmp_path / "b.npy").exists()
+    assert writer.wait() is True
+
+
+def test_headless_measurement_never_imports_matplotlib(tmp_path):
+    script = f"""
+import sys
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+slm, shutter = SimulatedSlm(), SimulatedShutter()
+cam = SimulatedCamera(slm, shutter, beam_waist=3e-3, n_fft=1536, roi_shape=(48, 48), seed=0)
+retriever = PhaseAmplitudeRetriever({str(tmp_path)!r})
+retriever.measure_slm_wavefront(slm, cam, shutter, aperture_number=12, aperture_width=80,
+                                num_frames=1, roi_min_x=5, roi_min_y=5, roi_n=2, plots=False)
+retriever.wait_for_results()
+assert "matplotlib" not in sys.modules, "matplotlib imported"
+"""
+    subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True)
+    (run_dir,) = os.listdir(tmp_path)
+    files = os.listdir(tmp_path / run_dir)
+    assert "dphi.npy" in files and "phase_map.png" not in files
+
+
+def test_figures_are_rendered_without_pyplot(tmp_path):
+    pytest.importorskip("matplotlib")
+    writer = ResultWriter()
+    writer.figure(str(tmp_path / "map.png"), np.eye(8), "Map", "magma")
+    writer.wait()
+    assert (tmp_path / "map.png").stat().st_size > 0
@@ -0,0 +1,84 @@
+"""
+Tests for the SLM settle-time calibration in function_scripts/settle_calibration.py.
+"""
+
+import numpy as np
+import pytest
+
+from function_scripts.settle_calibration import SettleStore, calibrate_settle_time, settled_after
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+
+def small_bench(response_time, store=None):
+    slm = SimulatedSlm(res=(128, 160), response_time=response_time, settle_store=store)
+    shutter = SimulatedShutter()
+    shutter.shutter_enable(True)
+    # Window on the first order of the grating, clear of the zero order
+    cam = SimulatedCamera(slm, shutter, n_fft=512, roi_shape=(12, 12), noise=1.0, seed=0)
+    return slm, cam
+
+
+def test_settled_after_finds_start_of_settled_tail():
+    times = np.arange(10) * 0.01
+    signal = np.array([0, 50, 90, 99, 101, 100, 100, 99, 100, 100], dtype=float)
+    assert settled_after(times, signal, band=2) == pytest.approx(0.03)
+    assert settled_after(times, np.full(10, 5.0), band=1) == 0.0
+
+
+def test_store_keeps_nearest_temperature_per_device(tmp_path):
+    store = SettleStore(str(tmp_path / "settle.json"))
+    store.add("A", 25.0, 0.05)
+    store.add("A", 35.0, 0.02)
+    store.add("A", 35.05, 0.03)  # replaces the 35 degC entry
+    store.add("B", 30.0, 0.08)
+    reloaded = SettleStore(store.path)
+    assert len(reloaded.entries["A"]) == 2
+    assert reloaded.lookup("A", 34.0) == 0.03
+    assert reloaded.lookup("A", 26.5) == 0.05
+    assert reloaded.lookup("A", 30.0) is None
+    assert reloaded.lookup("C", 30.0) is None
+
+
+def test_calibration_follows_response_time(tmp_path):
+    store = SettleStore(str(tmp_path / "settle.json"))
+    results = {}
+    for tau in (0.002, 0.015):
+        slm, cam = small_bench(tau)
+        results[tau] = calibrate_settle_time(slm, cam, store=store, duration=max(0.05, 12 * tau),
+                                             n_toggles=2)["settle_time"]
+    # Intensity within 2 % takes a few time constants, far below the fixed 100 ms
+    assert results[0.002] < 0.04
+    assert 2 * 0.015 < results[0.015] < 0.1
+    assert store.lookup("simulated", 30.0) == results[0.015]
+
+
+def test_calibration_rejects_patterns_without_contrast():
+    slm, cam = small_bench(0.0)
+    flat = np.zeros((128, 160), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        calibrate_settle_time(slm, cam, patterns=(flat, flat), duration=0.02, n_toggles=1)
+
+
+def test_drivers_pick_up_calibrated_settle_time(tmp_path):
+    store = SettleStore(str(tmp_path / "settle.json"))
+    store.add("LSH0803420", 30.0, 0.012)
+    store.add("simulated", 30.0, 0.007)
+
+    dll = StubSlmDll(head_temp=30.5)
+    slm = SlmHamamatsu(dll=dll, settle_time=0.1, settle_store=store)
+    slm.connect()
+    assert slm.settle_time == 0.012
+    dll.head_temp = 40.0  # no calibration near 40 degC: back to the default
+    assert slm.update_settle_time() == 0.1
+
+    sim, _ = small_bench(0.0, store)
+    assert sim.update_settle_time() == 0.007
+
+    # Settle times are kept per head: a second SLM on the bench gets its own entry
+    store.add("LSH0900001", 30.0, 0.020)
+    other = SlmHamamatsu(dll=StubSlmDll(head_temp=30.5), settle_time=0.1, settle_store=store, serial="LSH0900001")
+    other.connect()
+    assert other.settle_time == 0.020 and slm.update_settle_time() == 0.1
+    assert "CAL_LSH0900001_750nm.bmp" in other.correction_pattern_path()
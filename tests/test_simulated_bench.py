@@ -0,0 +1,60 @@
+"""
+End-to-end regression test of measure_slm_wavefront on the simulated optical bench.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from function_scripts.slmphase import PhaseAmplitudeRetriever
+from simulation.simulated_bench import SimulatedCamera, SimulatedShutter, SimulatedSlm
+
+# 80 px apertures hold two periods of the 40 px measurement grating
+APERTURE_NUMBER = 12
+APERTURE_WIDTH = 80
+ROI_MIN_X, ROI_MIN_Y, ROI_N = 4, 3, 4
+
+
+def test_closed_shutter_gives_dark_frames():
+    slm = SimulatedSlm()
+    shutter = SimulatedShutter()
+    cam = SimulatedCamera(slm, shutter, roi_shape=(32, 32), noise=2.0, seed=0)
+    cam.take_average_image(4)
+    assert cam.last_frame.shape == (32, 32)
+    assert abs(cam.last_frame.mean()) < 1.0
+
+
+@pytest.mark.parametrize("backend", ["sine", "fft"])
+def test_measure_recovers_injected_aberration(tmp_path, backend, aberration, bench, patch_truth, remove_piston_tilt):
+    slm, cam, shutter = bench(aberration)
+
+    retriever = PhaseAmplitudeRetriever(str(tmp_path))
+    retriever.measure_slm_wavefront(
+        slm, cam, shutter,
+        aperture_number=APERTURE_NUMBER,
+        aperture_width=APERTURE_WIDTH,
+        num_frames=2,
+        roi_min_x=ROI_MIN_X,
+        roi_min_y=ROI_MIN_Y,
+        roi_n=ROI_N,
+        fit_backend=backend,
+    )
+    retriever.wait_for_results()
+    (run_dir,) = os.listdir(tmp_path)
+    dphi = np.load(os.path.join(tmp_path, run_dir, "dphi.npy"))
+
+    error = np.angle(np.exp(1j * (dphi - patch_truth(aberration, APERTURE_NUMBER, APERTURE_WIDTH,
+                                                    ROI_MIN_X, ROI_MIN_Y, ROI_N))))
+    residual = remove_piston_tilt(error)
+    assert np.sqrt(np.mean(residual ** 2)) < 0.1
+
+
+def test_workers_without_refine_fit_is_rejected(tmp_path, bench):
+    slm, cam, shutter = bench()
+    with pytest.raises(ValueError, match="refine_fit"):
+        PhaseAmplitudeRetriever(str(tmp_path)).measure_slm_wavefront(
+            slm, cam, shutter, aperture_number=APERTURE_NUMBER, aperture_width=APERTURE_WIDTH,
+            roi_n=ROI_N, workers=2,
+        )
+    assert not os.listdir(tmp_path)
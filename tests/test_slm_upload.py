@@ -0,0 +1,71 @@
+"""
+Tests for the SlmHamamatsu upload path, using the stub DLL. Upload timings are
+tracked by the slm_load_phase benchmark in tests/benchmark_suite.py.
+"""
+
+import time
+
+import numpy as np
+
+from slm.slm_hamamatsu import SlmHamamatsu
+from slm.stub_dll import StubSlmDll
+
+
+def make_slm(**kwargs):
+    slm = SlmHamamatsu(dll=StubSlmDll(**kwargs), settle_time=0.0)
+    slm.connect()
+    return slm
+
+
+def legacy_upload(slm, image):
+    """Marshalling used before the zero-copy path: Python list + ffi.new."""
+    image = image.astype(np.uint8).flatten().tolist()
+    array_in = slm.ffi.new(f'uint8_t [{slm.slmX * slm.slmY}]', image)
+    slm.slmffi.Write_FMemArray(
+        slm.ffi.cast('uint8_t', slm.bID), array_in, slm.ffi.cast('int32_t', slm.slmX * slm.slmY),
+        slm.ffi.cast('uint32_t', slm.slmX), slm.ffi.cast('uint32_t', slm.slmY), slm.ffi.cast('uint32_t', 0)
+    )
+
+
+def test_uint8_frame_is_uploaded_unchanged():
+    slm = make_slm()
+    frame = np.random.default_rng(0).integers(0, 198, size=(1024, 1272), dtype=np.uint8)
+    slm.load_phase(frame)
+    np.testing.assert_array_equal(slm.slmffi.frames[0], frame)
+    assert slm.slmffi.writes == [(1, 0, 1272, 1024)]
+
+
+def test_float_and_strided_frames_go_through_staging_buffer():
+    slm = make_slm()
+    phase = np.random.default_rng(1).uniform(0, 198, size=(1024, 1272))
+    slm.load_phase(phase)
+    np.testing.assert_array_equal(slm.slmffi.frames[0], phase.astype(np.uint8))
+
+    wide = np.random.default_rng(2).integers(0, 198, size=(1024, 2544), dtype=np.uint8)
+    slm.load_phase(wide[:, ::2])
+    np.testing.assert_array_equal(slm.slmffi.frames[0], wide[:, ::2])
+
+
+def test_settle_time_is_configurable_and_measured():
+    slm = make_slm(record_frames=False)
+    slm.settle_time = 0.02
+    slm.load_phase(np.zeros((1024, 1272), dtype=np.uint8))
+    assert slm.last_settle_time >= 0.02
+    assert slm.last_upload_time < slm.last_settle_time
+
+
+def test_zero_copy_upload_beats_list_marshalling():
+    slm = make_slm(record_frames=False)
+    frame = np.random.default_rng(3).integers(0, 198, size=(1024, 1272), dtype=np.uint8)
+
+    def best_of(fn, repeats=3):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    legacy = best_of(lambda: legacy_upload(slm, frame))
+    fast = best_of(lambda: slm.load_phase(frame))
+    assert fast * 10 < legacy, f"legacy upload {legacy * 1e3:.1f} ms, zero-copy upload {fast * 1e3:.2f} ms"
@@ -0,0 +1,64 @@
+"""
+Tests for the Zernike decomposition and synthesis (function_scripts/zernike.py).
+"""
+
+import numpy as np
+import pytest
+
+from function_scripts import zernike as zk
+
+
+def test_modes_are_orthonormal_on_the_unit_disk():
+    polys = zk.mode_polynomials(6)
+    assert polys.shape == (28, 7, 7) and zk.zernike_modes(2)[4] == (2, 0)
+    y, x = np.mgrid[-1:1:601j, -1:1:601j]
+    inside = x ** 2 + y ** 2 <= 1
+    vy, vx = y[inside][:, None] ** np.arange(7), x[inside][:, None] ** np.arange(7)
+    values = np.einsum("iq,jqp,ip->ji", vy, polys, vx)
+    gram = values @ values.T / np.count_nonzero(inside)
+    np.testing.assert_allclose(gram, np.eye(28), atol=5e-3)
+    # Defocus is sqrt(3) (2 rho^2 - 1)
+    np.testing.assert_allclose(values[4], np.sqrt(3) * (2 * (x[inside] ** 2 + y[inside] ** 2) - 1), atol=1e-12)
+
+
+def test_weighted_fit_recovers_coefficients_and_ignores_dark_apertures():
+    basis = zk.ZernikeBasis((12, 12), 100, 200, 64, order=6)
+    coeffs = np.random.default_rng(0).normal(size=28)
+    phase = basis.evaluate(coeffs)
+    np.testing.assert_allclose(basis.fit(phase), coeffs, atol=1e-10)
+
+    weights = np.ones((12, 12))
+    corrupted = phase.copy()
+    corrupted[:3, :3] += 50.0  # e.g. no light on these apertures
+    weights[:3, :3] = 0.0
+    np.testing.assert_allclose(basis.fit(corrupted, weights), coeffs, atol=1e-8)
+    assert np.abs(basis.fit(corrupted) - coeffs).max() > 1
+
+    with pytest.raises(ValueError):
+        zk.ZernikeBasis((4, 4), 0, 0, 64, order=6)
+
+
+def test_synthesis_matches_the_grid_and_masks_outside_the_pupil():
+    basis = zk.get_basis((8, 8), 160, 160, 81, order=4)
+    coeffs = np.random.default_rng(1).normal(size=15)
+    full = basis.synthesize(coeffs, (1024, 1272))
+    assert full.dtype == np.float32 and full.shape == (1024, 1272)
+    centres = 160 + 81 * np.arange(8) + 40  # pixel centres k + 0.5 fall on the cell centres
+    np.testing.assert_allclose(full[np.ix_(centres, centres)], basis.evaluate(coeffs), atol=1e-4)
+    cy, cx = basis.center
+    assert full[0, 1271] == 0 and full[int(cy), int(cx)] != 0
+    correction = zk.correction_from_record(basis.record(coeffs), (1024, 1272))
+    wrapped = np.mod(-full / (2 * np.pi), 1)
+    diff = np.abs(correction - wrapped)
+    assert np.all(np.minimum(diff, 1 - diff) < 1e-5)
+
+
+def test_bases_are_cached_with_lru_eviction():
+    zk.clear_basis_cache()
+    basis = zk.get_basis((8, 8), 0, 0, 64, order=3)
+    assert zk.get_basis([8, 8], 0.0, 0, 64.0, 3) is basis
+    for i in range(zk.ZERNIKE_CACHE_SIZE):
+        zk.get_basis((8, 8), i + 1, 0, 64, order=3)
+    assert zk.get_basis((8, 8), 0, 0, 64, order=3) is not basis
+    assert not basis.q.flags.writeable
+    np.testing.assert_allclose(basis.q.T @ basis.q, np.eye(10), atol=1e-12)